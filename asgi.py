@@ -0,0 +1,12 @@
+import os
+from micropub import app, configure
+from micropub.asgi import make_app
+
+
+# for Flask-IndieAuth
+app.config['ME'] = os.environ['ME']
+app.config['TOKEN_ENDPOINT'] = os.environ['TOKEN_ENDPOINT']
+
+configure()
+
+application = make_app(app)
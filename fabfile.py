@@ -18,9 +18,14 @@ image = f'desmondrivet/micropub-git-server:{branch}'
 name = 'micropub-git-server'
 
 
-env = ['ME', 'TOKEN_ENDPOINT', 'GITHUB_REPO', 'GITHUB_USERNAME',
-       'GITHUB_PASSWORD', 'MICROPUB_MEDIA_ENDPOINT', 
-       'MICROPUB_REPO_PATH_FORMAT', 'MICROPUB_PERMALINK_FORMAT']
+# the settings are read by micropub/settings.py, ones that aren't set here
+# aren't passed on and keep their defaults
+env = ['ME', 'TOKEN_ENDPOINT', 'GH_REPO', 'GH_USERNAME', 'GH_PASSWORD',
+       'MICROPUB_BRANCH', 'MICROPUB_METRICS_TOKEN', 'MICROPUB_MEDIA_ENDPOINT',
+       'MICROPUB_MEDIA_PATH_FORMAT', 'MICROPUB_MEDIA_URL_FORMAT',
+       'MICROPUB_REPO_PATH_FORMAT', 'MICROPUB_PERMALINK_FORMAT',
+       'MICROPUB_POST_FORMAT', 'MICROPUB_POST_FORMATS',
+       'MICROPUB_BATCH_WINDOW']
 
 
 def all_env_cmd():
@@ -1,5 +1,5 @@
 import os
-from micropub import app as application
+from micropub import app as application, configure
 
 
 # for Flask-IndieAuth
@@ -7,5 +7,7 @@ application.config['ME'] = os.environ['ME']
 application.config['TOKEN_ENDPOINT'] = os.environ['TOKEN_ENDPOINT']
 # application.config['TESTING'] = True
 
+configure()
+
 if __name__ == "__main__":
     application.run()
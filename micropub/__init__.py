@@ -1,6 +1,9 @@
 import logging
+import os
 from flask import Flask
+from micropub import micropub
 from micropub.micropub import micropub_bp
+from micropub.settings import load_settings
 
 
 app = Flask(__name__)
@@ -8,3 +11,15 @@ app = Flask(__name__)
 
 app.register_blueprint(micropub_bp, url_prefix='/')
 app.logger.setLevel(logging.INFO)
+
+
+def configure(environ=os.environ):
+    """Read the settings from the environment and set up the endpoint.
+    Raises settings.ConfigError straight away if they're unusable."""
+    settings = load_settings(environ)
+    app.config['MICROPUB_SETTINGS'] = settings
+    # the endpoints check their own, smaller, limits as well, see
+    # micropub.check_body_size
+    app.config['MAX_CONTENT_LENGTH'] = max(settings.max_body_size,
+                                           settings.media_max_size)
+    micropub.configure(settings)
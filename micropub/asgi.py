@@ -0,0 +1,247 @@
+"""
+An ASGI front end for the micropub endpoint, for serving lots of slow
+clients from one process rather than a thread each:
+
+    pip install .[async]
+    uvicorn asgi:application
+
+Creates and queries are handled on the event loop: the token check and the
+GitHub calls, including the listing for the one-off rebuild of the post
+index, are made on an async HTTP client, so a post waiting on GitHub is a
+suspended coroutine rather than a blocked thread.  Making the post file,
+the commit queue and the sqlite indexes are local and quick, and are done
+on the loop too.
+Everything else, like updates and deletes, media uploads and /metrics, is
+handed to the Flask app, which asgiref runs in a thread pool.
+"""
+import io
+import sys
+from asgiref.wsgi import WsgiToAsgi
+from flask import Response, request
+from flask import current_app as app
+from flask_indieauth import get_access_token
+from werkzeug.exceptions import BadRequest
+from micropub import asyncgithub
+from micropub import metrics
+from micropub import micropub as mp
+from micropub.indieauth import check_auth_async
+
+
+class ClientGone(Exception):
+    pass
+
+
+def make_app(flask_app):
+    """Return the ASGI application serving flask_app."""
+    wsgi = WsgiToAsgi(flask_app)
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] in ('', '/') and \
+                scope['method'] in ('GET', 'POST'):
+            try:
+                await serve_root(flask_app, wsgi, scope, receive, send)
+            except ClientGone:
+                pass
+        else:
+            await wsgi(scope, receive, send)
+    return application
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await asyncgithub.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def serve_root(flask_app, wsgi, scope, receive, send):
+    length = header(scope, b'content-length')
+    if length is not None and length.isdigit() and \
+            int(length) > mp.settings.max_body_size:
+        # refused by check_body_size, without reading the body
+        return await wsgi(scope, receive, send)
+    body = await read_body(receive, mp.settings.max_body_size)
+    if body is None:
+        return await send_response(send, Response(status=413))
+
+    response = None
+    with flask_app.request_context(make_environ(scope, body)):
+        if handled_here():
+            response = await dispatch(flask_app, handle_root)
+    if response is None:
+        await wsgi(scope, replay(body, receive), send)
+    else:
+        await send_response(send, response)
+
+
+def handled_here():
+    """Whether this is a create or a query, rather than something for the
+    Flask app."""
+    if request.method == 'GET':
+        return 'q' in request.args
+    try:
+        json_data = request.get_json() if request.is_json else None
+    except BadRequest:
+        # let the Flask app turn it down
+        return False
+    data = json_data if isinstance(json_data, dict) else request.form
+    return 'action' not in data
+
+
+async def dispatch(flask_app, view):
+    """Do what Flask does with a request, but awaiting the view."""
+    try:
+        rv = flask_app.preprocess_request()
+        if rv is None:
+            rv = await view()
+    except Exception as e:
+        rv = handle_exception(flask_app, e)
+    return flask_app.process_response(flask_app.make_response(rv))
+
+
+def handle_exception(flask_app, e):
+    try:
+        return flask_app.handle_user_exception(e)
+    except Exception as e:
+        return flask_app.handle_exception(e)
+
+
+async def handle_root():
+    if not app.config.get('TESTING', False):
+        with metrics.timer('micropub_stage_seconds', stage='auth'):
+            resp = await check_auth_async(get_access_token())
+        if isinstance(resp, Response):
+            return resp
+    if request.method == 'GET':
+        return await handle_query()
+    app.logger.info('handling micropub root POST')
+    with metrics.timer('micropub_stage_seconds', stage='create'):
+        return await handle_create()
+
+
+async def handle_create():
+    prepared = mp.prepare_create()
+    if isinstance(prepared, Response):
+        return prepared
+    key, post, permalink = prepared
+    repo_path = mp.post_repo_path(post)
+    try:
+        with mp.post_contents(post, mp.settings.post_format(repo_path)) \
+                as contents:
+            await commit_files({repo_path: contents}, 'new post', permalink)
+            mp.record_post(post, repo_path, contents)
+    except Exception:
+        mp.handled_requests.release(key)
+        raise
+    return mp.created(permalink)
+
+
+async def commit_files(files, message, permalink):
+    if mp.commit_queue:
+        with metrics.timer('micropub_stage_seconds', stage='queue'):
+            mp.commit_queue.put(files, message, permalink)
+    else:
+        with metrics.timer('micropub_stage_seconds', stage='commit'):
+            await mp.backend.commit_async(files, message)
+
+
+async def handle_query():
+    if request.args.get('q') != 'source':
+        return mp.handle_query()
+    if mp.needs_rebuild(request.args.get('url')):
+        mp.rebuild_index(await mp.backend.list_files_async())
+    found = mp.find_source()
+    if isinstance(found, Response):
+        return found
+    path, version = found
+    try:
+        contents = mp.local_post(path, version)
+    except KeyError:
+        contents = await mp.backend.read_async(path)
+        if contents is not None:
+            mp.cache_post(path, version, contents)
+    return mp.source_response(path, contents)
+
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def read_body(receive, limit):
+    """Return the request body, or None if it's bigger than limit."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientGone()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if limit is not None and size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+def replay(body, receive):
+    """Return a receive function giving the body we've already read."""
+    pending = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive_again():
+        if pending:
+            return pending.pop()
+        return await receive()
+    return receive_again
+
+
+def make_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8')
+        .decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for key, value in scope['headers']:
+        name = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+async def send_response(send, response):
+    headers = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+               for k, v in response.headers.items()]
+    await send({'type': 'http.response.start',
+                'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': response.get_data()})
@@ -0,0 +1,227 @@
+"""
+The GitHub calls of micropub.commit, made on an asyncio HTTP client
+(httpx), for serving from micropub.asgi.
+
+Settings, the rate limiter, the head cache and the known blobs are all
+micropub.commit's, so both can commit to the same branch from the same
+process; the commit queue thread keeps using the blocking client.
+
+GH_ASYNC_POOL_SIZE - max connections kept open to the API host by the
+  event loop (default 16)
+"""
+import asyncio
+import base64
+import os
+import time
+import httpx
+from micropub import commit as gh
+from micropub import metrics
+from micropub.commit import GitHubError
+
+POOL_SIZE = int(os.environ.get('GH_ASYNC_POOL_SIZE', '16'))
+
+_client = None
+_client_loop = None
+_branch_locks = {}
+
+
+async def commit(repo, auth, files, message, branch='master'):
+    """Like micropub.commit.commit."""
+    entries = await tree_entries(repo, auth, files)
+    async with branch_lock(repo, branch):
+        for attempt in range(gh.COMMIT_RETRIES + 1):
+            if attempt > 1:
+                await asyncio.sleep(gh.retry_pause(attempt))
+            head = await get_head(repo, auth, branch, refresh=attempt > 0)
+            try:
+                return await commit_entries(repo, auth, head, entries,
+                                            message, branch)
+            except gh.StaleHead:
+                if attempt == gh.COMMIT_RETRIES:
+                    raise
+
+
+def branch_lock(repo, branch):
+    loop = asyncio.get_event_loop()
+    lock, lock_loop = _branch_locks.get((repo, branch), (None, None))
+    if lock is None or lock_loop is not loop:
+        lock = asyncio.Lock()
+        _branch_locks[(repo, branch)] = (lock, loop)
+    return lock
+
+
+async def tree_entries(repo, auth, files):
+    """Like micropub.commit.tree_entries, with the uploads running side by
+    side on the event loop."""
+    tasks = {path: asyncio.ensure_future(tree_entry(repo, auth, contents))
+             for path, contents in files.items()}
+    if not tasks:
+        return {}
+    done, pending = await asyncio.wait(tasks.values(),
+                                       return_when=asyncio.FIRST_EXCEPTION)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    errors = {path: task.exception() for path, task in tasks.items()
+              if not task.cancelled() and task.exception() is not None}
+    if errors:
+        raise gh.upload_error(errors)
+    return {path: task.result() for path, task in tasks.items()}
+
+
+async def tree_entry(repo, auth, contents):
+    sha, entry = gh.local_entry(repo, contents)
+    if entry is None:
+        sha = (await create_blob(repo, auth, contents))['sha']
+        gh._known_blobs.put((repo, sha), True)
+        entry = {'sha': sha}
+    return sha, entry
+
+
+async def commit_entries(repo, auth, head, entries, message, branch):
+    files, changed = gh.changed_entries(repo, branch, head, entries)
+    if not changed and entries:
+        # see micropub.commit.commit_entries
+        known = gh.known_files(repo, branch, head)
+        fresh = await get_head(repo, auth, branch, refresh=True)
+        if fresh['sha'] == head['sha']:
+            return gh.remember_head(repo, branch, fresh, known)
+        head = fresh
+        files, changed = gh.changed_entries(repo, branch, head, entries)
+    if not changed:
+        return head
+    new_tree = await post(gh.git_url(repo, 'trees'), auth,
+                          gh.tree_data(head['tree'], changed))
+    if new_tree['sha'] == head['tree']['sha']:
+        gh.remember_commit(repo, branch, head, files)
+        return head
+    new_commit = await post(gh.git_url(repo, 'commits'), auth,
+                            gh.commit_data(head, new_tree, message))
+    try:
+        await patch(gh.git_url(repo, f'refs/heads/{branch}'), auth,
+                    {'sha': new_commit['sha']})
+    except GitHubError as e:
+        gh.forget_head(repo, branch)
+        raise gh.stale_head(e)
+    gh.remember_commit(repo, branch, new_commit, files)
+    return new_commit
+
+
+async def get_head(repo, auth, branch, refresh=False):
+    cached = None if refresh else gh.cached_head(repo, branch)
+    if cached:
+        return cached
+    return gh.remember_head(repo, branch,
+                            await get_latest_commit(repo, auth, branch))
+
+
+async def get_latest_commit(repo, auth, branch):
+    ref = await get(gh.git_url(repo, f'ref/heads/{branch}'), auth)
+    return await get(gh.git_url(repo, f'commits/{ref["object"]["sha"]}'),
+                     auth)
+
+
+async def list_files(repo, auth, branch):
+    """Like micropub.commit.list_files."""
+    latest = await get_latest_commit(repo, auth, branch)
+    tree = await get(
+        gh.git_url(repo, f'trees/{latest["tree"]["sha"]}?recursive=1'), auth)
+    return gh.tree_paths(repo, tree)
+
+
+async def read_file(repo, auth, path, branch):
+    """Like micropub.commit.read_file."""
+    try:
+        body = await get(gh.contents_url(repo, path, branch), auth)
+    except GitHubError as e:
+        if e.status_code == 404:
+            return None
+        raise
+    gh._known_blobs.put((repo, body['sha']), True)
+    if body.get('encoding') != 'base64':
+        body = await get(gh.git_url(repo, f'blobs/{body["sha"]}'), auth)
+    return base64.b64decode(body['content'])
+
+
+async def create_blob(repo, auth, content):
+    url = gh.git_url(repo, 'blobs')
+    post_data = gh.blob_data(content)
+    if post_data is None:
+        return await request('POST', url, 201, auth,
+                             body=gh.Base64Body(content))
+    return await post(url, auth, post_data)
+
+
+async def stream(body):
+    """Send a Base64Body from the start, a chunk at a time."""
+    body.rewind()
+    while True:
+        chunk = body.read(4 * body.chunk_size // 3)
+        if not chunk:
+            break
+        yield chunk
+
+
+def get_client():
+    """Return the event loop's client, creating it on first use.  The token
+    check uses it too."""
+    global _client, _client_loop
+    loop = asyncio.get_event_loop()
+    if _client is None or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=POOL_SIZE,
+                                max_keepalive_connections=POOL_SIZE),
+            timeout=httpx.Timeout(gh.TIMEOUT[1], connect=gh.TIMEOUT[0]))
+        _client_loop = loop
+    return _client
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def get(url, auth):
+    return await request('GET', url, 200, auth)
+
+
+async def post(url, auth, data):
+    return await request('POST', url, 201, auth, json=data)
+
+
+async def patch(url, auth, data):
+    return await request('PATCH', url, 200, auth, json=data)
+
+
+async def request(method, url, expected_status, auth, json=None, body=None):
+    """Like micropub.commit.request.  body is a Base64Body to stream."""
+    call = gh.call_type(method, url)
+    limiter = gh.get_rate_limiter()
+    for attempt in range(gh.RATE_LIMIT_RETRIES + 1):
+        wait = gh.claim_slot(limiter, method, url, call)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        headers = {'Accept': 'application/vnd.github.v3+json'}
+        if body is None:
+            kwargs = {'json': json}
+        else:
+            kwargs = {'content': stream(body)}
+            headers['Content-Type'] = 'application/json'
+            headers['Content-Length'] = str(len(body))
+
+        start = time.perf_counter()
+        try:
+            r = await get_client().request(method, url, auth=auth,
+                                           headers=headers, **kwargs)
+        except httpx.HTTPError:
+            metrics.inc('micropub_github_failures_total', call=call,
+                        status='error')
+            raise
+        finally:
+            metrics.observe('micropub_github_request_seconds',
+                            time.perf_counter() - start, call=call)
+        if gh.check_response(limiter, method, url, call, r, expected_status,
+                             last=attempt == gh.RATE_LIMIT_RETRIES):
+            return r.json()
@@ -0,0 +1,91 @@
+"""
+Where posts get committed.
+
+A backend has a commit(files, message) method, which commits the files
+(a dictionary of repo paths to contents, or None for files to delete) in
+one shot, and a flush() method, which returns once everything committed so
+far has reached the site repository.  read(path) returns the committed
+contents of a file as bytes, or None, and list_files() the paths of every
+file in the repository.  commit_async(files, message), read_async(path)
+and list_files_async() are the same for asyncio callers, run in a thread
+unless the backend has something better.
+
+MICROPUB_BACKEND picks one:
+
+* github (the default) - commits through the GitHub Git Data API
+* local - commits into a local bare clone and pushes in the background,
+  see micropub.localgit
+"""
+import asyncio
+from micropub.commit import commit, list_files, read_file
+
+
+class Backend:
+    def commit(self, files, message):
+        raise NotImplementedError
+
+    async def commit_async(self, files, message):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.commit, files, message)
+
+    async def read_async(self, path):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.read, path)
+
+    async def list_files_async(self):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.list_files)
+
+    def flush(self):
+        pass
+
+    def read(self, path):
+        raise NotImplementedError
+
+    def list_files(self):
+        raise NotImplementedError
+
+
+class GitHubBackend(Backend):
+    def __init__(self, repo, auth, branch='main'):
+        self.repo = repo
+        self.auth = auth
+        self.branch = branch
+
+    def commit(self, files, message):
+        commit(self.repo, self.auth, files, message, self.branch)
+
+    async def commit_async(self, files, message):
+        # httpx is only installed with the async extra
+        from micropub import asyncgithub
+        await asyncgithub.commit(self.repo, self.auth, files, message,
+                                 self.branch)
+
+    def read(self, path):
+        return read_file(self.repo, self.auth, path, self.branch)
+
+    async def read_async(self, path):
+        from micropub import asyncgithub
+        return await asyncgithub.read_file(self.repo, self.auth, path,
+                                           self.branch)
+
+    def list_files(self):
+        return list_files(self.repo, self.auth, self.branch)
+
+    async def list_files_async(self):
+        from micropub import asyncgithub
+        return await asyncgithub.list_files(self.repo, self.auth,
+                                            self.branch)
+
+
+def make_backend(settings):
+    auth = (settings.username, settings.password)
+    if settings.backend == 'local':
+        from micropub.localgit import LocalGitBackend
+        remote = settings.git_remote or \
+            f'https://github.com/{settings.repo}.git'
+        return LocalGitBackend(settings.local_repo, remote, settings.branch,
+                               push_interval=settings.push_interval,
+                               credentials=auth)
+    else:
+        return GitHubBackend(settings.repo, auth, settings.branch)
@@ -0,0 +1,191 @@
+"""
+Benchmarks for the create pipeline, stage by stage, with the full request
+committing to an in-process fake GitHub.
+
+    python -m micropub.bench [--latency 0.05] [--iterations 200]
+                             [--save] [--baseline bench-baseline.json]
+
+Prints throughput and p50/p99 latency for each stage.  With --save the
+results become the new baseline; otherwise they're compared with the
+baseline, if there is one, and the run fails if any stage's p50 got slower
+by more than --tolerance.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from werkzeug.datastructures import MultiDict
+import micropub.commit
+from micropub.fakegithub import FakeGitHub
+
+DEFAULT_BASELINE = 'bench-baseline.json'
+
+FORM = MultiDict([
+    ('h', 'entry'),
+    ('content', 'A short note, like most of them. ' * 4),
+    ('category[]', 'indieweb'),
+    ('category[]', 'micropub'),
+    ('in-reply-to', 'https://example.com/2019/08/15/a-post'),
+    ('mp-slug', 'a-short-note'),
+    ('published', '2019-08-15T14:35:45.5')
+])
+
+JSON_POST = {
+    'type': ['h-entry'],
+    'properties': {
+        'name': ['A longer post'],
+        'content': [{'html': '<p>' + 'Some words about things. ' * 40 +
+                     '</p>'}],
+        'category': ['indieweb', 'micropub'],
+        'mp-slug': ['a-longer-post'],
+        'published': ['2019-08-15T14:35:45-04:00']
+    }
+}
+
+
+def measure(fn, iterations, warmup=10):
+    """Call fn iterations times, returning its throughput and latency
+    percentiles, in seconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+    times.sort()
+    return {
+        'ops_per_sec': iterations / total,
+        'p50': percentile(times, 50),
+        'p99': percentile(times, 99)
+    }
+
+
+def percentile(sorted_times, p):
+    index = min(len(sorted_times) - 1,
+                int(round(p / 100 * (len(sorted_times) - 1))))
+    return sorted_times[index]
+
+
+def setup_app(server):
+    """Configure the app to commit to the fake server, with auth off."""
+    from micropub import app, configure
+    micropub.commit.GITHUB_API_ROOT = server.url
+    # what's known of the last run's server doesn't hold for this one
+    micropub.commit.forget_head('bench/site', 'main')
+    micropub.commit._known_blobs.clear()
+    # a log line per request would swamp the timings
+    app.logger.setLevel(logging.WARNING)
+    app.config['TESTING'] = True
+    app.config['ME'] = 'https://example.com'
+    configure({
+        'GH_REPO': 'bench/site',
+        'GH_USERNAME': 'bench',
+        'GH_PASSWORD': 'bench',
+        'MICROPUB_INDEX': os.path.join(tempfile.mkdtemp(), 'index.sqlite'),
+        'MICROPUB_IDEMPOTENCY_DB': os.path.join(tempfile.mkdtemp(),
+                                                'idempotency.sqlite'),
+        'MICROPUB_METRICS_DIR': tempfile.mkdtemp(),
+        'MICROPUB_MEDIA_DIR': tempfile.mkdtemp(),
+        'MICROPUB_MEDIA_WORKERS': '0'
+    })
+    return app.test_client()
+
+
+def run(iterations, latency):
+    from micropub.micropub import form2json, extract_create_request
+    from micropub.format import make_post
+    from micropub.post import Post
+
+    server = FakeGitHub(latency=latency, branch='main').start()
+    try:
+        client = setup_app(server)
+        counter = iter(range(10 ** 9))
+
+        def create():
+            # a fresh published time each time, or they'd all be one file
+            n = next(counter)
+            post = json.loads(json.dumps(JSON_POST))
+            post['properties']['published'] = \
+                [f'2019-08-15T14:{n // 60 % 60:02}:{n % 60:02}-04:00']
+            rv = client.post('/', json=post)
+            assert rv.status_code == 202, rv.status_code
+
+        return {
+            'form2json': measure(lambda: form2json(FORM), iterations * 10),
+            'extract_create_request': measure(
+                lambda: extract_create_request(
+                    json.loads(json.dumps(JSON_POST)), None),
+                iterations * 10),
+            'make_post': measure(
+                lambda: make_post(Post(form2json(FORM))), iterations * 10),
+            'handle_create': measure(create, iterations)
+        }
+    finally:
+        server.stop()
+
+
+def compare(results, baseline, tolerance):
+    """Return the stages whose p50 is more than tolerance times slower
+    than the baseline's."""
+    return [stage for stage, result in results.items()
+            if stage in baseline and
+            result['p50'] > baseline[stage]['p50'] * tolerance]
+
+
+def report(results, baseline):
+    print(f'{"stage":<24}{"ops/s":>12}{"p50 ms":>10}{"p99 ms":>10}'
+          f'{"vs base":>10}')
+    for stage, result in results.items():
+        change = ''
+        if stage in baseline:
+            change = f'{result["p50"] / baseline[stage]["p50"]:.2f}x'
+        print(f'{stage:<24}{result["ops_per_sec"]:>12.1f}'
+              f'{result["p50"] * 1000:>10.3f}{result["p99"] * 1000:>10.3f}'
+              f'{change:>10}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the create '
+                                     'pipeline.')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the fake GitHub waits per call')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    results = run(args.iterations, args.latency)
+    baseline = {}
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        # timings with another latency can't be compared
+        if saved['latency'] == args.latency:
+            baseline = saved['stages']
+        else:
+            print(f'baseline was run with latency {saved["latency"]}, '
+                  'not comparing')
+    report(results, baseline)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'latency': args.latency, 'stages': results}, f,
+                      indent=2, sort_keys=True)
+        return 0
+    slower = compare(results, baseline, args.tolerance)
+    if slower:
+        print(f'slower than the baseline: {", ".join(slower)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
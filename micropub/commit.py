@@ -1,98 +1,663 @@
+import base64
+import hashlib
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from urllib.parse import quote
 import requests
+from requests.adapters import HTTPAdapter
+from micropub import metrics
+from micropub.ratelimit import RateLimiter
+from micropub.utils import LRUCache
 
 GITHUB_API_ROOT = 'https://api.github.com'
 
+# One pooled, keep-alive session per worker process, shared by its threads.
+#
+# GH_POOL_SIZE - max connections kept open to the API host (default 4)
+# GH_CONNECT_TIMEOUT, GH_READ_TIMEOUT - in seconds (defaults 5 and 30)
+POOL_SIZE = int(os.environ.get('GH_POOL_SIZE', '4'))
+TIMEOUT = (float(os.environ.get('GH_CONNECT_TIMEOUT', '5')),
+           float(os.environ.get('GH_READ_TIMEOUT', '30')))
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# The last commit and tree sha seen for each (repo, branch), so steady state
+# commits don't have to look up the branch head first.  If someone else
+# moved the branch meanwhile the ref update is refused as a non fast-forward
+# and we fetch the head again.
+#
+# GH_HEAD_CACHE_TTL - seconds a cached head is trusted (default 300)
+HEAD_CACHE_TTL = float(os.environ.get('GH_HEAD_CACHE_TTL', '300'))
+
+_heads = {}
+
+# Commits to the same branch are serialized within a process; races with
+# other processes are retried on a fresh head, with jittered backoff.
+#
+# GH_COMMIT_RETRIES - how many times a refused ref update is retried
+#   (default 5)
+COMMIT_RETRIES = int(os.environ.get('GH_COMMIT_RETRIES', '5'))
+RETRY_DELAY = 0.1
+
+_branch_locks = {}
+_branch_locks_lock = threading.Lock()
+
+# All calls in a worker process are paced together to stay inside the
+# token's rate limit, see micropub.ratelimit.  Calls that would have to wait
+# too long fail with RateLimited instead, to be made again later.
+#
+# GH_RATE_LIMIT_RESERVE - below this many calls left, calls are spread out
+#   until the limit resets (default 100)
+# GH_RATE_LIMIT_MAX_WAIT - longest a call waits, in seconds (default 10)
+# GH_RATE_LIMIT_RETRIES - how many times a call refused for the rate limit
+#   is made again (default 2)
+RATE_LIMIT_RESERVE = int(os.environ.get('GH_RATE_LIMIT_RESERVE', '100'))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('GH_RATE_LIMIT_MAX_WAIT', '10'))
+RATE_LIMIT_RETRIES = int(os.environ.get('GH_RATE_LIMIT_RETRIES', '2'))
+
+_rate_limiter = None
+_rate_limiter_pid = None
+
+# Blob shas are worked out locally.  Small text files go inline in the tree
+# request instead of being uploaded as blobs of their own, and blobs GitHub
+# is known to have already aren't uploaded again.  Files a commit would
+# leave as they are in a head we made are left out of it, and a commit
+# changing nothing isn't made.
+#
+# GH_INLINE_SIZE - largest text file sent inline, in bytes (default 256KB)
+INLINE_SIZE = int(os.environ.get('GH_INLINE_SIZE', str(256 * 1024)))
+KNOWN_FILES_SIZE = 1000
+
+# (repo, sha) of blobs we've uploaded, committed or read
+_known_blobs = LRUCache(4096)
+
+# The blobs of a commit with several files are uploaded side by side, by a
+# per-process pool of GH_POOL_SIZE threads, one per pooled connection.
+_upload_pool = None
+_upload_pool_pid = None
+
+
+class GitHubError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+    @property
+    def permanent(self):
+        """Whether making the same commit again would fail the same way."""
+        return self.status_code is not None and \
+            400 <= self.status_code < 500
+
+
+class RateLimited(GitHubError):
+    """The call wasn't made, or was refused, because of the rate limit.
+    retry_after is how many seconds to wait before trying again."""
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message, status_code)
+        self.retry_after = retry_after
+
+    permanent = False
+
+
+class StaleHead(GitHubError):
+    """The branch update was refused, because the branch has moved since
+    the head the commit was made on."""
+    permanent = False
+
+
+class UploadFailed(GitHubError):
+    """Some of a commit's blobs couldn't be uploaded, so it wasn't made.
+    errors are {path: exception} of the files that failed."""
+    def __init__(self, errors):
+        message = '; '.join(f'{path}: {e}' for path, e in errors.items())
+        first = next(iter(errors.values()))
+        super().__init__(f'uploading blobs failed, {message}',
+                         getattr(first, 'status_code', None))
+        self.errors = errors
+
 
 def commit(repo, auth, files, message, branch="master"):
     """
     repo is the repository to commit the files to
     files is a dictionary of relative file paths and contents,
-    either new or updated.  Everything committed in one shot.
+    either new or updated, or None for files to delete.  Everything
+    committed in one shot.
     """
-    old_commit = get_latest_commit(repo, auth, branch)
-    old_tree = get_tree(repo, auth, old_commit)
-    blobs = {}
-    for path in files.keys():
-        contents = files[path]
-        blobs[path] = create_blob(repo, auth, contents)
-    new_tree = create_tree(repo, auth, old_tree, blobs)
-    new_commit = create_commit(repo, auth, old_commit, new_tree, message)
-    update_branch(repo, auth, new_commit, branch)
+    entries = tree_entries(repo, auth, files)
+    with branch_lock(repo, branch):
+        for attempt in range(COMMIT_RETRIES + 1):
+            if attempt > 1:
+                time.sleep(retry_pause(attempt))
+            head = get_head(repo, auth, branch, refresh=attempt > 0)
+            try:
+                return commit_entries(repo, auth, head, entries, message,
+                                      branch)
+            except StaleHead:
+                if attempt == COMMIT_RETRIES:
+                    raise
+
+
+def retry_pause(attempt):
+    """How long to wait before another go at a refused commit: not at all
+    the first time, then jittered exponential backoff."""
+    if attempt <= 1:
+        return 0
+    return random.uniform(0, RETRY_DELAY * 2 ** attempt)
+
+
+def branch_lock(repo, branch):
+    with _branch_locks_lock:
+        return _branch_locks.setdefault((repo, branch), threading.Lock())
+
+
+def tree_entries(repo, auth, files):
+    """Return {path: (sha, tree entry)} for the files, in the same order,
+    working on them side by side if there are several.  If any of them
+    fails, the ones not yet started are dropped, and UploadFailed is raised
+    once the others are done, or RateLimited if that's why."""
+    if len(files) < 2:
+        return {path: tree_entry(repo, auth, contents)
+                for path, contents in files.items()}
+    pool = get_upload_pool()
+    futures = {path: pool.submit(tree_entry, repo, auth, contents)
+               for path, contents in files.items()}
+    done, pending = wait(futures.values(), return_when=FIRST_EXCEPTION)
+    if pending:
+        for future in pending:
+            future.cancel()
+        # the running ones are still reading their files
+        wait(pending)
+    errors = {path: future.exception() for path, future in futures.items()
+              if not future.cancelled() and future.exception() is not None}
+    if errors:
+        raise upload_error(errors)
+    return {path: future.result() for path, future in futures.items()}
+
+
+def upload_error(errors):
+    """The error to raise for the {path: exception} of failed uploads."""
+    for e in errors.values():
+        if isinstance(e, RateLimited):
+            return e
+    return UploadFailed(errors)
+
+
+def get_upload_pool():
+    """Return this process' upload threads, starting them on first use (and
+    again after a fork, which leaves them behind)."""
+    global _upload_pool, _upload_pool_pid
+    pid = os.getpid()
+    if _upload_pool is None or _upload_pool_pid != pid:
+        with _session_lock:
+            if _upload_pool is None or _upload_pool_pid != pid:
+                _upload_pool = ThreadPoolExecutor(
+                    POOL_SIZE, thread_name_prefix='blob-upload')
+                _upload_pool_pid = pid
+    return _upload_pool
+
+
+def tree_entry(repo, auth, contents):
+    """Return the blob sha of contents, and how to give it in a tree
+    request: inline, or by the sha of a blob GitHub has, uploading it if
+    need be.  The sha is None for files to delete."""
+    sha, entry = local_entry(repo, contents)
+    if entry is None:
+        sha = create_blob(repo, auth, contents)['sha']
+        _known_blobs.put((repo, sha), True)
+        entry = {'sha': sha}
+    return sha, entry
+
+
+def local_entry(repo, contents):
+    """Return the blob sha of contents and its tree entry, which is None
+    if the blob has to be uploaded."""
+    if contents is None:
+        return None, {'sha': None}
+    sha = blob_sha(contents)
+    if _known_blobs.get((repo, sha)):
+        return sha, {'sha': sha}
+    text = inline_text(contents)
+    if text is not None:
+        return sha, {'content': text}
+    return sha, None
+
+
+def blob_sha(contents):
+    """The git blob sha of a string, bytes, or a binary file."""
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    if isinstance(contents, bytes):
+        h = hashlib.sha1(b'blob %d\0' % len(contents))
+        h.update(contents)
+        return h.hexdigest()
+    contents.seek(0, os.SEEK_END)
+    h = hashlib.sha1(b'blob %d\0' % contents.tell())
+    contents.seek(0)
+    for chunk in iter(lambda: contents.read(64 * 1024), b''):
+        h.update(chunk)
+    contents.seek(0)
+    return h.hexdigest()
+
+
+def inline_text(contents):
+    """Return contents as a string if it's small text, None otherwise.
+    Files are never small, they're only used for big posts."""
+    if isinstance(contents, str):
+        data = contents.encode('utf-8')
+    elif isinstance(contents, bytes):
+        data = contents
+    else:
+        return None
+    if len(data) > INLINE_SIZE or b'\0' in data:
+        return None
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+def commit_entries(repo, auth, head, entries, message, branch):
+    """Commit the tree entries on top of head and move the branch there.
+    Returns the new commit, or head if nothing changed."""
+    files, changed = changed_entries(repo, branch, head, entries)
+    if not changed and entries:
+        # nothing to do going by what we know of a cached head, but the
+        # branch may have moved since, and no refused ref update would
+        # tell us
+        known = known_files(repo, branch, head)
+        fresh = get_head(repo, auth, branch, refresh=True)
+        if fresh['sha'] == head['sha']:
+            return remember_head(repo, branch, fresh, known)
+        head = fresh
+        files, changed = changed_entries(repo, branch, head, entries)
+    if not changed:
+        return head
+    new_tree = create_tree(repo, auth, head['tree'], changed)
+    if new_tree['sha'] == head['tree']['sha']:
+        remember_commit(repo, branch, head, files)
+        return head
+    new_commit = create_commit(repo, auth, head, new_tree, message)
+    try:
+        update_branch(repo, auth, new_commit, branch)
+    except GitHubError as e:
+        forget_head(repo, branch)
+        raise stale_head(e)
+    remember_commit(repo, branch, new_commit, files)
+    return new_commit
+
+
+def changed_entries(repo, branch, head, entries):
+    """Return the files head will have once the entries are committed, and
+    the entries it doesn't have already."""
+    files = known_files(repo, branch, head)
+    changed = {path: entry for path, (sha, entry) in entries.items()
+               if files.get(path, False) != sha}
+    files.update((path, sha) for path, (sha, entry) in entries.items())
+    return files, changed
+
+
+def remember_commit(repo, branch, new_commit, files):
+    remember_head(repo, branch, new_commit, files)
+    for sha in files.values():
+        if sha is not None:
+            _known_blobs.put((repo, sha), True)
+
+
+def stale_head(e):
+    """Return the error to raise for a failed branch update: StaleHead if
+    it was refused as a non fast-forward, which is worth retrying on a
+    fresh head."""
+    if e.status_code == 422 and not isinstance(e, RateLimited):
+        return StaleHead(str(e), e.status_code)
+    return e
+
+
+def get_head(repo, auth, branch, refresh=False):
+    """Return the branch head as {'sha': commit_sha, 'tree': {'sha': ...}},
+    from the cache when it's fresh enough."""
+    cached = None if refresh else cached_head(repo, branch)
+    if cached:
+        return cached
+    return remember_head(repo, branch, get_latest_commit(repo, auth, branch))
+
+
+def cached_head(repo, branch):
+    cached = _heads.get((repo, branch))
+    if cached and time.monotonic() - cached['time'] < HEAD_CACHE_TTL:
+        return cached['head']
+    return None
+
+
+def head_from_commit(commit):
+    """Return the parts of a commit, as the API gives it, that a head is
+    made of."""
+    return {'sha': commit['sha'], 'tree': {'sha': commit['tree']['sha']}}
+
+
+def remember_head(repo, branch, commit, files=None):
+    """Cache commit as the branch head, and return it as a head.  files
+    are {path: blob sha} of files known to be in the head, None for ones
+    known not to be."""
+    head = head_from_commit(commit)
+    files = dict(files or {})
+    for path in list(files)[:-KNOWN_FILES_SIZE]:
+        del files[path]
+    _heads[(repo, branch)] = {
+        'head': head,
+        'files': files,
+        'time': time.monotonic()
+    }
+    return head
+
+
+def known_files(repo, branch, head):
+    """Return a copy of the files known to be in head."""
+    cached = _heads.get((repo, branch))
+    if cached is None or cached['head']['sha'] != head['sha']:
+        return {}
+    return dict(cached['files'])
+
+
+def forget_head(repo, branch):
+    _heads.pop((repo, branch), None)
 
 
 def get_latest_commit(repo, auth, branch):
-    body = get(f'{GITHUB_API_ROOT}/repos/{repo}/git/ref/heads/{branch}', auth)
+    body = get(git_url(repo, f'ref/heads/{branch}'), auth)
     sha = body['object']['sha']
     return get_commit(repo, auth, sha)
 
 
 def get_commit(repo, auth, sha):
-    return get(f'{GITHUB_API_ROOT}/repos/{repo}/git/commits/{sha}', auth)
+    return get(git_url(repo, f'commits/{sha}'), auth)
 
 
-def get_tree(repo, auth, commit):
+def get_tree(repo, auth, commit, recursive=False):
     tree_sha = commit['tree']['sha']
-    return get(f'{GITHUB_API_ROOT}/repos/{repo}/git/trees/{tree_sha}', auth)
+    url = git_url(repo, f'trees/{tree_sha}')
+    if recursive:
+        url += '?recursive=1'
+    return get(url, auth)
+
+
+def list_files(repo, auth, branch):
+    """Return the paths of all the files on the branch, in one request."""
+    tree = get_tree(repo, auth, get_latest_commit(repo, auth, branch),
+                    recursive=True)
+    return tree_paths(repo, tree)
+
+
+def tree_paths(repo, tree):
+    """Return the paths of the files in a recursive tree listing."""
+    if tree.get('truncated'):
+        raise GitHubError(f'tree of {repo} is too big to list', 200)
+    return [e['path'] for e in tree['tree'] if e['type'] == 'blob']
+
+
+def read_file(repo, auth, path, branch):
+    """Return the contents of the file on the branch as bytes, or None if
+    there is no such file."""
+    try:
+        body = get(contents_url(repo, path, branch), auth)
+    except GitHubError as e:
+        if e.status_code == 404:
+            return None
+        raise
+    _known_blobs.put((repo, body['sha']), True)
+    if body.get('encoding') != 'base64':
+        # the contents API leaves out files over 1MB, the blob API doesn't
+        body = get(git_url(repo, f'blobs/{body["sha"]}'), auth)
+    return base64.b64decode(body['content'])
+
+
+def git_url(repo, path):
+    return f'{GITHUB_API_ROOT}/repos/{repo}/git/{path}'
+
+
+def contents_url(repo, path, branch):
+    return f'{GITHUB_API_ROOT}/repos/{repo}/contents/{quote(path)}' + \
+        f'?ref={quote(branch)}'
 
 
 def create_blob(repo, auth, content):
-    post_data = {'content': content, 'encoding': 'utf-8'}
-    return post(f'{GITHUB_API_ROOT}/repos/{repo}/git/blobs', auth, post_data)
+    """content is a string, bytes, or a binary file, which is streamed up
+    rather than read into memory."""
+    url = git_url(repo, 'blobs')
+    post_data = blob_data(content)
+    if post_data is None:
+        return post_stream(url, auth, Base64Body(content))
+    return post(url, auth, post_data)
+
+
+def blob_data(content):
+    """Return the blob API request for a string or bytes, or None for a
+    file, which is sent as a Base64Body."""
+    if isinstance(content, str):
+        return {'content': content, 'encoding': 'utf-8'}
+    elif isinstance(content, bytes):
+        return {'content': base64.b64encode(content).decode('ascii'),
+                'encoding': 'base64'}
+    return None
+
+
+class Base64Body:
+    """A file-like blob API request body, base64 encoding a binary file
+    as it's read."""
+    prefix = b'{"encoding": "base64", "content": "'
+    suffix = b'"}'
+    # multiple of 3, so chunks encode without padding
+    chunk_size = 3 * 16 * 1024
+
+    def __init__(self, f):
+        self.f = f
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(0)
+        self.length = len(self.prefix) + 4 * ((size + 2) // 3) + \
+            len(self.suffix)
+        self.pending = self.prefix
+        self.done = False
 
+    def __len__(self):
+        return self.length
 
-def create_tree(repo, auth, old_tree, blobs):
+    def rewind(self):
+        """Start over, for sending the request again."""
+        self.f.seek(0)
+        self.pending = self.prefix
+        self.done = False
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.length
+        while len(self.pending) < n and not self.done:
+            chunk = self.f.read(self.chunk_size)
+            if chunk:
+                self.pending += base64.b64encode(chunk)
+            else:
+                self.pending += self.suffix
+                self.done = True
+        data, self.pending = self.pending[:n], self.pending[n:]
+        return data
+
+
+def create_tree(repo, auth, old_tree, entries):
+    return post(git_url(repo, 'trees'), auth, tree_data(old_tree, entries))
+
+
+def tree_data(old_tree, entries):
+    """entries are {path: {'sha': blob_sha}} or {path: {'content': text}};
+    a null sha deletes the file."""
     post_data = {
         'base_tree': old_tree['sha'],
         'tree': []
     }
-    for path in blobs.keys():
+    for path, entry in entries.items():
         tree = {}
         tree['path'] = path
         tree['type'] = 'blob'
         tree['mode'] = '100644'
-        tree['sha'] = blobs[path]['sha']
+        tree.update(entry)
         post_data['tree'].append(tree)
-
-    return post(f'{GITHUB_API_ROOT}/repos/{repo}/git/trees', auth, post_data)
+    return post_data
 
 
 def create_commit(repo, auth, old_commit, new_tree, message):
-    post_data = {
+    return post(git_url(repo, 'commits'), auth,
+                commit_data(old_commit, new_tree, message))
+
+
+def commit_data(old_commit, new_tree, message):
+    return {
         'message': message,
         'tree': new_tree['sha'],
         'parents': [old_commit['sha']]
     }
-    return post(f'{GITHUB_API_ROOT}/repos/{repo}/git/commits', auth, post_data)
 
 
 def update_branch(repo, auth, new_commit, branch):
-    branch_ref = f'refs/heads/{branch}'
-    patch_data = {
-        'sha': new_commit['sha']
-    }
-    return patch(f'{GITHUB_API_ROOT}/repos/{repo}/git/{branch_ref}',
-                 auth, patch_data)
+    return patch(git_url(repo, f'refs/heads/{branch}'), auth,
+                 {'sha': new_commit['sha']})
+
+
+def get_session():
+    """Return this process' shared session, creating it on first use (and
+    again after a fork, so workers never share sockets with their parent).
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = make_session(POOL_SIZE)
+                _session_pid = pid
+    return _session
+
+
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Accept': 'application/vnd.github.v3+json',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive'
+    })
+    return session
 
 
 def get(url, auth):
-    r = requests.get(url, auth=auth)
-    if r.status_code != 200:
-        raise Exception(f'GET {url} failed with {r.status_code}, {r.json()}')
-    else:
-        return r.json()
+    return request('GET', url, 200, auth=auth)
 
 
 def post(url, auth, data):
-    r = requests.post(url, auth=auth, json=data)
-    if r.status_code != 201:
-        raise Exception(f'POST {url} failed with {r.status_code}, {r.json()}')
-    else:
-        return r.json()
+    return request('POST', url, 201, auth=auth, json=data)
+
+
+def post_stream(url, auth, body):
+    headers = {'Content-Type': 'application/json'}
+    return request('POST', url, 201, auth=auth, data=body, headers=headers)
 
 
 def patch(url, auth, data):
-    r = requests.patch(url, auth=auth, json=data)
-    if r.status_code != 200:
-        raise Exception(f'PATCH {url} failed with {r.status_code}, {r.json()}')
-    else:
-        return r.json()
\ No newline at end of file
+    return request('PATCH', url, 200, auth=auth, json=data)
+
+
+def request(method, url, expected_status, **kwargs):
+    """Make an API call, within the rate limit, timing it and counting
+    failures by the kind of call, and return the response body.  Raises
+    GitHubError unless the status is the expected one, RateLimited if the
+    rate limit got in the way."""
+    call = call_type(method, url)
+    limiter = get_rate_limiter()
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        wait = claim_slot(limiter, method, url, call)
+        if wait > 0:
+            time.sleep(wait)
+        if attempt > 0 and hasattr(kwargs.get('data'), 'rewind'):
+            kwargs['data'].rewind()
+
+        start = time.perf_counter()
+        try:
+            r = get_session().request(method, url, timeout=TIMEOUT, **kwargs)
+        except requests.RequestException:
+            metrics.inc('micropub_github_failures_total', call=call,
+                        status='error')
+            raise
+        finally:
+            metrics.observe('micropub_github_request_seconds',
+                            time.perf_counter() - start, call=call)
+        if check_response(limiter, method, url, call, r, expected_status,
+                          last=attempt == RATE_LIMIT_RETRIES):
+            return r.json()
+
+
+def claim_slot(limiter, method, url, call):
+    """Return how long to wait before making the call, or raise RateLimited
+    if that's too long."""
+    wait = limiter.reserve_slot(RATE_LIMIT_MAX_WAIT)
+    if wait > RATE_LIMIT_MAX_WAIT:
+        metrics.inc('micropub_github_failures_total', call=call,
+                    status='deferred')
+        raise RateLimited(f'{method} {url} deferred for {wait:.0f}s by '
+                          'the rate limit', 429, wait)
+    return wait
+
+
+def check_response(limiter, method, url, call, r, expected_status, last):
+    """Return True if the call worked, False if it was refused for the rate
+    limit and can be made again, and raise otherwise."""
+    if r.status_code == expected_status:
+        limiter.update(r.status_code, r.headers)
+        return True
+
+    metrics.inc('micropub_github_failures_total', call=call,
+                status=str(r.status_code))
+    body = error_body(r)
+    message = f'{method} {url} failed with {r.status_code}, {body}'
+    if not limiter.update(r.status_code, r.headers,
+                          str(body.get('message', ''))):
+        raise GitHubError(message, r.status_code)
+    if last:
+        raise RateLimited(message, r.status_code, limiter.delay())
+    return False
+
+
+def error_body(r):
+    try:
+        body = r.json()
+    except ValueError:
+        return {'message': r.text}
+    return body if isinstance(body, dict) else {'message': str(body)}
+
+
+def get_rate_limiter():
+    """Return this process' rate limiter, shared by its threads."""
+    global _rate_limiter, _rate_limiter_pid
+    pid = os.getpid()
+    if _rate_limiter is None or _rate_limiter_pid != pid:
+        with _session_lock:
+            if _rate_limiter is None or _rate_limiter_pid != pid:
+                _rate_limiter = RateLimiter(RATE_LIMIT_RESERVE)
+                _rate_limiter_pid = pid
+    return _rate_limiter
+
+
+def call_type(method, url):
+    """ref, update, commit, tree, blob or contents, for the metrics."""
+    path = url[len(GITHUB_API_ROOT):]
+    for part, call in (('/git/ref', 'ref'), ('/git/commits', 'commit'),
+                       ('/git/trees', 'tree'), ('/git/blobs', 'blob'),
+                       ('/contents/', 'contents')):
+        if part in path:
+            if call == 'ref' and method == 'PATCH':
+                return 'update'
+            return call
+    return 'other'
@@ -0,0 +1,357 @@
+"""
+A durable, on-disk queue of pending commits.
+
+Each queued commit is a small JSON journal entry in the queue directory.
+A background thread in every worker process drains the directory, so
+entries written by one uWSGI process can be committed by any other, and
+entries left behind by a crash are picked up on the next start.  An entry
+is only removed once its commit has gone through.
+
+An entry whose commit fails is held back, along with any later entry
+touching the same files, while the rest of the queue carries on.  It is
+tried again after retry_delay, and after max_attempts failures, or straight
+away if the error says trying again won't help (it has a true `permanent`
+attribute), it is moved to the failed/ subdirectory and logged.  Moving it
+back into the queue directory queues it again.
+
+Entries arriving close together can be batched: the worker waits up to
+batch_window seconds after the oldest pending entry, or until batch_size
+entries are pending, and commits them all in one go.  If that commit
+fails, they're committed again one at a time, so a bad entry only holds
+back itself.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class CommitQueue:
+    def __init__(self, directory, commit_fn, poll_interval=1.0,
+                 retry_delay=30.0, batch_window=0.0, batch_size=1,
+                 max_attempts=10):
+        """commit_fn is called as commit_fn(files, message) for every entry,
+        and should raise if the commit did not go through.
+        """
+        self.directory = directory
+        self.commit_fn = commit_fn
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.batch_window = batch_window
+        self.batch_size = max(1, batch_size)
+        self.max_attempts = max(1, max_attempts)
+        self.wakeup = threading.Event()
+        self.worker = None
+        self.worker_pid = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, files, message, permalink=None):
+        """Journal a commit and wake up the worker.  Returns once the entry
+        is safely on disk.
+
+        String contents, and None for deletions, go in the entry itself;
+        bytes and binary files are copied to blob files next to it, and
+        handed to the commit function as open binary files.
+        """
+        name = f'{int(time.time() * 1e6):020d}-{uuid.uuid4().hex}.json'
+        journaled = {}
+        for i, (path, contents) in enumerate(files.items()):
+            if contents is None or isinstance(contents, str):
+                journaled[path] = contents
+            else:
+                journaled[path] = {'blob': self.write_blob(name, i, contents)}
+        entry = {'files': journaled, 'message': message,
+                 'permalink': permalink, 'created': time.time()}
+        tmp_path = os.path.join(self.directory, '.' + name)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, os.path.join(self.directory, name))
+        self.start()
+        self.wakeup.set()
+        return name
+
+    def write_blob(self, name, i, contents):
+        blob_name = f'{name}.{i}.blob'
+        with open(os.path.join(self.directory, blob_name), 'wb') as f:
+            if isinstance(contents, bytes):
+                f.write(contents)
+            else:
+                contents.seek(0)
+                shutil.copyfileobj(contents, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return blob_name
+
+    def find(self, path):
+        """Return what the newest pending entry has for path: a string,
+        bytes, or None if it deletes the file.  Raises KeyError if no
+        pending entry has it."""
+        for name in reversed(self.pending()):
+            try:
+                with open(os.path.join(self.directory, name),
+                          encoding='utf-8') as f:
+                    files = json.load(f)['files']
+                if path not in files:
+                    continue
+                contents = files[path]
+                if isinstance(contents, dict):
+                    with open(os.path.join(self.directory, contents['blob']),
+                              'rb') as f:
+                        contents = f.read()
+                return contents
+            except FileNotFoundError:
+                # committed meanwhile, and so is everything older
+                break
+        raise KeyError(path)
+
+    def pending(self):
+        return sorted(n for n in os.listdir(self.directory)
+                      if n.endswith('.json') and not n.startswith('.'))
+
+    def depth(self):
+        return len(self.pending())
+
+    def start(self):
+        """Start the worker thread for this process, if not running yet."""
+        pid = os.getpid()
+        with self.lock:
+            if self.worker_pid == pid and self.worker.is_alive():
+                return
+            self.worker = threading.Thread(target=self.run, daemon=True,
+                                           name='commit-queue')
+            self.worker_pid = pid
+            self.worker.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            try:
+                self.wait_for_batch()
+                self.drain()
+            except Exception as e:
+                # the commit function can say when it's worth trying again
+                delay = getattr(e, 'retry_after', None) or self.retry_delay
+                logger.exception('commit failed, retrying in %ss', delay)
+                time.sleep(delay)
+
+    def wait_for_batch(self):
+        """Hold off until the batch is full or the window has passed."""
+        deadline = None
+        while True:
+            pending = self.pending()
+            if not pending or len(pending) >= self.batch_size:
+                return
+            if deadline is None:
+                deadline = entry_time(pending[0]) + self.batch_window
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            self.wakeup.wait(min(remaining, self.poll_interval))
+            self.wakeup.clear()
+
+    def drain(self):
+        """Commit every pending entry this process can claim, oldest first,
+        batch_size entries per commit.  Returns the number of entries
+        committed, or raises the last error if any were held back."""
+        count = 0
+        held = {}
+        error = None
+        while True:
+            batch = self.claim_batch(held)
+            if not batch:
+                break
+            try:
+                committed, failures = self.commit_batch(batch)
+                for f, data in committed:
+                    for blob in data['blobs']:
+                        os.unlink(blob.name)
+                    os.unlink(f.name)
+                    remove(attempts_path(f.name))
+                for (f, data), e in failures:
+                    held[f.name] = set(data['files'])
+                    self.record_failure(f, data, e)
+                    error = e
+            finally:
+                for entry in batch:
+                    close_entry(entry)
+            count += len(committed)
+        if error is not None:
+            raise error
+        return count
+
+    def claim_batch(self, held):
+        """Claim up to batch_size entries, leaving out the ones held back
+        or claimed by another process, and any touching the same files."""
+        batch = []
+        held_paths = set().union(*held.values())
+        for name in self.pending():
+            if os.path.join(self.directory, name) in held:
+                continue
+            entry = self.claim(name)
+            if entry is None:
+                # being committed by another process, so nothing after it
+                # may overtake it
+                held_paths.update(self.entry_paths(name))
+                continue
+            if held_paths.intersection(entry[1]['files']):
+                close_entry(entry)
+                continue
+            batch.append(entry)
+            if len(batch) == self.batch_size:
+                break
+        return batch
+
+    def commit_batch(self, batch):
+        """Commit the claimed entries.  Returns the ones committed, and the
+        ones that weren't with their errors.  If committing them together
+        fails, they're committed one at a time, so only the bad ones are
+        held back."""
+        if len(batch) == 1:
+            return self.commit_each(batch)
+        entries = [data for f, data in batch]
+        files = {}
+        for entry in entries:
+            files.update(entry['files'])
+        try:
+            self.commit_fn(files, batch_message(entries))
+        except Exception as e:
+            if getattr(e, 'retry_after', None):
+                return [], [(entry, e) for entry in batch]
+            logger.warning('commit of %d entries failed, committing them '
+                           'one at a time: %s', len(batch), e)
+            return self.commit_each(batch)
+        return batch, []
+
+    def commit_each(self, batch):
+        committed, failures = [], []
+        held_paths = set()
+        for i, (f, data) in enumerate(batch):
+            if failures and getattr(failures[-1][1], 'retry_after', None):
+                # the rest would only be deferred too
+                failures.extend((entry, failures[-1][1])
+                                for entry in batch[i:])
+                break
+            if held_paths.intersection(data['files']):
+                # left for after the entry it follows up on
+                continue
+            for blob in data['blobs']:
+                blob.seek(0)
+            try:
+                self.commit_fn(data['files'], data['message'])
+            except Exception as e:
+                failures.append(((f, data), e))
+                held_paths.update(data['files'])
+            else:
+                committed.append((f, data))
+        return committed, failures
+
+    def record_failure(self, f, data, e):
+        """Count a failed attempt at an entry, and move it to failed/ if
+        it's used up its attempts.  Being deferred doesn't count."""
+        if getattr(e, 'retry_after', None):
+            return
+        attempts = read_attempts(f.name) + 1
+        if attempts < self.max_attempts and \
+                not getattr(e, 'permanent', False):
+            write_file(attempts_path(f.name), str(attempts))
+            return
+        failed = os.path.join(self.directory, 'failed')
+        os.makedirs(failed, exist_ok=True)
+        for blob in data['blobs']:
+            os.rename(blob.name,
+                      os.path.join(failed, os.path.basename(blob.name)))
+        name = os.path.basename(f.name)
+        write_file(os.path.join(failed, name + '.error'),
+                   f'{e.__class__.__name__}: {e}\n')
+        os.rename(f.name, os.path.join(failed, name))
+        remove(attempts_path(f.name))
+        logger.error('giving up on %s (%s) after %d attempts: %s', name,
+                     data.get('permalink') or data['message'], attempts, e)
+
+    def entry_paths(self, name):
+        """Return the paths an entry commits, or nothing if it's gone."""
+        try:
+            with open(os.path.join(self.directory, name),
+                      encoding='utf-8') as f:
+                return list(json.load(f)['files'])
+        except FileNotFoundError:
+            return []
+
+    def claim(self, name):
+        """Lock an entry for this process.  Returns the open, locked file
+        and its contents, or None if another process got there first."""
+        try:
+            f = open(os.path.join(self.directory, name), encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        # the previous holder may have committed and removed it already
+        if os.fstat(f.fileno()).st_nlink == 0:
+            f.close()
+            return None
+        data = json.load(f)
+        data['blobs'] = []
+        for path, contents in data['files'].items():
+            if isinstance(contents, dict):
+                blob = open(os.path.join(self.directory, contents['blob']),
+                            'rb')
+                data['blobs'].append(blob)
+                data['files'][path] = blob
+        return f, data
+
+
+def close_entry(entry):
+    f, data = entry
+    for blob in data['blobs']:
+        blob.close()
+    f.close()
+
+
+def attempts_path(path):
+    return path + '.attempts'
+
+
+def read_attempts(path):
+    try:
+        with open(attempts_path(path)) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def write_file(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def entry_time(name):
+    """Entry names start with their creation time, in microseconds."""
+    return int(name.split('-')[0]) / 1e6
+
+
+def batch_message(entries):
+    lines = [f'batch of {len(entries)} posts', '']
+    for entry in entries:
+        lines.append(f"{entry['message']}: {entry.get('permalink') or ''}")
+    return '\n'.join(lines)
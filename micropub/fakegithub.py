@@ -0,0 +1,291 @@
+"""
+An in-process stand-in for the parts of the GitHub Git Data API that
+micropub.commit talks to.  Used by the tests and the benchmarks, never
+in production.
+
+    server = FakeGitHub()
+    server.start()
+    ... point micropub.commit.GITHUB_API_ROOT at server.url ...
+    server.stop()
+"""
+import base64
+import gzip
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def git_sha(kind, data):
+    header = f'{kind} {len(data)}\0'.encode('utf-8')
+    return hashlib.sha1(header + data).hexdigest()
+
+
+class FakeRepo:
+    """Objects and refs of one repository.  Trees are kept flat, as a dict
+    of full paths to blob shas."""
+
+    def __init__(self, branch='main'):
+        self.blobs = {}
+        self.trees = {}
+        self.commits = {}
+        self.refs = {}
+        tree = self.add_tree({})
+        self.refs[branch] = self.add_commit('initial commit', tree, [])
+
+    def add_blob(self, data):
+        sha = git_sha('blob', data)
+        self.blobs[sha] = data
+        return sha
+
+    def add_tree(self, entries):
+        sha = git_sha('tree', json.dumps(entries, sort_keys=True).encode())
+        self.trees[sha] = dict(entries)
+        return sha
+
+    def add_commit(self, message, tree, parents):
+        body = json.dumps([message, tree, parents, time.time()]).encode()
+        sha = git_sha('commit', body)
+        self.commits[sha] = {'message': message, 'tree': tree,
+                             'parents': parents}
+        return sha
+
+    def is_ancestor(self, old, new):
+        pending = [new]
+        while pending:
+            sha = pending.pop()
+            if sha == old:
+                return True
+            pending.extend(self.commits[sha]['parents'])
+        return False
+
+    def files(self, branch='main'):
+        """Return the contents of the branch head as a dict of paths to
+        bytes."""
+        tree = self.trees[self.commits[self.refs[branch]]['tree']]
+        return {path: self.blobs[sha] for path, sha in tree.items()}
+
+
+class FakeGitHub:
+    def __init__(self, latency=0.0, branch='main'):
+        self.latency = latency
+        self.branch = branch
+        self.repos = {}
+        self.calls = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.httpd = None
+        # rate limit headers, sent when rate_remaining is set; it goes down
+        # by one per call
+        self.rate_remaining = None
+        self.rate_reset = None
+        self.refusals = []
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.httpd.server_address[:2]
+
+    def repo(self, name):
+        with self.lock:
+            if name not in self.repos:
+                self.repos[name] = FakeRepo(self.branch)
+            return self.repos[name]
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(self))
+        self.httpd.daemon_threads = True
+        thread = threading.Thread(target=self.httpd.serve_forever,
+                                  daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = []
+
+    def refuse(self, count, status=429, headers=None,
+               message='You have exceeded a secondary rate limit'):
+        """Refuse the next count calls, as rate limited."""
+        with self.lock:
+            self.refusals.extend([(status, {'message': message},
+                                   dict(headers or {}))] * count)
+
+    def rate_headers(self):
+        if self.rate_remaining is None:
+            return {}
+        self.rate_remaining = max(0, self.rate_remaining - 1)
+        return {'X-RateLimit-Remaining': str(self.rate_remaining),
+                'X-RateLimit-Reset': str(int(self.rate_reset or 0))}
+
+    def handle(self, method, path, query, body):
+        """Return the status, json body and extra headers for one API
+        call."""
+        with self.lock:
+            self.calls.append((method, path))
+            headers = self.rate_headers()
+            if self.refusals:
+                status, result, refusal_headers = self.refusals.pop(0)
+                headers.update(refusal_headers)
+                return status, result, headers
+        if self.latency:
+            time.sleep(self.latency)
+        parts = path.strip('/').split('/')
+        if len(parts) < 4 or parts[0] != 'repos':
+            return 404, {'message': 'Not Found'}, headers
+        repo = self.repo(parts[1] + '/' + parts[2])
+        with self.lock:
+            status, result = self.route(repo, method, parts[3:], query, body)
+        return status, result, headers
+
+    def route(self, repo, method, parts, query, body):
+        if parts[0] == 'contents' and method == 'GET':
+            return self.get_contents(repo, '/'.join(parts[1:]), query)
+        if parts[0] != 'git':
+            return 404, {'message': 'Not Found'}
+        kind, rest = parts[1], parts[2:]
+        if kind == 'ref' and method == 'GET':
+            return self.get_ref(repo, '/'.join(rest))
+        if kind == 'refs' and method == 'PATCH':
+            return self.update_ref(repo, '/'.join(rest), body)
+        if kind == 'commits' and method == 'GET':
+            return self.get_commit(repo, rest[0])
+        if kind == 'commits' and method == 'POST':
+            return self.create_commit(repo, body)
+        if kind == 'trees' and method == 'GET':
+            return self.get_tree(repo, rest[0])
+        if kind == 'trees' and method == 'POST':
+            return self.create_tree(repo, body)
+        if kind == 'blobs' and method == 'GET':
+            return self.get_blob(repo, rest[0])
+        if kind == 'blobs' and method == 'POST':
+            return self.create_blob(repo, body)
+        return 404, {'message': 'Not Found'}
+
+    def get_ref(self, repo, ref):
+        branch = ref[len('heads/'):]
+        if branch not in repo.refs:
+            return 404, {'message': 'Not Found'}
+        sha = repo.refs[branch]
+        return 200, {'ref': f'refs/{ref}',
+                     'object': {'sha': sha, 'type': 'commit'}}
+
+    def update_ref(self, repo, ref, body):
+        branch = ref[len('heads/'):]
+        new = body['sha']
+        if new not in repo.commits:
+            return 422, {'message': 'Object does not exist'}
+        old = repo.refs.get(branch)
+        if old and not body.get('force') and not repo.is_ancestor(old, new):
+            return 422, {'message': 'Update is not a fast forward'}
+        repo.refs[branch] = new
+        return 200, {'ref': f'refs/{ref}',
+                     'object': {'sha': new, 'type': 'commit'}}
+
+    def get_commit(self, repo, sha):
+        if sha not in repo.commits:
+            return 404, {'message': 'Not Found'}
+        commit = repo.commits[sha]
+        return 200, {'sha': sha, 'message': commit['message'],
+                     'tree': {'sha': commit['tree']},
+                     'parents': [{'sha': p} for p in commit['parents']]}
+
+    def create_commit(self, repo, body):
+        if body['tree'] not in repo.trees:
+            return 422, {'message': 'Tree does not exist'}
+        sha = repo.add_commit(body['message'], body['tree'], body['parents'])
+        return 201, {'sha': sha, 'tree': {'sha': body['tree']}}
+
+    # trees are flat, so always listed as if recursive
+    def get_tree(self, repo, sha):
+        if sha not in repo.trees:
+            return 404, {'message': 'Not Found'}
+        entries = [{'path': path, 'mode': '100644', 'type': 'blob',
+                    'sha': blob, 'size': len(repo.blobs[blob])}
+                   for path, blob in sorted(repo.trees[sha].items())]
+        return 200, {'sha': sha, 'tree': entries, 'truncated': False}
+
+    def create_tree(self, repo, body):
+        entries = {}
+        if 'base_tree' in body:
+            if body['base_tree'] not in repo.trees:
+                return 422, {'message': 'Base tree does not exist'}
+            entries.update(repo.trees[body['base_tree']])
+        for entry in body['tree']:
+            if 'content' in entry:
+                entries[entry['path']] = \
+                    repo.add_blob(entry['content'].encode('utf-8'))
+            elif entry.get('sha') is None:
+                entries.pop(entry['path'], None)
+            elif entry['sha'] not in repo.blobs:
+                return 422, {'message': 'Blob does not exist'}
+            else:
+                entries[entry['path']] = entry['sha']
+        return 201, {'sha': repo.add_tree(entries)}
+
+    def create_blob(self, repo, body):
+        if body.get('encoding') == 'base64':
+            data = base64.b64decode(body['content'])
+        else:
+            data = body['content'].encode('utf-8')
+        return 201, {'sha': repo.add_blob(data)}
+
+    def get_blob(self, repo, sha):
+        if sha not in repo.blobs:
+            return 404, {'message': 'Not Found'}
+        data = repo.blobs[sha]
+        return 200, {'sha': sha, 'size': len(data), 'encoding': 'base64',
+                     'content': base64.b64encode(data).decode('ascii')}
+
+    def get_contents(self, repo, path, query):
+        branch = query.get('ref', [self.branch])[0]
+        files = repo.files(branch)
+        if path not in files:
+            return 404, {'message': 'Not Found'}
+        data = files[path]
+        return 200, {'path': path, 'type': 'file', 'encoding': 'base64',
+                     'sha': git_sha('blob', data),
+                     'content': base64.b64encode(data).decode('ascii')}
+
+
+def make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            with server.lock:
+                server.connections += 1
+
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            status, result, headers = server.handle(
+                self.command, url.path, parse_qs(url.query), body)
+            data = json.dumps(result).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                data = gzip.compress(data)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = respond
+        do_POST = respond
+        do_PATCH = respond
+
+    return Handler
@@ -1,107 +1,415 @@
+import datetime
+import json
+import re
+from typing import Dict, NamedTuple, Optional, Tuple
 import yaml
-from dateutil.parser import parse
-
-# default behaviour is to copy the properties as is to the front matter.
-# this will change that behaviour for certain fields
-prop_transform = {
-    'name': {
-        'prop': 'title',
-        'policy': 'first'
-    },
-    'in-reply-to': {
-        'policy': 'first'
-    },
-    'like-of': {
-        'policy': 'first'
-    },
-    'repost-of': {
-        'policy': 'first'
-    },
-    'bookmark-of': {
-        'policy': 'first'
-    },
-    'published': {
-        'prop': 'date',
-        'policy': 'first'
-    },
-    'updated': {
-        'prop': 'modified',
-        'policy': 'first'
-    },
-    'category': {
-        'prop': 'tags',
-    },
-    'summary': {
-        'policy': 'first'
+from micropub.utils import parse_datetime
+
+# libyaml is much faster, when it's there.  It wraps long escaped strings
+# differently from yaml.safe_dump though, so those still go through the
+# pure python dumper.
+try:
+    from yaml import CSafeDumper as FastSafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper as FastSafeDumper, SafeLoader
+
+# for reading toml front matter back
+try:
+    import tomllib
+except ImportError:
+    try:
+        import toml as tomllib
+    except ImportError:
+        tomllib = None
+
+# How each property of each post type goes into the front matter.  By
+# default a property is copied as is.  'prop' renames it, and the policy
+# is 'copy' (all the values, the default), 'first' (just the first one),
+# or 'body' (it's written after the front matter instead, except in
+# children, where it's kept as the first value).
+TYPE_RULES = {
+    'h-entry': {
+        'name': {'prop': 'title', 'policy': 'first'},
+        'in-reply-to': {'policy': 'first'},
+        'like-of': {'policy': 'first'},
+        'repost-of': {'policy': 'first'},
+        'bookmark-of': {'policy': 'first'},
+        'published': {'prop': 'date', 'policy': 'first'},
+        'updated': {'prop': 'modified', 'policy': 'first'},
+        'category': {'prop': 'tags'},
+        'summary': {'policy': 'first'},
+        'location': {'policy': 'first'},
+        'content': {'policy': 'body'}
     },
-    'location': {
-        'policy': 'first'
+    'h-event': {
+        'name': {'prop': 'title', 'policy': 'first'},
+        'start': {'policy': 'first'},
+        'end': {'policy': 'first'},
+        'duration': {'policy': 'first'},
+        'location': {'policy': 'first'},
+        'url': {'policy': 'first'},
+        'published': {'prop': 'date', 'policy': 'first'},
+        'updated': {'prop': 'modified', 'policy': 'first'},
+        'category': {'prop': 'tags'},
+        'summary': {'policy': 'first'},
+        'content': {'policy': 'body'}
     },
-    'content': {
-        'policy': 'skip'
+    'h-card': {
+        'name': {'prop': 'title', 'policy': 'first'},
+        'nickname': {'policy': 'first'},
+        'photo': {'policy': 'first'},
+        'email': {'policy': 'first'},
+        'published': {'prop': 'date', 'policy': 'first'},
+        'updated': {'prop': 'modified', 'policy': 'first'},
+        'category': {'prop': 'tags'},
+        'note': {'policy': 'body'}
     }
 }
 
+# for types without rules of their own
+DEFAULT_RULES = {
+    'published': {'prop': 'date', 'policy': 'first'},
+    'updated': {'prop': 'modified', 'policy': 'first'},
+    'category': {'prop': 'tags'},
+    'content': {'policy': 'body'}
+}
+
+
+class Plan(NamedTuple):
+    """A type's rules, worked out once: rules are {prop: (key, policy)},
+    sources {key: (prop, policy)} to undo them, and body the property
+    written after the front matter, if there is one."""
+    rules: Dict[str, Tuple[str, str]]
+    sources: Dict[str, Tuple[str, str]]
+    body: Optional[str]
+
+
+def compile_rules(rules):
+    compiled = {prop: (rule.get('prop', prop), rule.get('policy', 'copy'))
+                for prop, rule in rules.items()}
+    sources = {key: (prop, policy)
+               for prop, (key, policy) in compiled.items()}
+    body = next((prop for prop, (key, policy) in compiled.items()
+                 if policy == 'body'), None)
+    return Plan(compiled, sources, body)
+
+
+plans = {}
+
+
+def register_type(mf2_type, rules):
+    """Add or replace the front matter rules of a post type."""
+    plans[mf2_type] = compile_rules(rules)
+
+
+for mf2_type, rules in TYPE_RULES.items():
+    register_type(mf2_type, rules)
+default_plan = compile_rules(DEFAULT_RULES)
+
+
+def plan_for(mf2_type):
+    return plans.get(mf2_type, default_plan)
+
+
+# strings yaml.safe_dump would write as they are: starting with a letter,
+# printable ascii only, and nothing that could read as a comment, mapping
+# key, bool or null
+plain_re = re.compile(r"[A-Za-z][A-Za-z0-9 _./,;()=+&%@!?'\"~*:-]*")
+not_plain_words = {
+    'yes', 'Yes', 'YES', 'no', 'No', 'NO', 'true', 'True', 'TRUE',
+    'false', 'False', 'FALSE', 'on', 'On', 'ON', 'off', 'Off', 'OFF',
+    'null', 'Null', 'NULL'
+}
+# what tziso returns, which yaml.safe_dump single quotes
+timestamp_re = re.compile(
+    r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d[+-]\d\d:\d\d')
+
+escaped_re = re.compile(r'[^\x20-\x7e]')
+
+# yaml wraps lines with spaces beyond 80 columns, stay well clear of that
+MAX_PLAIN_LINE = 72
+
+
 def tziso(notz):
-    d = parse(notz)
+    return localiso(parse_datetime(notz))
+
+
+def localiso(d):
+    """Server local time, to the second, with its offset."""
     return d.astimezone().replace(microsecond=0).isoformat()
 
 # returns two element array
 # - the post as a string
 # - the file extension (md or html)
-def make_post(data):
-    assert len(data['type']) == 1
-    assert data['type'][0] == 'h-entry'
-    
-    frontmatter = {}
-    properties = data['properties']
-    for key in properties.keys():
-        if key in prop_transform:
-            transform = prop_transform[key]
-            dest_prop = transform.get('prop', key)
-            policy = transform.get('policy', 'copy')
-            if policy == 'skip':
-                continue
-            if policy == 'first':
-                frontmatter[dest_prop] = properties[key][0]
-            elif policy == 'copy':
-                frontmatter[dest_prop] = properties[key]
-        else:
-            frontmatter[key] = properties[key]
-    
+def make_post(post, fmt='yaml'):
+    parts, post_type = post_parts(post, fmt)
+    return [''.join(parts), post_type]
+
+
+# big posts are written out in slices, so there's never a second full copy
+# of the content in memory
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+def write_post(post, out, fmt='yaml'):
+    """Write the post, utf-8 encoded, to the binary file out.  Returns the
+    file extension."""
+    parts, post_type = post_parts(post, fmt)
+    for part in parts:
+        for start in range(0, len(part), WRITE_CHUNK_SIZE):
+            out.write(part[start:start + WRITE_CHUNK_SIZE].encode('utf-8'))
+    return post_type
+
+
+def post_size(post):
+    """Roughly how big the post will be, in characters."""
+    content = post.content
+    if type(content) is dict:
+        content = content.get('html', '')
+    return len(content) if type(content) is str else 0
+
+
+def content_ext(post):
+    """The file extension of the post: html for html content, md
+    otherwise, whatever the format."""
+    content = post.content
+    return 'html' if type(content) is dict and 'html' in content else 'md'
+
+
+# returns the pieces of the post, to be joined or written out, and the file
+# extension
+def post_parts(post, fmt='yaml'):
+    return FORMATS[fmt](post), content_ext(post)
+
+
+def yaml_parts(post):
+    frontmatter, post_content = post_frontmatter(post)
+    parts = ['---\n']
+    dump_frontmatter(frontmatter, parts)
+    parts.append('---\n')
+    add_body(parts, post_content)
+    return parts
+
+
+def toml_parts(post):
+    frontmatter, post_content = post_frontmatter(post)
+    parts = ['+++\n']
+    dump_toml(frontmatter, parts)
+    parts.append('+++\n')
+    add_body(parts, post_content)
+    return parts
+
+
+def json_parts(post):
+    """The mf2 object as it is, like the request."""
+    return [json.dumps(post.to_mf2(), ensure_ascii=False, indent=2), '\n']
+
+
+def add_body(parts, post_content):
+    if post_content:
+        parts.append('\n')
+        parts.append(post_content)
+
+
+# the output formats, selected by repo path with MICROPUB_POST_FORMATS
+FORMATS = {'yaml': yaml_parts, 'toml': toml_parts, 'json': json_parts}
+
+
+def post_frontmatter(post):
+    """Return the post's front matter, and its body (None if it hasn't
+    got one)."""
+    mf2_type = post.type[0] if post.type else 'h-entry'
+    plan = plan_for(mf2_type)
+    frontmatter = transform(mf2_type, post.properties, plan, nested=False)
+    if post.children:
+        frontmatter['children'] = [
+            transform(child['type'][0], child['properties'],
+                      plan_for(child['type'][0]), nested=True)
+            for child in post.children]
     if not frontmatter:
-        raise 'at least one data property needed in a post'
-    
+        raise ValueError('at least one data property needed in a post')
+
     if 'date' in frontmatter:
-        frontmatter['date'] = tziso(frontmatter['date'])
+        frontmatter['date'] = localiso(post.published)
 
     if 'modified' in frontmatter:
         frontmatter['modified'] = tziso(frontmatter['modified'])
 
+    body = post.content if plan.body == 'content' else \
+        first(post.properties.get(plan.body))
+    if type(body) is dict:
+        body = body.get('html')
+    return frontmatter, body if type(body) is str else None
+
+
+def transform(mf2_type, properties, plan, nested):
+    frontmatter = {}
+    # h-entry is what a post is unless it says otherwise
+    if nested or mf2_type != 'h-entry':
+        frontmatter['type'] = mf2_type
+    for key, values in properties.items():
+        dest_prop, policy = plan.rules.get(key, (key, 'copy'))
+        if policy == 'body' and not nested:
+            continue
+        if policy in ('first', 'body'):
+            frontmatter[dest_prop] = values[0]
+        else:
+            frontmatter[dest_prop] = values
+
     if 'tags' in frontmatter:
         pruned_tags = [t for t in frontmatter['tags'] if t]
         if pruned_tags:
             frontmatter['tags'] = pruned_tags
         else:
             del frontmatter['tags']
+    return frontmatter
 
 
-    post_content = None
-    post_type = 'md'
-    if 'content' in properties and \
-            properties['content'] and \
-            isinstance(properties['content'], list):
-        content = properties['content'][0]
-        if type(content) is dict and 'html' in content:
-            post_content = content['html']
-            post_type = 'html'
-        elif type(content) is str:
-            post_content = content
-    
-    frontmatter_str = yaml.safe_dump(frontmatter)
-    
-    post = f'---\n{frontmatter_str}---\n'
-    if post_content:
-        post = f'{post}\n{post_content}'
-   
-    return [post, post_type]
+def first(values):
+    return values[0] if values and isinstance(values, list) else None
+
+
+def dump_frontmatter(frontmatter, parts):
+    """Append the lines of yaml.safe_dump(frontmatter) to parts.
+
+    The flat strings and lists of strings we usually have are written
+    directly, anything else is left to yaml, one key at a time.
+    """
+    for key, value in sorted(frontmatter.items()):
+        if is_plain(key):
+            if type(value) is str:
+                scalar = dump_scalar(value)
+                if scalar is not None and \
+                        len(key) + len(scalar) + 2 <= MAX_PLAIN_LINE:
+                    parts.append(f'{key}: {scalar}\n')
+                    continue
+            elif type(value) is list and value and \
+                    all(type(v) is str for v in value):
+                scalars = [dump_scalar(v) for v in value]
+                if all(s is not None and len(s) + 2 <= MAX_PLAIN_LINE
+                       for s in scalars):
+                    parts.append(f'{key}:\n')
+                    for scalar in scalars:
+                        parts.append(f'- {scalar}\n')
+                    continue
+        parts.append(yaml.dump({key: value}, Dumper=pick_dumper(value)))
+
+
+def pick_dumper(value):
+    values = value if type(value) is list else [value]
+    for v in values:
+        if type(v) is not str or escaped_re.search(v):
+            return yaml.SafeDumper
+    return FastSafeDumper
+
+
+def dump_scalar(value):
+    """Return value as yaml.safe_dump would write it, or None if it's not
+    one of the simple cases."""
+    if is_plain(value):
+        return value
+    if timestamp_re.fullmatch(value):
+        return f"'{value}'"
+    return None
+
+
+def is_plain(value):
+    return plain_re.fullmatch(value) is not None and \
+        value[-1] != ' ' and ': ' not in value and value[-1] != ':' and \
+        value not in not_plain_words
+
+
+def dump_toml(frontmatter, parts):
+    """Append the front matter as toml lines to parts.  toml has no null,
+    so None values are left out."""
+    for key, value in sorted(frontmatter.items()):
+        if value is not None:
+            parts.append(f'{toml_key(key)} = {toml_value(value)}\n')
+
+
+def toml_key(key):
+    return key if bare_key_re.fullmatch(key) else toml_string(key)
+
+
+def toml_value(value):
+    if type(value) is bool:
+        return 'true' if value else 'false'
+    if type(value) in (int, float):
+        return repr(value)
+    if type(value) is list:
+        return '[' + ', '.join(toml_value(v) for v in value
+                               if v is not None) + ']'
+    if type(value) is dict:
+        return '{ ' + ', '.join(f'{toml_key(k)} = {toml_value(v)}'
+                                for k, v in value.items()
+                                if v is not None) + ' }'
+    return toml_string(str(value))
+
+
+def toml_string(value):
+    # json's escapes are all valid in toml basic strings, but for delete
+    return json.dumps(value, ensure_ascii=False).replace('\x7f', '\\u007f')
+
+
+bare_key_re = re.compile(r'[A-Za-z0-9_-]+')
+
+
+def parse_post(data, ext):
+    """Turn a post file made by make_post back into a micropub create
+    request, for updating it."""
+    text = data.decode('utf-8')
+    if text.startswith('{'):
+        return json.loads(text)
+    if text.startswith('---\n'):
+        frontmatter, post_content = split_post(text, '---')
+        frontmatter = yaml.load(frontmatter, Loader=SafeLoader) or {}
+    elif text.startswith('+++\n'):
+        if tomllib is None:
+            raise ValueError('reading toml needs python 3.11 or toml')
+        frontmatter, post_content = split_post(text, '+++')
+        frontmatter = tomllib.loads(frontmatter)
+    else:
+        raise ValueError('post has no front matter')
+
+    mf2 = untransform(frontmatter)
+    plan = plan_for(mf2['type'][0])
+    if post_content and plan.body:
+        if ext == 'html':
+            mf2['properties'][plan.body] = [{'html': post_content}]
+        else:
+            mf2['properties'][plan.body] = [post_content]
+    return mf2
+
+
+def split_post(text, fence):
+    end = text.find(f'\n{fence}\n', 3)
+    if end == -1:
+        raise ValueError('post front matter is not closed')
+    post_content = text[end + 5:]
+    if post_content.startswith('\n'):
+        post_content = post_content[1:]
+    return text[4:end + 1], post_content
+
+
+def untransform(frontmatter):
+    """Undo transform, returning an mf2 object."""
+    mf2_type = frontmatter.pop('type', 'h-entry')
+    if not isinstance(mf2_type, str):
+        # a property of that name
+        frontmatter['type'] = mf2_type
+        mf2_type = 'h-entry'
+    children = frontmatter.pop('children', None)
+    plan = plan_for(mf2_type)
+
+    properties = {}
+    for key, value in frontmatter.items():
+        prop, policy = plan.sources.get(key, (key, 'copy'))
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        if policy != 'copy' or not isinstance(value, list):
+            value = [value]
+        properties[prop] = value
+    mf2 = {'type': [mf2_type], 'properties': properties}
+    if children:
+        mf2['children'] = [untransform(dict(child)) for child in children]
+    return mf2
@@ -0,0 +1,105 @@
+"""
+Remembers the create requests we've already handled, so a client retrying
+one, because the first try was slow to answer, gets the original Location
+back instead of a second copy of the post.
+
+A request is known by its Idempotency-Key header if it has one, and
+otherwise by a hash of the request as the client sent it, before any
+defaults (like the published date) are filled in.  Keys are kept in a
+small sqlite database shared by the worker processes, for ttl seconds, and
+at most max_entries of them.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS requests (
+    key TEXT PRIMARY KEY,
+    location TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS requests_created ON requests (created);
+'''
+
+# how many claims between sweeps of the expired keys
+SWEEP_EVERY = 100
+
+KEY_ENCODER = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+
+class IdempotencyStore:
+    def __init__(self, path, ttl=3600, max_entries=10000, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.local = threading.local()
+        self.claims = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use (and
+        again after a fork)."""
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+            self.local.pid = pid
+        return self.local.conn
+
+    def claim(self, key, location):
+        """Record that the request known by key is being handled, and will
+        be found at location.  Returns None if it's new, or the location it
+        was given the first time if it isn't."""
+        now = self.clock()
+        self.claims += 1
+        with self.connection() as conn:
+            if self.claims % SWEEP_EVERY == 0:
+                self.sweep(conn, now)
+            conn.execute('DELETE FROM requests WHERE key = ? AND created <= ?',
+                         (key, now - self.ttl))
+            inserted = conn.execute(
+                'INSERT OR IGNORE INTO requests (key, location, created) '
+                'VALUES (?, ?, ?)', (key, location, now)).rowcount
+            if inserted:
+                return None
+            return conn.execute('SELECT location FROM requests WHERE key = ?',
+                                (key,)).fetchone()[0]
+
+    def release(self, key):
+        """Forget a claim, when handling the request failed, so the client
+        can try again."""
+        with self.connection() as conn:
+            conn.execute('DELETE FROM requests WHERE key = ?', (key,))
+
+    def sweep(self, conn, now):
+        conn.execute('DELETE FROM requests WHERE created <= ?',
+                     (now - self.ttl,))
+        conn.execute('DELETE FROM requests WHERE key IN (SELECT key FROM '
+                     'requests ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                     (self.max_entries,))
+
+
+def request_key(header, json_data, form):
+    """Return the key of a create request: its Idempotency-Key header if
+    it has one, otherwise a hash of its contents."""
+    if header:
+        return 'key:' + header
+    if json_data is not None:
+        body = {k: v for k, v in json_data.items() if k != 'access_token'}
+    else:
+        body = sorted((k, v) for k, v in form.items(multi=True)
+                      if k != 'access_token')
+    # hashed a piece at a time, rather than as one more copy of the post
+    digest = hashlib.sha256()
+    for chunk in KEY_ENCODER.iterencode(body):
+        digest.update(chunk.encode('utf-8'))
+    return 'sha256:' + digest.hexdigest()
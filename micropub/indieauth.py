@@ -0,0 +1,155 @@
+"""
+IndieAuth token checking, like flask_indieauth.requires_indieauth, but the
+token endpoint's answer is cached, so clients don't pay for a round-trip
+to it on every micropub call.
+
+Entries are keyed by a hash of the token, never the token itself.  Tokens
+the endpoint rejects are remembered too, for a shorter time.  Settings in
+app.config:
+
+* TOKEN_CACHE_TTL - seconds a verified token is trusted (default 300)
+* TOKEN_CACHE_NEGATIVE_TTL - seconds a rejected token stays rejected
+  (default 30)
+* TOKEN_CACHE_SIZE - max number of tokens remembered (default 1024)
+
+check_auth_async is the same check for micropub.asgi, asking the token
+endpoint on an async client.
+"""
+import functools
+import hashlib
+from urllib.parse import parse_qs
+import requests
+from flask import Response, g
+from flask import current_app as app
+from flask_indieauth import get_access_token, check_me, deny
+from micropub import metrics
+from micropub.utils import LRUCache
+
+token_cache = None
+session = requests.Session()
+
+INVALID = 'invalid'
+
+
+def requires_indieauth(f):
+    @functools.wraps(f)
+    def decorated(*args, **kwargs):
+        with metrics.timer('micropub_stage_seconds', stage='auth'):
+            resp = check_auth(get_access_token())
+        if isinstance(resp, Response):
+            return resp
+        return f(*args, **kwargs)
+    return decorated
+
+
+def check_auth(access_token):
+    if not access_token:
+        app.logger.error('No access token.')
+        return deny('No access token found.')
+    return check_token_data(access_token, verify_token(access_token))
+
+
+async def check_auth_async(access_token):
+    if not access_token:
+        app.logger.error('No access token.')
+        return deny('No access token found.')
+    return check_token_data(access_token,
+                            await verify_token_async(access_token))
+
+
+def check_token_data(access_token, token_data):
+    """Check the token endpoint's answer, returning a Response if it isn't
+    good enough."""
+    if token_data is INVALID:
+        app.logger.error('Invalid token')
+        return deny('Invalid token')
+
+    me, me_error = check_me(token_data['me'])
+    if me is None:
+        app.logger.error(f'Invalid `me` value [{me_error}]')
+        return deny(me_error)
+
+    scope = token_data['scope']
+    if not any(s in scope for s in ('post', 'create')):
+        app.logger.error(f"Scope '{scope}' does not contain 'post' or "
+                         "'create'.")
+        return deny(f"Scope '{scope}' does not contain 'post' or 'create'.")
+
+    g.user = {
+        'me': me,
+        'client_id': token_data['client_id'],
+        'scope': scope,
+        'access_token': access_token
+    }
+
+
+def verify_token(access_token):
+    """Return the token endpoint's me, client_id and scope for the token,
+    or INVALID, from the cache when possible."""
+    key = token_key(access_token)
+    token_data = get_token_cache().get(key)
+    if token_data is None:
+        token_data = fetch_token(access_token)
+        remember_token(key, token_data)
+    return token_data
+
+
+async def verify_token_async(access_token):
+    key = token_key(access_token)
+    token_data = get_token_cache().get(key)
+    if token_data is None:
+        token_data = await fetch_token_async(access_token)
+        remember_token(key, token_data)
+    return token_data
+
+
+def token_key(access_token):
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+
+def remember_token(key, token_data):
+    cache = get_token_cache()
+    if token_data is INVALID:
+        ttl = app.config.get('TOKEN_CACHE_NEGATIVE_TTL', 30)
+        cache.put(key, INVALID, ttl)
+    else:
+        cache.put(key, token_data, app.config.get('TOKEN_CACHE_TTL', 300))
+
+
+def fetch_token(access_token):
+    r = session.get(app.config['TOKEN_ENDPOINT'],
+                    headers={'Authorization': f'Bearer {access_token}'},
+                    timeout=10)
+    if 400 <= r.status_code < 500:
+        return INVALID
+    r.raise_for_status()
+    return parse_token(r.text)
+
+
+async def fetch_token_async(access_token):
+    from micropub.asyncgithub import get_client
+    r = await get_client().get(
+        app.config['TOKEN_ENDPOINT'],
+        headers={'Authorization': f'Bearer {access_token}'}, timeout=10)
+    if 400 <= r.status_code < 500:
+        return INVALID
+    r.raise_for_status()
+    return parse_token(r.text)
+
+
+def parse_token(text):
+    fields = parse_qs(text)
+    if not fields.get('me') or not fields.get('client_id'):
+        return INVALID
+    return {
+        'me': fields['me'][0],
+        'client_id': fields['client_id'][0],
+        'scope': fields.get('scope', [''])[0]
+    }
+
+
+def get_token_cache():
+    global token_cache
+    if token_cache is None:
+        token_cache = LRUCache(app.config.get('TOKEN_CACHE_SIZE', 1024))
+    return token_cache
@@ -0,0 +1,269 @@
+"""
+A backend that commits into a local bare clone of the site repository and
+pushes to the remote in the background.
+
+Blobs are written straight into the object store, and trees are built in
+a throwaway index file, so there is never a working copy to check out.
+Whatever is on the local branch but not on the remote gets pushed; if the
+remote has moved on, those commits are simply made again on top of it.
+"""
+import fcntl
+import io
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from hashlib import sha1
+from urllib.parse import urlsplit, urlunsplit
+from micropub.backend import Backend
+
+logger = logging.getLogger(__name__)
+
+# used when the environment doesn't say who is committing
+GIT_IDENTITY = {
+    'GIT_AUTHOR_NAME': 'micropub',
+    'GIT_AUTHOR_EMAIL': 'micropub@localhost',
+    'GIT_COMMITTER_NAME': 'micropub',
+    'GIT_COMMITTER_EMAIL': 'micropub@localhost'
+}
+
+# Credentials for the remote are handed to git by a credential helper that
+# reads them from the environment, so they're never in the remote URL, the
+# clone's config, the command line or the errors we log.
+CREDENTIAL_HELPER = ('!f() { echo "username=$MICROPUB_GIT_USERNAME"; '
+                     'echo "password=$MICROPUB_GIT_PASSWORD"; }; f')
+
+PUSH_ATTEMPTS = 3
+CHUNK_SIZE = 64 * 1024
+
+
+class PushError(Exception):
+    pass
+
+
+class LocalGitBackend(Backend):
+    def __init__(self, path, remote, branch='main', push_interval=5.0,
+                 credentials=None):
+        """credentials are the (username, password) to give the remote if
+        it asks for them."""
+        self.path = path
+        self.remote = remote
+        self.credentials = credentials
+        self.branch = branch
+        self.local_ref = f'refs/heads/{branch}'
+        self.remote_ref = f'refs/remotes/origin/{branch}'
+        self.push_interval = push_interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pusher = None
+        if not os.path.exists(os.path.join(path, 'HEAD')):
+            self.clone()
+        else:
+            # clones made before credentials were kept out of the URL
+            self.git('config', 'remote.origin.url', self.remote)
+
+    def clone(self):
+        self.run_git(['clone', '--quiet', '--bare', '--single-branch',
+                      '--branch', self.branch, self.remote, self.path], {})
+        self.git('update-ref', self.remote_ref, self.local_ref)
+
+    def git(self, *args, env=None, input=None, raw=False):
+        """Run a git command on the clone and return its output, as
+        stripped text or, with raw, as bytes."""
+        output = self.run_git(args, dict(env or {}, GIT_DIR=self.path), input)
+        if raw:
+            return output
+        return output.decode('utf-8').strip()
+
+    def run_git(self, args, env, input=None):
+        full_env = dict(GIT_IDENTITY)
+        full_env.update(os.environ)
+        full_env.update(env)
+        command = ['git']
+        if self.credentials:
+            command += ['-c', 'credential.helper=',
+                        '-c', f'credential.helper={CREDENTIAL_HELPER}']
+            full_env['MICROPUB_GIT_USERNAME'] = self.credentials[0]
+            full_env['MICROPUB_GIT_PASSWORD'] = self.credentials[1]
+        try:
+            return subprocess.run(command + list(args), env=full_env,
+                                  input=input, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, check=True).stdout
+        except subprocess.CalledProcessError as e:
+            raise subprocess.CalledProcessError(
+                e.returncode, [self.mask(arg) for arg in e.cmd], e.output,
+                self.mask(e.stderr.decode('utf-8', 'replace'))) from None
+
+    def mask(self, text):
+        """Hide whatever credentials the remote URL has in text."""
+        return text.replace(self.remote, mask_url(self.remote))
+
+    @contextmanager
+    def locked(self):
+        """Hold the branch for this thread and, through a lock file, against
+        the other worker processes sharing the clone."""
+        with self.lock:
+            with open(os.path.join(self.path, 'micropub.lock'), 'w') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                yield
+
+    def commit(self, files, message):
+        entries = []
+        for path, contents in files.items():
+            if contents is None:
+                entries.append(f'0 {"0" * 40}\t{path}\n')
+            else:
+                entries.append(
+                    f'100644 {self.write_blob(contents)}\t{path}\n')
+        with self.locked():
+            parent = self.git('rev-parse', self.local_ref)
+            sha = self.make_commit(parent, entries, message)
+            self.git('update-ref', self.local_ref, sha, parent)
+        self.start_pusher()
+        self.wakeup.set()
+        return sha
+
+    def read(self, path):
+        try:
+            return self.git('cat-file', 'blob', f'{self.local_ref}:{path}',
+                            raw=True)
+        except subprocess.CalledProcessError:
+            return None
+
+    def list_files(self):
+        return self.git('ls-tree', '-r', '-z', '--name-only', self.local_ref,
+                        raw=True).decode('utf-8').split('\0')[:-1]
+
+    def make_commit(self, parent, entries, message):
+        """Commit the index-info entries on top of parent."""
+        fd, index = tempfile.mkstemp(prefix='index-', dir=self.path)
+        os.close(fd)
+        os.unlink(index)
+        try:
+            env = {'GIT_INDEX_FILE': index}
+            self.git('read-tree', parent, env=env)
+            self.git('update-index', '--index-info', env=env,
+                     input=''.join(entries).encode('utf-8'))
+            tree = self.git('write-tree', env=env)
+        finally:
+            if os.path.exists(index):
+                os.unlink(index)
+        return self.git('commit-tree', tree, '-p', parent, '-m', message)
+
+    def write_blob(self, contents):
+        """Write a loose blob object and return its sha.  contents is a
+        string, bytes, or a binary file, which is copied over in chunks."""
+        if isinstance(contents, str):
+            contents = contents.encode('utf-8')
+        if isinstance(contents, bytes):
+            contents = io.BytesIO(contents)
+        contents.seek(0, os.SEEK_END)
+        size = contents.tell()
+        contents.seek(0)
+
+        header = f'blob {size}\0'.encode('utf-8')
+        digest = sha1(header)
+        compressor = zlib.compressobj()
+        objects = os.path.join(self.path, 'objects')
+        fd, tmp_path = tempfile.mkstemp(dir=objects)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressor.compress(header))
+                for chunk in iter(lambda: contents.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+            sha = digest.hexdigest()
+            obj_dir = os.path.join(objects, sha[:2])
+            obj_path = os.path.join(obj_dir, sha[2:])
+            if os.path.exists(obj_path):
+                return sha
+            os.makedirs(obj_dir, exist_ok=True)
+            os.chmod(tmp_path, 0o444)
+            os.rename(tmp_path, obj_path)
+            return sha
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def start_pusher(self):
+        with self.lock:
+            if self.pusher is not None and self.pusher.is_alive():
+                return
+            self.pusher = threading.Thread(target=self.run, daemon=True,
+                                           name='git-push')
+            self.pusher.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            try:
+                self.push()
+            except Exception:
+                logger.exception('push failed, will retry')
+                self.wakeup.set()
+            # let commits pile up a bit, so they're pushed together
+            time.sleep(self.push_interval)
+
+    def flush(self):
+        self.push()
+
+    def push(self):
+        """Push everything committed so far, replaying it on top of the
+        remote branch if that has moved on."""
+        for attempt in range(PUSH_ATTEMPTS):
+            head = self.git('rev-parse', self.local_ref)
+            if head == self.git('rev-parse', self.remote_ref):
+                return
+            try:
+                self.git('push', '--quiet', self.remote,
+                         f'{head}:{self.local_ref}')
+            except subprocess.CalledProcessError:
+                self.rebase()
+                continue
+            self.git('update-ref', self.remote_ref, head)
+            return
+        raise PushError(f'could not push to {self.branch} '
+                        f'after {PUSH_ATTEMPTS} attempts')
+
+    def rebase(self):
+        """Fetch the remote branch and make our unpushed commits again on
+        top of it."""
+        self.git('fetch', '--quiet', self.remote,
+                 f'+{self.local_ref}:{self.remote_ref}')
+        with self.locked():
+            head = self.git('rev-parse', self.remote_ref)
+            unpushed = self.git('rev-list', '--reverse', '--first-parent',
+                                f'{self.remote_ref}..{self.local_ref}')
+            for sha in unpushed.split():
+                message = self.git('log', '-1', '--format=%B', sha)
+                head = self.make_commit(head, self.changes(sha), message)
+            self.git('update-ref', self.local_ref, head)
+
+    def changes(self, sha):
+        """Return the index-info entries for what a commit changed."""
+        entries = []
+        for line in self.git('diff-tree', '-r', '--no-commit-id',
+                             f'{sha}^', sha).splitlines():
+            meta, path = line.split('\t', 1)
+            old_mode, new_mode, old_sha, new_sha, status = meta[1:].split()
+            if status == 'D':
+                entries.append(f'0 {"0" * 40}\t{path}\n')
+            else:
+                entries.append(f'{new_mode} {new_sha}\t{path}\n')
+        return entries
+
+
+def mask_url(url):
+    """Return url with any password in it replaced by stars."""
+    parts = urlsplit(url)
+    if parts.password is None:
+        return url
+    netloc = parts.netloc.rpartition('@')
+    user = netloc[0].split(':')[0]
+    return urlunsplit(parts._replace(netloc=f'{user}:***@{netloc[2]}'))
@@ -0,0 +1,175 @@
+"""
+The built-in media endpoint's file handling.
+
+Uploads are saved in MICROPUB_MEDIA_DIR as they come in, and the client
+gets their URL straight away.  Images are then processed in a pool of
+worker processes - their EXIF data stripped, after applying its rotation,
+and a smaller copy made for each of MICROPUB_MEDIA_WIDTHS narrower than the
+original - and committed together with their copies.  Other files are
+committed as they are.
+
+A copy is named after its original, with the width added, so a 960 pixel
+wide copy of 1a2b3c.jpg is 1a2b3c-960.jpg.
+"""
+import logging
+import mimetypes
+import multiprocessing
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# file extensions we can process, and the Pillow formats they're saved as
+IMAGE_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+JPEG_QUALITY = 85
+
+ext_re = re.compile(r'[a-z0-9]{1,8}')
+
+
+def new_name():
+    return uuid.uuid4().hex[:16]
+
+
+def upload_ext(filename, mimetype):
+    """Pick a safe file extension for an upload, from its file name or
+    failing that its content type."""
+    ext = os.path.splitext(filename or '')[1][1:].lower()
+    if not ext_re.fullmatch(ext):
+        ext = (mimetypes.guess_extension(mimetype or '') or '')[1:]
+    if ext == 'jpe':
+        ext = 'jpg'
+    return ext if ext_re.fullmatch(ext) else 'bin'
+
+
+def variant_name(name, width):
+    return name if width is None else f'{name}-{width}'
+
+
+def process_image(path, ext, widths):
+    """Strip the metadata from the image at path, in place, and write a
+    copy of it next to it for each of the widths narrower than it.  Returns
+    a dictionary of widths to the paths of the copies.
+
+    Runs in a worker process.
+    """
+    from PIL import Image, ImageOps
+
+    fmt = IMAGE_FORMATS[ext]
+    with Image.open(path) as original:
+        image = ImageOps.exif_transpose(original)
+        if fmt == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        # keep the colour profile, but nothing else; Pillow only writes the
+        # EXIF data it's given
+        options = {'icc_profile': original.info.get('icc_profile')}
+        if fmt in ('JPEG', 'WEBP'):
+            options['quality'] = JPEG_QUALITY
+        if fmt != 'WEBP':
+            options['optimize'] = True
+
+    save_image(image, path, fmt, options)
+    variants = {}
+    base = path[:-len(ext) - 1]
+    for width in widths:
+        if width >= image.width:
+            continue
+        height = max(1, round(image.height * width / image.width))
+        variant_path = f'{variant_name(base, width)}.{ext}'
+        save_image(image.resize((width, height), Image.LANCZOS),
+                   variant_path, fmt, options)
+        variants[width] = variant_path
+    return variants
+
+
+def save_image(image, path, fmt, options):
+    tmp_path = path + '.tmp'
+    image.save(tmp_path, fmt, **options)
+    os.replace(tmp_path, path)
+
+
+class MediaProcessor:
+    """Processes saved uploads in the background, then hands them to
+    commit_fn(files, location), files being a dictionary of repo paths to
+    open files.
+
+    workers is the number of processes resizing images; with 0, uploads
+    are processed and committed in the calling thread.
+    """
+    def __init__(self, media_dir, commit_fn, widths=(), workers=2):
+        self.media_dir = media_dir
+        self.commit_fn = commit_fn
+        self.widths = widths
+        self.workers = workers
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(media_dir, exist_ok=True)
+
+    def save(self, upload, name, ext):
+        """Save the upload (a werkzeug FileStorage) for processing, returning
+        its path."""
+        path = os.path.join(self.media_dir, f'{name}.{ext}')
+        upload.save(path)
+        return path
+
+    def submit(self, path, ext, repo_path, location):
+        """Process the saved upload at path and commit it, along with its
+        copies.  repo_path(width) gives the repo path of the copy with the
+        given width, or of the upload itself for None."""
+        if self.workers <= 0:
+            self.process(path, ext, repo_path, location)
+        else:
+            self.get_pools()[1].submit(self.process, path, ext, repo_path,
+                                       location)
+
+    def process(self, path, ext, repo_path, location):
+        variants = {}
+        if ext in IMAGE_FORMATS:
+            try:
+                if self.workers <= 0:
+                    variants = process_image(path, ext, self.widths)
+                else:
+                    variants = self.get_pools()[0].submit(
+                        process_image, path, ext, self.widths).result()
+            except Exception:
+                # better the upload as it came than no upload at all
+                logger.exception(f'Could not process {path}, '
+                                 'committing it as is')
+
+        paths = {repo_path(None): path}
+        for width, variant_path in variants.items():
+            paths[repo_path(width)] = variant_path
+
+        files = {}
+        try:
+            for rpath, fpath in paths.items():
+                files[rpath] = open(fpath, 'rb')
+            self.commit_fn(files, location)
+        except Exception:
+            # leave the files where they are, for someone to look at
+            logger.exception(f'Could not commit {location}')
+            return
+        finally:
+            for f in files.values():
+                f.close()
+
+        for fpath in paths.values():
+            os.unlink(fpath)
+
+    def get_pools(self):
+        """Return this process' image processing pool and the thread pool
+        waiting on it, creating them on first use (and again after a
+        fork)."""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # not spawn: under uWSGI sys.executable isn't python
+                    context = multiprocessing.get_context('fork')
+                    self._pools = (
+                        ProcessPoolExecutor(self.workers, mp_context=context),
+                        ThreadPoolExecutor(self.workers))
+                    self._pid = pid
+        return self._pools
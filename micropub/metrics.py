@@ -0,0 +1,204 @@
+"""
+Prometheus metrics, added up across the worker processes.
+
+Every process counts in memory and writes its totals to a file of its own
+in the metrics directory, at most once a second, from a background
+thread.  /metrics adds up all the files, so what it reports doesn't depend
+on which worker answers.  Files of workers that have gone away are kept,
+as their counts are part of the totals.
+"""
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    'micropub_stage_seconds':
+        ('histogram', 'Time spent in each stage of handling a post.'),
+    'micropub_github_request_seconds':
+        ('histogram', 'Time spent on GitHub API calls, by call.'),
+    'micropub_github_failures_total':
+        ('counter', 'Failed GitHub API calls, by call and status code.'),
+    'micropub_responses_total':
+        ('counter', 'Responses sent, by endpoint and status code.'),
+    'micropub_queue_depth':
+        ('gauge', 'Commits waiting in the commit queue.')
+}
+
+FLUSH_INTERVAL = 1.0
+
+directory = None
+_histograms = {}
+_counters = {}
+_pid = None
+_dirty = False
+_flusher = None
+_lock = threading.Lock()
+
+
+def configure(metrics_dir):
+    global directory
+    os.makedirs(metrics_dir, exist_ok=True)
+    directory = metrics_dir
+
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        check_pid()
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # a count per bucket, then +Inf, then the sum
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+    changed()
+
+
+def inc(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        check_pid()
+        _counters[key] = _counters.get(key, 0) + amount
+    changed()
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def check_pid():
+    """Start counting afresh in a forked child, so nothing is counted
+    twice."""
+    global _pid, _flusher
+    pid = os.getpid()
+    if _pid != pid:
+        _histograms.clear()
+        _counters.clear()
+        _pid = pid
+        _flusher = None
+
+
+def changed():
+    global _dirty, _flusher
+    if directory is None:
+        return
+    with _lock:
+        _dirty = True
+        if _flusher is None:
+            _flusher = threading.Thread(target=run_flusher, daemon=True,
+                                        name='metrics-flush')
+            _flusher.start()
+
+
+def run_flusher():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+
+def flush():
+    """Write this process' totals to its file, if they changed."""
+    global _dirty
+    with _lock:
+        if not _dirty or directory is None:
+            return
+        data = snapshot()
+        _dirty = False
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def snapshot():
+    return {
+        'histograms': [[name, labels, values]
+                       for (name, labels), values in _histograms.items()],
+        'counters': [[name, labels, value]
+                     for (name, labels), value in _counters.items()]
+    }
+
+
+def collect():
+    """Add up the totals of every process, this one's being current."""
+    with _lock:
+        check_pid()
+        mine = snapshot()
+    snapshots = [mine]
+    if directory is not None:
+        own_file = os.path.join(directory, f'{os.getpid()}.json')
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            if path == own_file:
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    histograms = {}
+    counters = {}
+    for data in snapshots:
+        for name, labels, values in data['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+        for name, labels, value in data['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+    return histograms, counters
+
+
+def render(gauges=None):
+    """Return all metrics in the Prometheus text format.  gauges are
+    {name: value} of gauges computed by the caller."""
+    histograms, counters = collect()
+    samples = {}
+    for (name, labels), values in sorted(histograms.items()):
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), values[:-1]):
+            cumulative += count
+            lines.append(f'{name}_bucket'
+                         f'{format_labels(labels + (("le", str(bound)),))} '
+                         f'{cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {values[-1]}')
+        lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+    for (name, labels), value in sorted(counters.items()):
+        samples.setdefault(name, []).append(
+            f'{name}{format_labels(labels)} {value}')
+    for name, value in sorted((gauges or {}).items()):
+        samples.setdefault(name, []).append(f'{name} {value}')
+
+    out = []
+    for name, lines in samples.items():
+        kind, help_text = METRICS[name]
+        out.append(f'# HELP {name} {help_text}')
+        out.append(f'# TYPE {name} {kind}')
+        out.extend(lines)
+    return '\n'.join(out) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{k}="{escape(str(v))}"' for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
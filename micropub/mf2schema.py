@@ -1,3 +1,7 @@
+import json
+import re
+from jsonschema import Draft7Validator
+
 mf2schema = """{
     "$schema": "http://json-schema.org/draft-07/schema#",
     "type": "object",
@@ -70,3 +74,52 @@ mf2schema = """{
     }
 }
 """
+
+
+# the schema is parsed and its validator built once, at import time
+mf2validator = Draft7Validator(json.loads(mf2schema))
+
+type_re = re.compile(r'^h-([0-9a-z]+-)?[a-z]+(-[a-z]+)*$')
+prop_re = re.compile(r'^([0-9a-z]+-)?[a-z]+(-[a-z]+)*$')
+
+# plain values and {'html': ..., 'value': ...} content objects are all that
+# most clients ever send
+html_keys = [{'html'}, {'html', 'value'}]
+
+
+def validate_mf2(data):
+    """Raise a jsonschema ValidationError if data is not a valid mf2 object.
+
+    The common h-entry shape is checked by hand; anything unusual goes
+    through the full schema validator.
+    """
+    if not is_simple_entry(data):
+        mf2validator.validate(data)
+
+
+def is_simple_entry(data):
+    if type(data) is not dict or data.keys() != {'type', 'properties'}:
+        return False
+    types = data['type']
+    if type(types) is not list or not types:
+        return False
+    for t in types:
+        if type(t) is not str or not type_re.match(t):
+            return False
+    properties = data['properties']
+    if type(properties) is not dict:
+        return False
+    for key, values in properties.items():
+        if type(key) is not str or not prop_re.match(key):
+            return False
+        if type(values) is not list:
+            return False
+        for v in values:
+            if type(v) is str:
+                continue
+            if type(v) is not dict or v.keys() not in html_keys:
+                return False
+            for s in v.values():
+                if type(s) is not str:
+                    return False
+    return True
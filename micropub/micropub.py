@@ -1,38 +1,129 @@
 import json
 import datetime
-import copy
+import math
+import hashlib
+import hmac
 import os
+import tempfile
+from contextlib import contextmanager
 
-from jsonschema import validate
 from flask import Response, Blueprint
 from flask import current_app as app
-from flask import request
-from flask_indieauth import requires_indieauth
-from micropub.mf2schema import mf2schema
-from micropub.utils import disable_if_testing
-from micropub.commit import commit
-from micropub.format import make_post
-
-# IndieAuth credentials:
+from flask import request, g
+from micropub import metrics
+from micropub.indieauth import requires_indieauth
+from micropub.mf2schema import validate_mf2
+from micropub.utils import disable_if_testing, LRUCache, LimitedInput
+from micropub.backend import make_backend
+from micropub.commitqueue import CommitQueue
+from micropub.commit import RateLimited
+from micropub.idempotency import IdempotencyStore, request_key
+from micropub.format import make_post, write_post, post_size, parse_post, \
+    content_ext
+from micropub.media import MediaProcessor, new_name, upload_ext, variant_name
+from micropub.post import Post
+from micropub.postindex import PostIndex, compile_path_pattern, match_path
+
+# IndieAuth credentials, in app.config:
 #
 # ME=https://desmondrivet.com
 # TOKEN_ENDPOINT=https://tokens.indieauth.com/token
-# 
-# Github information:
-# 
-# GH_REPO - the repository where you have your website, including the name or org.  In my case it's drivet/website-11ty
-# GH_USERNAME - username on github
-# GH_PASSWORD - the token you generate on Github
-#  
-# MICROPUB_MEDIA_ENDPOINT - the endpoint where you will upload media
-# MICROPUB_REPO_PATH_FORMAT - the format to use for the newly saved file paths.  In my case it's 
-#   src/posts/feed/{published:%Y}/{published:%Y}{published:%m}{published:%d}{published:%H}{published:%M}{published:%S}.{ext}
+#
+# Everything else comes from the environment, see micropub/settings.py
 
 micropub_bp = Blueprint('micropub_bp', __name__)
 
-syndicate_to = [
-    {'name': 'Mastodon', 'uid': 'mastodon'}
-]
+settings = None
+backend = None
+commit_queue = None
+media_processor = None
+post_index = None
+handled_requests = None
+post_cache = None
+query_responses = None
+
+# the scope each action needs, besides post or create
+ACTION_SCOPES = {'update': 'update', 'delete': 'delete', 'undelete': 'delete'}
+
+# q=config and q=syndicate-to answers are only cached by clients for a
+# while, since they're behind a token
+QUERY_CACHE_CONTROL = 'private, max-age=300'
+
+
+def configure(new_settings):
+    """Set everything up from the settings, once, at startup."""
+    global settings, backend, commit_queue, media_processor, post_index, \
+        handled_requests, post_cache, query_responses
+    settings = new_settings
+    post_index = PostIndex(settings.index_path)
+    handled_requests = IdempotencyStore(settings.idempotency_path,
+                                        ttl=settings.idempotency_ttl,
+                                        max_entries=settings.idempotency_size)
+    # recently written or read posts, as {(path, version): contents}
+    post_cache = LRUCache(settings.source_cache_size)
+    metrics.configure(settings.metrics_dir)
+    query_responses = make_query_responses(settings)
+    backend = make_backend(settings)
+    commit_queue = None
+    if settings.queue_dir:
+        commit_queue = CommitQueue(settings.queue_dir, commit_now,
+                                   batch_window=settings.batch_window,
+                                   batch_size=settings.batch_size,
+                                   max_attempts=settings.queue_attempts)
+        # pick up anything left in the queue by a previous run
+        commit_queue.start()
+    media_processor = MediaProcessor(settings.media_dir, commit_media,
+                                     widths=settings.media_widths,
+                                     workers=settings.media_workers)
+
+
+@micropub_bp.before_request
+def check_body_size():
+    # refuse oversized posts up front, before reading them or checking the
+    # token; bodies without a length are cut off as they're read
+    length = request.content_length
+    if request.endpoint == 'micropub_bp.handle_media':
+        limit = settings.media_max_size
+    else:
+        limit = settings.max_body_size
+    if length is not None and length > limit:
+        app.logger.error(f'Request body too large: {length} bytes')
+        return Response(status=413)
+    if length is None:
+        request.environ['wsgi.input'] = \
+            LimitedInput(request.environ['wsgi.input'], limit)
+
+
+@micropub_bp.errorhandler(RateLimited)
+def handle_rate_limited(e):
+    app.logger.error(f'Rate limited: {e}')
+    resp = Response(status=503)
+    resp.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return resp
+
+
+@micropub_bp.after_request
+def count_response(resp):
+    if request.endpoint != 'micropub_bp.handle_metrics':
+        endpoint = (request.endpoint or 'unknown').split('.')[-1]
+        metrics.inc('micropub_responses_total', endpoint=endpoint,
+                    status=str(resp.status_code))
+    return resp
+
+
+@micropub_bp.route('/metrics', methods=['GET'])
+def handle_metrics():
+    if settings.metrics_token:
+        expected = f'Bearer {settings.metrics_token}'
+        if not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                   expected):
+            return Response(status=401)
+    gauges = {}
+    if commit_queue:
+        gauges['micropub_queue_depth'] = commit_queue.depth()
+    return Response(metrics.render(gauges),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 @micropub_bp.route('/', methods=['GET', 'POST'], strict_slashes=False)
 @disable_if_testing(requires_indieauth)
@@ -45,61 +136,361 @@ def handle_root():
             return Response(status=400)
     elif request.method == 'POST':
         app.logger.info('handling micropub root POST')
-        if 'action' in request.form:
-            app.logger.error('Actions other than create not supported')
-            return Response(status=400)
+        json_data = request.get_json() if request.is_json else None
+        data = json_data if isinstance(json_data, dict) else request.form
+        if 'action' in data:
+            return handle_action(data)
         else:
-            return handle_create()
+            with metrics.timer('micropub_stage_seconds', stage='create'):
+                return handle_create()
     else:
         app.logger.error('HTTP method not supported: ' + request.method)
         return Response(status=405)
 
 
+@micropub_bp.route('/media', methods=['POST'])
+@disable_if_testing(requires_indieauth)
+def handle_media():
+    upload = request.files.get('file')
+    if upload is None:
+        app.logger.error('No file in media upload')
+        return Response(status=400)
+
+    published = datetime.datetime.now()
+    name = new_name()
+    ext = upload_ext(upload.filename, upload.mimetype)
+    location = os.path.join(app.config['ME'], settings.format_media_url(
+        published=published, name=name, ext=ext))
+    app.logger.info('using media location ' + location)
+
+    def repo_path(width):
+        return settings.format_media_path(
+            published=published, name=variant_name(name, width), ext=ext)
+
+    path = media_processor.save(upload, name, ext)
+    media_processor.submit(path, ext, repo_path, location)
+    resp = Response(status=201)
+    resp.headers['Location'] = location
+    return resp
+
+
 def handle_query():
     q = request.args.get('q')
-    supported_q = ['config', 'syndicate-to']
+    responses = query_responses
 
-    if q not in supported_q:
+    if q == 'source':
+        return handle_source()
+    if q not in responses:
         app.logger.error(f'Unsupported q value: {q}')
         return Response(status=400)
 
-    result = {}
-        
-    if q == 'config':
-        media_endpoint = os.environ.get('MICROPUB_MEDIA_ENDPOINT', None)
-        if media_endpoint:
-            result['media-endpoint'] = media_endpoint
+    body, etag = responses[q]
+    resp = Response(body, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = QUERY_CACHE_CONTROL
+    return resp.make_conditional(request)
+
+
+def handle_source():
+    found = find_source()
+    if isinstance(found, Response):
+        return found
+    path, version = found
+    return source_response(path, read_post(path, version))
+
+
+def find_source():
+    """Return the path and version of the post q=source asks for, or the
+    response if there isn't one."""
+    url = request.args.get('url')
+    entry = find_post(url)
+    if entry is None:
+        app.logger.error(f'No post found for {url}')
+        return Response(status=400)
+    permalink, path, deleted, version = entry
+    if deleted is not None:
+        return Response(status=410)
+    return path, version
+
+
+def source_response(path, contents):
+    if contents is None:
+        app.logger.error(f'{path} is not in the repo')
+        return Response(status=400)
+
+    source = parse_post(contents, post_ext(path))
+    wanted = request.args.getlist('properties[]') or \
+        request.args.getlist('properties')
+    if wanted:
+        properties = source['properties']
+        source = {'properties': {p: properties[p] for p in wanted
+                                 if p in properties}}
+    return Response(json.dumps(source), mimetype='application/json')
+
+
+def make_query_responses(settings):
+    """Serialize the answer to each supported q value once, returning a
+    dictionary of q values to (body, etag) pairs."""
+    config = {}
+    if os.path.exists(settings.config_path):
+        with open(settings.config_path) as f:
+            config = json.load(f)
 
-    if q == 'config' or q == 'syndicate-to':    
-        result['syndicate-to'] = syndicate_to
+    syndicate_to = config.get('syndicate-to', [])
+    media_endpoint = settings.media_endpoint or config.get('media-endpoint')
 
-    return json.dumps(result)
+    results = {'config': {}, 'syndicate-to': {}}
+    if media_endpoint:
+        results['config']['media-endpoint'] = media_endpoint
+    results['config']['syndicate-to'] = syndicate_to
+    results['syndicate-to']['syndicate-to'] = syndicate_to
+
+    responses = {}
+    for q, result in results.items():
+        body = json.dumps(result).encode('utf-8')
+        responses[q] = (body, hashlib.sha1(body).hexdigest())
+    return responses
 
 
 def handle_create():
-    request_data = extract_create_request(request.get_json(), request.form)
-    permalink = os.path.join(app.config['ME'], make_permalink(request_data))
+    prepared = prepare_create()
+    if isinstance(prepared, Response):
+        return prepared
+    key, post, permalink = prepared
+    try:
+        save_post(post, permalink)
+    except Exception:
+        handled_requests.release(key)
+        raise
+    return created(permalink)
+
+
+def prepare_create():
+    """Return the request's idempotency key, post and permalink, or the
+    response if it was handled already."""
+    json_data = request.get_json() if request.is_json else None
+    # before the defaults are filled in, so a retry hashes the same
+    key = request_key(request.headers.get('Idempotency-Key'), json_data,
+                      request.form)
+    try:
+        post = Post(extract_create_request(json_data, request.form))
+    except ValueError as e:
+        app.logger.error(f'Bad create request: {e}')
+        return Response(status=400)
+    permalink = os.path.join(app.config['ME'], make_permalink(post))
+
+    original = handled_requests.claim(key, permalink)
+    if original is not None:
+        app.logger.info('already handled this request, at ' + original)
+        return created(original)
     app.logger.info('using permalink ' + permalink)
 
     # access token is passed along with the rest of the data,
     # we don't want to save that
-    props = request_data['properties']
-    if 'access_token' in props:
-        del props['access_token']
+    post.properties.pop('access_token', None)
+    return key, post, permalink
+
 
-    save_post(request_data)
+def created(permalink):
     resp = Response(status=202)
     resp.headers['Location'] = permalink
     return resp
 
 
+def handle_action(data):
+    action = data.get('action')
+    if action not in ACTION_SCOPES:
+        app.logger.error(f'Unsupported action: {action}')
+        return Response(status=400)
+
+    user = g.get('user')
+    if user is not None and ACTION_SCOPES[action] not in user['scope']:
+        app.logger.error(f"Scope '{user['scope']}' does not allow {action}")
+        return Response(status=403)
+
+    url = data.get('url')
+    entry = find_post(url)
+    if entry is None:
+        app.logger.error(f'No post found for {url}')
+        return Response(status=400)
+    permalink, path, deleted, version = entry
+    app.logger.info(f'{action} of {url}, at {path}')
+
+    if action == 'update':
+        if deleted is not None or not request.is_json:
+            app.logger.error('Can only update posts that are there, in json')
+            return Response(status=400)
+        contents = read_post(path, version)
+        if contents is None:
+            app.logger.error(f'{path} is not in the repo')
+            return Response(status=400)
+        try:
+            update_post(permalink, path, contents, data, url)
+        except ValueError as e:
+            app.logger.error(f'Bad update: {e}')
+            return Response(status=400)
+    elif action == 'delete':
+        if deleted is None:
+            contents = read_post(path, version)
+            if contents is None:
+                app.logger.error(f'{path} is not in the repo')
+                return Response(status=400)
+            commit_files({path: None}, 'delete post', url)
+            post_index.mark_deleted(permalink, contents)
+    elif deleted is not None:
+        commit_files({path: deleted}, 'undelete post', url)
+        cache_post(path, post_index.put(permalink, path), deleted)
+    return Response(status=204)
+
+
+def find_post(url):
+    """Return (permalink, path, deleted, version) for the post at url, or
+    None."""
+    permalink = url_permalink(url)
+    if permalink is None:
+        return None
+    entry = post_index.get(permalink)
+    if entry is None and not post_index.is_built():
+        rebuild_index()
+        entry = post_index.get(permalink)
+    return None if entry is None else (permalink,) + entry
+
+
+def url_permalink(url):
+    me = app.config['ME'].rstrip('/') + '/'
+    if not isinstance(url, str) or not url.startswith(me):
+        return None
+    return url[len(me):]
+
+
+def needs_rebuild(url):
+    """Whether find_post(url) would have to rebuild the index first."""
+    permalink = url_permalink(url)
+    return permalink is not None and not post_index.is_built() and \
+        post_index.get(permalink) is None
+
+
+def rebuild_index(paths=None):
+    """Fill in the post index from a listing of the repository, made here
+    unless paths are given."""
+    app.logger.info('rebuilding the post index')
+    entries = []
+    pattern = compile_path_pattern(settings.repo_path_format)
+    if pattern is not None:
+        if paths is None:
+            paths = backend.list_files()
+        for path in paths:
+            fields = match_path(pattern, path)
+            if fields is not None:
+                published, slug = fields
+                permalink = settings.format_permalink(published=published,
+                                                      slug=slug)
+                entries.append((permalink, path))
+    post_index.rebuild(entries)
+
+
+def read_post(path, version):
+    """Return the contents of the post file as bytes, or None, from the
+    cache, the commits still in the queue, or the repo."""
+    try:
+        return local_post(path, version)
+    except KeyError:
+        contents = backend.read(path)
+    if contents is not None:
+        cache_post(path, version, contents)
+    return contents
+
+
+def local_post(path, version):
+    """Return the contents of the post file from the cache, or the commits
+    still in the queue.  Raises KeyError if it has to be read from the
+    repo."""
+    contents = post_cache.get((path, version))
+    if contents is not None:
+        return contents
+    if not commit_queue:
+        raise KeyError(path)
+    contents = commit_queue.find(path)
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    if contents is not None:
+        cache_post(path, version, contents)
+    return contents
+
+
+def cache_post(path, version, contents):
+    """Keep the post's contents, unless it's one of the big ones."""
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    if isinstance(contents, bytes) and len(contents) <= settings.spool_size:
+        post_cache.put((path, version), contents)
+
+
+def post_ext(path):
+    return 'html' if path.endswith('.html') else 'md'
+
+
+def update_post(permalink, path, contents, data, url):
+    ext = post_ext(path)
+    request_data = parse_post(contents, ext)
+    apply_update(request_data['properties'], data)
+    post = Post(request_data)
+    new_ext = content_ext(post)
+    new_path = path
+    # the extension follows the content, so the file may have to move
+    if new_ext != ext and path.endswith('.' + ext):
+        new_path = path[:-len(ext)] + new_ext
+    new_contents, _ = make_post(post, settings.post_format(new_path))
+    files = {new_path: new_contents}
+    if new_path != path:
+        files = {path: None, new_path: new_contents}
+    commit_files(files, 'update post', url)
+    cache_post(new_path, post_index.put(permalink, new_path), new_contents)
+
+
+def apply_update(properties, data):
+    """Apply the replace, add and delete parts of an update request to
+    the properties."""
+    replace = data.get('replace', {})
+    add = data.get('add', {})
+    delete = data.get('delete', [])
+    if not isinstance(replace, dict) or not isinstance(add, dict) or \
+            not isinstance(delete, (list, dict)):
+        raise ValueError('replace and add must be objects, delete an array '
+                         'or object')
+    for prop, values in replace.items():
+        properties[prop] = check_values(prop, values)
+    for prop, values in add.items():
+        properties.setdefault(prop, []).extend(check_values(prop, values))
+    if isinstance(delete, list):
+        for prop in delete:
+            properties.pop(prop, None)
+    else:
+        for prop, values in delete.items():
+            values = check_values(prop, values)
+            remaining = [v for v in properties.get(prop, [])
+                         if v not in values]
+            if remaining:
+                properties[prop] = remaining
+            else:
+                properties.pop(prop, None)
+
+
+def check_values(prop, values):
+    if not isinstance(values, list):
+        raise ValueError(f'{prop} values must be an array')
+    return values
+
+
 def extract_create_request(json_data, form_data):
     """Return a decoded json object for a create request, or convert the web
     form data and return that.
     """
     if json_data:
-        validate(json_data, json.loads(mf2schema))
-        request_data = copy.deepcopy(json_data)
+        with metrics.timer('micropub_stage_seconds', stage='validate'):
+            validate_mf2(json_data)
+        # get_json() parses the body afresh, nobody else holds on to it
+        request_data = json_data
     else:
         request_data = form2json(form_data)
     fill_defaults(request_data)
@@ -146,51 +537,58 @@ def fill_defaults(request_data):
         request_data['properties']['published'] = [date.isoformat()]
 
 
-def save_post(request_data):
+def save_post(post, permalink=None):
     app.logger.info('saving post...')
-    props = request_data['properties']
-    published_date = get_published_date(props)
-    slug = get_slug(props)
-    result = make_post(request_data)
-    repo_path = get_repo_path_format().format(published=published_date,
-                                              slug=slug,
-                                              ext=result[1])
-    files = {repo_path: result[0]}
-    auth = (os.environ['GH_USERNAME'], os.environ['GH_PASSWORD'])
-    commit(os.environ['GH_REPO'], auth, files, 'new post', 'main')
+    repo_path = post_repo_path(post)
+    with post_contents(post, settings.post_format(repo_path)) as contents:
+        commit_files({repo_path: contents}, 'new post', permalink)
+        record_post(post, repo_path, contents)
+
+
+@contextmanager
+def post_contents(post, fmt):
+    """Make the post file in the output format fmt; big ones are written to
+    a temporary file, which is closed afterwards."""
+    if post_size(post) > settings.spool_size:
+        with tempfile.SpooledTemporaryFile(settings.spool_size) as f:
+            with metrics.timer('micropub_stage_seconds', stage='make_post'):
+                write_post(post, f, fmt)
+            f.seek(0)
+            yield f
+    else:
+        with metrics.timer('micropub_stage_seconds', stage='make_post'):
+            contents, ext = make_post(post, fmt)
+        yield contents
 
 
-def get_repo_path_format():
-    default = 'content/micropub/' + \
-              '{published:%Y}/{published:%m}/{published:%d}/' + \
-              '{published:%H}{published:%M}{published:%S}.{ext}'
-    return os.environ.get('MICROPUB_REPO_PATH_FORMAT', default)
+def post_repo_path(post):
+    return settings.format_repo_path(published=post.published,
+                                     slug=post.slug,
+                                     ext=content_ext(post))
 
 
-def make_permalink(request_data):
-    props = request_data['properties']
-    published_date = get_published_date(props)
-    slug = get_slug(props)
-    return get_permalink_format().format(published=published_date, slug=slug)
+def record_post(post, repo_path, contents):
+    """Index a newly committed post, and keep its contents."""
+    cache_post(repo_path, post_index.put(make_permalink(post), repo_path),
+               contents)
 
 
-def get_permalink_format():
-    default = '{published:%Y}/{published:%m}/{published:%d}/{slug}'
-    return os.environ.get('MICROPUB_PERMALINK_FORMAT', default)
+def commit_media(files, location):
+    commit_files(files, 'new media', location)
 
 
-def get_slug(props):
-    return props.get('mp-slug', [get_default_slug(props)])[0]
+def commit_files(files, message, permalink=None):
+    if commit_queue:
+        with metrics.timer('micropub_stage_seconds', stage='queue'):
+            commit_queue.put(files, message, permalink)
+    else:
+        commit_now(files, message)
 
 
-def get_default_slug(props):
-    date = get_published_date(props)
-    return '{published:%H}{published:%M}{published:%S}'.format(published=date)
+def commit_now(files, message):
+    with metrics.timer('micropub_stage_seconds', stage='commit'):
+        backend.commit(files, message)
 
 
-def get_published_date(props):
-    datestr = props['published'][0]
-    try:
-        return datetime.datetime.strptime(datestr, '%Y-%m-%dT%H:%M:%S.%f')
-    except ValueError:
-        return datetime.datetime.strptime(datestr, '%Y-%m-%dT%H:%M:%S-%f')
+def make_permalink(post):
+    return settings.format_permalink(published=post.published, slug=post.slug)
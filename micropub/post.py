@@ -0,0 +1,48 @@
+from micropub.utils import parse_datetime
+
+
+class Post:
+    """A micropub create request, parsed once and handed to everything
+    downstream.
+
+    type and properties are the mf2 object's own (not copies), published
+    is the parsed published date (None if there isn't one), slug is
+    mp-slug or one made from the published time, content is the first
+    content value, a string or an {'html': ...} dict, or None, and children
+    are the nested mf2 objects, if any.
+    """
+    __slots__ = ('type', 'properties', 'published', 'slug', 'content',
+                 'children')
+
+    def __init__(self, data):
+        self.type = data['type']
+        self.properties = data['properties']
+        self.children = data.get('children') or []
+        props = self.properties
+
+        published = props.get('published')
+        self.published = parse_datetime(published[0]) if published else None
+
+        if 'mp-slug' in props:
+            self.slug = props['mp-slug'][0]
+        elif self.published is not None:
+            self.slug = default_slug(self.published)
+        else:
+            self.slug = None
+
+        content = props.get('content')
+        if content and isinstance(content, list):
+            self.content = content[0]
+        else:
+            self.content = None
+
+    def to_mf2(self):
+        mf2 = {'type': self.type, 'properties': self.properties}
+        if self.children:
+            mf2['children'] = self.children
+        return mf2
+
+
+def default_slug(published):
+    return '{published:%H}{published:%M}{published:%S}'.format(
+        published=published)
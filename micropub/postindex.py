@@ -0,0 +1,156 @@
+"""
+A persistent index of permalinks to the repo paths of their posts, so
+update and delete requests can find the file to change.
+
+It lives in a small sqlite database shared by the worker processes, and
+is kept up to date from the server's own commits.  When it's first used
+it is filled in from a listing of the repository, by matching each path
+against the repo path format.  Paths without the slug are given the
+default one, so after such a rebuild, posts that had an mp-slug can only
+be found if it's part of their path.
+
+Deleted posts stay in the index with their last contents, so they can be
+undeleted.  Each entry has a version, bumped on every change, so copies
+of a post cached by any one process can be told apart from the current
+one.
+"""
+import datetime
+import os
+import re
+import sqlite3
+import threading
+from string import Formatter
+from micropub.post import default_slug
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS posts (
+    permalink TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    deleted BLOB,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# the strftime directives we can read back from a path
+DIRECTIVES = {'Y': ('year', r'\d{4}'), 'm': ('month', r'\d\d'),
+              'd': ('day', r'\d\d'), 'H': ('hour', r'\d\d'),
+              'M': ('minute', r'\d\d'), 'S': ('second', r'\d\d')}
+
+
+class PostIndex:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use (and
+        again after a fork)."""
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+            self.local.pid = pid
+        return self.local.conn
+
+    def get(self, permalink):
+        """Return (path, deleted, version) for the permalink, deleted being
+        the contents of a deleted post, or None if it's there.  Returns None
+        if the permalink isn't known."""
+        return self.connection().execute(
+            'SELECT path, deleted, version FROM posts WHERE permalink = ?',
+            (permalink,)).fetchone()
+
+    def put(self, permalink, path):
+        """Record the post's path, and return its new version."""
+        with self.connection() as conn:
+            conn.execute('INSERT INTO posts (permalink, path) VALUES (?, ?) '
+                         'ON CONFLICT (permalink) DO UPDATE SET '
+                         'path = excluded.path, deleted = NULL, '
+                         'version = version + 1', (permalink, path))
+            return self.version(conn, permalink)
+
+    def mark_deleted(self, permalink, contents):
+        with self.connection() as conn:
+            conn.execute('UPDATE posts SET deleted = ?, version = version + 1 '
+                         'WHERE permalink = ?', (contents, permalink))
+            return self.version(conn, permalink)
+
+    def version(self, conn, permalink):
+        return conn.execute('SELECT version FROM posts WHERE permalink = ?',
+                            (permalink,)).fetchone()[0]
+
+    def is_built(self):
+        return self.connection().execute(
+            "SELECT 1 FROM meta WHERE key = 'built'").fetchone() is not None
+
+    def rebuild(self, entries):
+        """Add the (permalink, path) entries, leaving the ones we already
+        know alone, since those came from our own commits."""
+        with self.connection() as conn:
+            conn.executemany('INSERT OR IGNORE INTO posts (permalink, path) '
+                             'VALUES (?, ?)', entries)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('built', ?)",
+                         (datetime.datetime.now().isoformat(),))
+
+
+def compile_path_pattern(fmt):
+    """Turn a repo path format into a regex matching the paths it makes,
+    or None if it uses something we can't read back."""
+    pattern = []
+    seen = set()
+    for literal, field, spec, conversion in Formatter().parse(fmt):
+        pattern.append(re.escape(literal))
+        if field is None:
+            continue
+        if conversion or field not in ('published', 'slug', 'ext'):
+            return None
+        if field == 'published':
+            parts = re.split(r'(%.)', spec or '')
+            for part in parts:
+                if part.startswith('%') and len(part) == 2:
+                    if part[1] not in DIRECTIVES:
+                        return None
+                    pattern.append(group(*DIRECTIVES[part[1]], seen))
+                else:
+                    pattern.append(re.escape(part))
+        elif spec:
+            return None
+        elif field == 'slug':
+            pattern.append(group('slug', r'[^/]+', seen))
+        else:
+            pattern.append(group('ext', r'md|html', seen))
+    return re.compile(''.join(pattern))
+
+
+def group(name, regex, seen):
+    if name in seen:
+        return f'(?P={name})'
+    seen.add(name)
+    return f'(?P<{name}>{regex})'
+
+
+def match_path(pattern, path):
+    """Return the published date and slug of the post at path, or None if
+    the path isn't one of ours."""
+    m = pattern.fullmatch(path)
+    if m is None:
+        return None
+    fields = m.groupdict()
+    if 'year' not in fields:
+        return None
+    try:
+        published = datetime.datetime(
+            *(int(fields.get(f, 1)) for f in ('year', 'month', 'day')),
+            *(int(fields.get(f, 0)) for f in ('hour', 'minute', 'second')))
+    except ValueError:
+        return None
+    return published, fields.get('slug') or default_slug(published)
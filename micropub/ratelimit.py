@@ -0,0 +1,93 @@
+"""
+Pacing for GitHub API calls, going by the rate limit headers GitHub sends
+back with every answer.
+
+Calls go through as fast as they like while the budget is healthy.  Once
+fewer than reserve calls are left, they're spread out evenly over the time
+left until the limit resets, and once none are left they wait for the
+reset.  A call refused for a secondary rate limit (403 or 429) holds up
+every call for as long as Retry-After says, or for a minute, doubling
+each time it happens again.
+"""
+import threading
+import time
+
+SECONDARY_BACKOFF = 60.0
+MAX_BACKOFF = 900.0
+
+
+class RateLimiter:
+    def __init__(self, reserve=100, clock=time.time):
+        self.reserve = reserve
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset = None
+        self.blocked_until = 0.0
+        self.next_slot = 0.0
+        self.backoffs = 0
+
+    def reserve_slot(self, max_wait=None):
+        """Claim a call, and return how many seconds to wait before making
+        it.  If that's more than max_wait, nothing is claimed."""
+        with self.lock:
+            now = self.clock()
+            start = self.earliest(now)
+            if max_wait is not None and start - now > max_wait:
+                return start - now
+            if self.budget_known(now):
+                if 0 < self.remaining <= self.reserve:
+                    self.next_slot = start + \
+                        (self.reset - now) / self.remaining
+                # other threads shouldn't count on this one
+                self.remaining -= 1
+            return start - now
+
+    def delay(self):
+        """How many seconds until calls can be made again."""
+        with self.lock:
+            now = self.clock()
+            return self.earliest(now) - now
+
+    def earliest(self, now):
+        start = max(now, self.blocked_until, self.next_slot)
+        if self.budget_known(now) and self.remaining <= 0:
+            start = max(start, self.reset)
+        return start
+
+    def budget_known(self, now):
+        return self.remaining is not None and self.reset is not None and \
+            self.reset > now
+
+    def update(self, status, headers, message=''):
+        """Learn from an answer.  Returns True if the call was refused for
+        the rate limit, and can be made again later."""
+        with self.lock:
+            now = self.clock()
+            try:
+                self.remaining = int(headers['X-RateLimit-Remaining'])
+                self.reset = float(headers['X-RateLimit-Reset'])
+            except (KeyError, ValueError):
+                pass
+
+            if status not in (403, 429):
+                if status < 400:
+                    self.backoffs = 0
+                return False
+            if 'Retry-After' in headers:
+                try:
+                    wait = float(headers['Retry-After'])
+                except ValueError:
+                    wait = SECONDARY_BACKOFF
+            elif headers.get('X-RateLimit-Remaining') == '0' and \
+                    self.reset is not None:
+                wait = self.reset - now
+            elif status == 429 or 'rate limit' in message.lower():
+                wait = min(SECONDARY_BACKOFF * 2 ** self.backoffs,
+                           MAX_BACKOFF)
+                self.backoffs += 1
+            else:
+                # forbidden for some other reason
+                return False
+            self.blocked_until = max(self.blocked_until, now + max(wait, 0))
+            return True
@@ -0,0 +1,277 @@
+"""
+Server settings, read from the environment once at startup.
+
+GH_REPO - the repository where you have your website, including the name
+  or org.  In my case it's drivet/website-11ty
+GH_USERNAME - username on github
+GH_PASSWORD - the token you generate on Github
+MICROPUB_BRANCH - the branch to commit to (default main)
+
+MICROPUB_CONFIG - json file with the syndicate-to targets and
+  media-endpoint to advertise (default run/config.json)
+MICROPUB_MEDIA_ENDPOINT - the endpoint where you will upload media,
+  overrides the one in MICROPUB_CONFIG.  Point it at this server's /media
+  to use the built-in one
+MICROPUB_REPO_PATH_FORMAT - the format to use for the newly saved file
+  paths.  In my case it's
+  src/posts/feed/{published:%Y}/{published:%Y}{published:%m}{published:%d}{published:%H}{published:%M}{published:%S}.{ext}
+MICROPUB_PERMALINK_FORMAT - the format of post permalinks, relative to ME
+MICROPUB_POST_FORMAT - how post files are written: yaml (front matter, the
+  default), toml (front matter between +++ lines) or json (the mf2 object
+  as it is)
+MICROPUB_POST_FORMATS - comma separated pattern=format pairs overriding
+  MICROPUB_POST_FORMAT for repo paths matching the (fnmatch) pattern, the
+  first match winning, e.g. *.mpj=json,content/events/*=toml
+
+MICROPUB_BACKEND - github (the default) to commit through the GitHub API,
+  or local to commit into a bare clone at MICROPUB_LOCAL_REPO (default
+  /data/repo) and push to MICROPUB_GIT_REMOTE every MICROPUB_PUSH_INTERVAL
+  seconds.  See micropub/backend.py
+MICROPUB_QUEUE_DIR - if set, posts are journaled here and committed in the
+  background instead of during the request.  In docker it's /data/queue
+MICROPUB_BATCH_WINDOW - seconds to wait for more queued posts before
+  committing them together (default 0, no batching)
+MICROPUB_BATCH_SIZE - max number of queued posts in one commit (default 10)
+MICROPUB_QUEUE_ATTEMPTS - failed commits of a queued post before it's moved
+  to the failed/ subdirectory of the queue (default 10)
+
+MICROPUB_MAX_BODY_SIZE - bigger micropub requests are refused with a 413
+  (default 10MB)
+MICROPUB_SPOOL_SIZE - posts with more content than this are written to a
+  temporary file and streamed from there, rather than built up in memory
+  (default 1MB)
+
+MICROPUB_INDEX - the sqlite database mapping permalinks to repo paths,
+  for updates and deletes.  In docker it's /data/index.sqlite
+MICROPUB_SOURCE_CACHE_SIZE - how many recently written or read posts each
+  worker keeps for q=source and updates (default 256)
+
+MICROPUB_IDEMPOTENCY_DB - the sqlite database of recently handled create
+  requests, so client retries don't make duplicate posts.  In docker it's
+  /data/idempotency.sqlite
+MICROPUB_IDEMPOTENCY_TTL - seconds a request is remembered (default 3600)
+MICROPUB_IDEMPOTENCY_SIZE - max number of requests remembered (default
+  10000)
+
+MICROPUB_METRICS_DIR - where each worker process writes its metrics for
+  /metrics to add up (default micropub-metrics in the temp directory)
+MICROPUB_METRICS_TOKEN - if set, /metrics wants it as a bearer token
+
+MICROPUB_MEDIA_DIR - where uploads to the built-in /media endpoint are kept
+  until they're committed.  In docker it's /data/media
+MICROPUB_MEDIA_PATH_FORMAT - the repo path for uploaded files, with the
+  fields published, name and ext
+MICROPUB_MEDIA_URL_FORMAT - the URL of uploaded files on the site,
+  relative to ME, with the same fields
+MICROPUB_MEDIA_MAX_SIZE - bigger uploads are refused with a 413 (default
+  25MB)
+MICROPUB_MEDIA_WIDTHS - comma separated widths of the smaller copies made
+  of each uploaded image (default 480,960,1920)
+MICROPUB_MEDIA_WORKERS - number of processes resizing images (default 2, 0
+  to do it during the upload request)
+"""
+import datetime
+import fnmatch
+import os
+import re
+import tempfile
+from string import Formatter
+from typing import Callable, NamedTuple, Optional, Tuple
+from micropub.format import FORMATS
+
+DEFAULT_REPO_PATH_FORMAT = 'content/micropub/' + \
+    '{published:%Y}/{published:%m}/{published:%d}/' + \
+    '{published:%H}{published:%M}{published:%S}.{ext}'
+
+DEFAULT_MEDIA_PATH_FORMAT = \
+    'content/media/{published:%Y}/{published:%m}/{name}.{ext}'
+
+DEFAULT_MEDIA_URL_FORMAT = 'media/{published:%Y}/{published:%m}/{name}.{ext}'
+
+DEFAULT_PERMALINK_FORMAT = \
+    '{published:%Y}/{published:%m}/{published:%d}/{slug}'
+
+DEFAULT_CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'run', 'config.json')
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Settings(NamedTuple):
+    repo: str
+    username: str
+    password: Optional[str]
+    branch: str
+    config_path: str
+    media_endpoint: Optional[str]
+    repo_path_format: str
+    permalink_format: str
+    # repo_path_format.format and permalink_format.format, once validated
+    format_repo_path: Callable[..., str]
+    format_permalink: Callable[..., str]
+    # the output format of a repo path
+    post_format: Callable[[str], str]
+    backend: str
+    local_repo: str
+    git_remote: Optional[str]
+    push_interval: float
+    queue_dir: Optional[str]
+    batch_window: float
+    batch_size: int
+    queue_attempts: int
+    max_body_size: int
+    spool_size: int
+    index_path: str
+    source_cache_size: int
+    idempotency_path: str
+    idempotency_ttl: float
+    idempotency_size: int
+    metrics_dir: str
+    metrics_token: Optional[str]
+    media_dir: str
+    media_path_format: str
+    media_url_format: str
+    format_media_path: Callable[..., str]
+    format_media_url: Callable[..., str]
+    media_max_size: int
+    media_widths: Tuple[int, ...]
+    media_workers: int
+
+
+def load_settings(environ=os.environ):
+    """Build the settings from environ, raising ConfigError if anything is
+    missing or malformed."""
+    for name in ('GH_REPO', 'GH_USERNAME'):
+        if not environ.get(name):
+            raise ConfigError(f'{name} must be set')
+
+    repo_path_format = environ.get('MICROPUB_REPO_PATH_FORMAT',
+                                   DEFAULT_REPO_PATH_FORMAT)
+    permalink_format = environ.get('MICROPUB_PERMALINK_FORMAT',
+                                   DEFAULT_PERMALINK_FORMAT)
+    media_path_format = environ.get('MICROPUB_MEDIA_PATH_FORMAT',
+                                    DEFAULT_MEDIA_PATH_FORMAT)
+    media_url_format = environ.get('MICROPUB_MEDIA_URL_FORMAT',
+                                   DEFAULT_MEDIA_URL_FORMAT)
+    backend = environ.get('MICROPUB_BACKEND', 'github')
+    if backend not in ('github', 'local'):
+        raise ConfigError(f'Unknown MICROPUB_BACKEND: {backend}')
+
+    return Settings(
+        repo=environ['GH_REPO'],
+        username=environ['GH_USERNAME'],
+        password=environ.get('GH_PASSWORD'),
+        branch=environ.get('MICROPUB_BRANCH') or 'main',
+        config_path=environ.get('MICROPUB_CONFIG', DEFAULT_CONFIG_PATH),
+        media_endpoint=environ.get('MICROPUB_MEDIA_ENDPOINT'),
+        repo_path_format=repo_path_format,
+        permalink_format=permalink_format,
+        format_repo_path=compile_format('MICROPUB_REPO_PATH_FORMAT',
+                                        repo_path_format,
+                                        {'published', 'slug', 'ext'}),
+        format_permalink=compile_format('MICROPUB_PERMALINK_FORMAT',
+                                        permalink_format,
+                                        {'published', 'slug'}),
+        post_format=post_formats(environ),
+        backend=backend,
+        local_repo=environ.get('MICROPUB_LOCAL_REPO', '/data/repo'),
+        git_remote=environ.get('MICROPUB_GIT_REMOTE'),
+        push_interval=number(environ, 'MICROPUB_PUSH_INTERVAL', float, 5),
+        queue_dir=environ.get('MICROPUB_QUEUE_DIR') or None,
+        batch_window=number(environ, 'MICROPUB_BATCH_WINDOW', float, 0),
+        batch_size=number(environ, 'MICROPUB_BATCH_SIZE', int, 10),
+        queue_attempts=number(environ, 'MICROPUB_QUEUE_ATTEMPTS', int, 10),
+        max_body_size=number(environ, 'MICROPUB_MAX_BODY_SIZE', int,
+                             10 * 1024 * 1024),
+        spool_size=number(environ, 'MICROPUB_SPOOL_SIZE', int, 1024 * 1024),
+        index_path=environ.get('MICROPUB_INDEX') or
+        os.path.join(tempfile.gettempdir(), 'micropub-index.sqlite'),
+        source_cache_size=number(environ, 'MICROPUB_SOURCE_CACHE_SIZE', int,
+                                 256),
+        idempotency_path=environ.get('MICROPUB_IDEMPOTENCY_DB') or
+        os.path.join(tempfile.gettempdir(), 'micropub-idempotency.sqlite'),
+        idempotency_ttl=number(environ, 'MICROPUB_IDEMPOTENCY_TTL', float,
+                               3600),
+        idempotency_size=number(environ, 'MICROPUB_IDEMPOTENCY_SIZE', int,
+                                10000),
+        metrics_dir=environ.get('MICROPUB_METRICS_DIR') or
+        os.path.join(tempfile.gettempdir(), 'micropub-metrics'),
+        metrics_token=environ.get('MICROPUB_METRICS_TOKEN') or None,
+        media_dir=environ.get('MICROPUB_MEDIA_DIR') or
+        os.path.join(tempfile.gettempdir(), 'micropub-media'),
+        media_path_format=media_path_format,
+        media_url_format=media_url_format,
+        format_media_path=compile_format('MICROPUB_MEDIA_PATH_FORMAT',
+                                         media_path_format,
+                                         {'published', 'name', 'ext'}),
+        format_media_url=compile_format('MICROPUB_MEDIA_URL_FORMAT',
+                                        media_url_format,
+                                        {'published', 'name', 'ext'}),
+        media_max_size=number(environ, 'MICROPUB_MEDIA_MAX_SIZE', int,
+                              25 * 1024 * 1024),
+        media_widths=widths(environ, 'MICROPUB_MEDIA_WIDTHS',
+                            (480, 960, 1920)),
+        media_workers=number(environ, 'MICROPUB_MEDIA_WORKERS', int, 2))
+
+
+def compile_format(name, fmt, fields):
+    """Check that fmt only uses the given fields and formats a sample post
+    cleanly, and return its format method."""
+    try:
+        used = {re.split(r'[.\[]', f)[0]
+                for _, f, _, _ in Formatter().parse(fmt) if f is not None}
+    except ValueError as e:
+        raise ConfigError(f'{name} is malformed: {e}')
+    unknown = used - fields
+    if unknown:
+        raise ConfigError(f'{name} uses unknown fields: '
+                          f'{", ".join(sorted(unknown))}')
+    sample = {'published': datetime.datetime(2019, 8, 15, 14, 35, 45),
+              'slug': 'slug', 'name': 'name', 'ext': 'md'}
+    try:
+        fmt.format(**sample)
+    except (ValueError, KeyError, IndexError) as e:
+        raise ConfigError(f'{name} is malformed: {e}')
+    return fmt.format
+
+
+def post_formats(environ):
+    """Return a function picking the output format of a repo path."""
+    default = environ.get('MICROPUB_POST_FORMAT', 'yaml')
+    if default not in FORMATS:
+        raise ConfigError(f'Unknown MICROPUB_POST_FORMAT: {default}')
+    rules = []
+    for item in environ.get('MICROPUB_POST_FORMATS', '').split(','):
+        if not item.strip():
+            continue
+        pattern, _, fmt = item.strip().rpartition('=')
+        if not pattern or fmt not in FORMATS:
+            raise ConfigError(f'MICROPUB_POST_FORMATS is malformed: {item}')
+        rules.append((pattern, fmt))
+
+    def post_format(path):
+        for pattern, fmt in rules:
+            if fnmatch.fnmatchcase(path, pattern):
+                return fmt
+        return default
+    return post_format
+
+
+def number(environ, name, kind, default):
+    try:
+        return kind(environ.get(name, default))
+    except ValueError:
+        raise ConfigError(f'{name} must be a number')
+
+
+def widths(environ, name, default):
+    if name not in environ:
+        return default
+    try:
+        return tuple(sorted(int(w) for w in environ[name].split(',')
+                            if w.strip()))
+    except ValueError:
+        raise ConfigError(f'{name} must be a list of numbers')
@@ -0,0 +1,184 @@
+import asyncio
+import io
+import os
+import tempfile
+from unittest.mock import patch
+import httpx
+import micropub.micropub
+from micropub import app, configure, asyncgithub
+from micropub import commit as gh
+from micropub.asgi import make_app
+from micropub.fakegithub import FakeGitHub
+from micropub.postindex import PostIndex
+
+
+server = None
+repo = 'drivet/async-blog'
+api_root = None
+
+
+def setup_module():
+    global server, api_root
+    server = FakeGitHub(branch='main').start()
+    api_root = patch('micropub.commit.GITHUB_API_ROOT', server.url)
+    api_root.start()
+    app.config['TESTING'] = True
+    app.config['ME'] = 'https://mysite.com'
+    configure({
+        'GH_REPO': repo,
+        'GH_USERNAME': 'dude',
+        'GH_PASSWORD': 'amazing_password',
+        'MICROPUB_REPO_PATH_FORMAT': 'content/{published:%Y}/{slug}.{ext}',
+        'MICROPUB_PERMALINK_FORMAT': '{published:%Y}/{slug}',
+        'MICROPUB_INDEX': os.path.join(tempfile.mkdtemp(), 'index.sqlite'),
+        'MICROPUB_IDEMPOTENCY_DB': os.path.join(tempfile.mkdtemp(),
+                                                'idempotency.sqlite'),
+        'MICROPUB_METRICS_DIR': tempfile.mkdtemp(),
+        'MICROPUB_MEDIA_DIR': tempfile.mkdtemp(),
+        'MICROPUB_MEDIA_WORKERS': '0'
+    })
+
+
+def teardown_module():
+    api_root.stop()
+    server.stop()
+
+
+def call(method, url, **kwargs):
+    async def go():
+        transport = httpx.ASGITransport(app=make_app(app))
+        try:
+            async with httpx.AsyncClient(transport=transport,
+                                         base_url='http://test') as client:
+                return await client.request(method, url, **kwargs)
+        finally:
+            await asyncgithub.close()
+    return asyncio.run(go())
+
+
+def test_create_commits_through_async_client():
+    rv = call('POST', '/', data={'content': 'hello async',
+                                 'mp-slug': 'hello',
+                                 'published': '2019-07-16T13:45:23'})
+    assert rv.status_code == 202
+    assert rv.headers['Location'] == 'https://mysite.com/2019/hello'
+    files = server.repo(repo).files()
+    assert files['content/2019/hello.md'].endswith(b'hello async')
+
+
+def test_create_without_head_cache():
+    with patch('micropub.commit.HEAD_CACHE_TTL', 0):
+        rv = call('POST', '/', data={'content': 'uncached',
+                                     'mp-slug': 'uncached',
+                                     'published': '2019-07-16T13:45:23'})
+    assert rv.status_code == 202
+    files = server.repo(repo).files()
+    assert files['content/2019/uncached.md'].endswith(b'uncached')
+
+
+def test_json_create_with_several_at_once():
+    async def go():
+        transport = httpx.ASGITransport(app=make_app(app))
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://test') as client:
+            posts = [client.post('/', json={
+                'type': ['h-entry'],
+                'properties': {'content': [f'post {n}'],
+                               'mp-slug': [f'post-{n}'],
+                               'published': ['2019-07-17T13:45:23']}})
+                for n in range(5)]
+            results = await asyncio.gather(*posts)
+        await asyncgithub.close()
+        return results
+
+    for rv in asyncio.run(go()):
+        assert rv.status_code == 202
+    files = server.repo(repo).files()
+    for n in range(5):
+        assert files[f'content/2019/post-{n}.md'].endswith(
+            f'post {n}'.encode())
+
+
+def test_big_post_streamed_up():
+    with patch('micropub.micropub.settings',
+                  micropub.micropub.settings._replace(spool_size=100)), \
+            patch('micropub.commit.INLINE_SIZE', 100):
+        rv = call('POST', '/', data={'content': 'big ' * 1000,
+                                     'mp-slug': 'big',
+                                     'published': '2019-07-18T13:45:23'})
+    assert rv.status_code == 202
+    files = server.repo(repo).files()
+    assert files['content/2019/big.md'].endswith(b'big ' * 999 + b'big ')
+
+
+def test_source_read_through_async_client():
+    call('POST', '/', data={'content': 'read me', 'mp-slug': 'source',
+                            'published': '2019-07-19T13:45:23'})
+    micropub.micropub.post_cache.clear()
+    server.reset_calls()
+    rv = call('GET', '/', params={'q': 'source',
+                                  'url': 'https://mysite.com/2019/source'})
+    assert rv.status_code == 200
+    assert rv.json()['properties']['content'] == ['read me']
+    assert [m for m, path in server.calls] == ['GET']
+
+
+def test_cold_index_rebuilt_through_async_client():
+    gh.commit(repo, ('dude', 'amazing_password'),
+              {'content/2019/cold.md': '---\ntitle: cold\n---\n\nbrr'},
+              'outside post', 'main')
+    index = PostIndex(os.path.join(tempfile.mkdtemp(), 'index.sqlite'))
+    with patch('micropub.micropub.post_index', index), \
+            patch('micropub.backend.list_files',
+                  side_effect=AssertionError('listed on the event loop')):
+        rv = call('GET', '/', params={'q': 'source',
+                                      'url': 'https://mysite.com/2019/cold'})
+    assert rv.status_code == 200
+    assert rv.json()['properties']['content'] == ['brr']
+    assert index.is_built()
+
+
+def test_queries_and_errors_answered():
+    rv = call('GET', '/', params={'q': 'config'})
+    assert rv.status_code == 200
+    assert 'syndicate-to' in rv.json()
+    assert call('GET', '/', params={'q': 'nonsense'}).status_code == 400
+    rv = call('POST', '/', content=b'{"type": ',
+              headers={'Content-Type': 'application/json'})
+    assert rv.status_code == 400
+
+
+def test_other_requests_go_to_flask():
+    call('POST', '/', data={'content': 'doomed', 'mp-slug': 'doomed',
+                            'published': '2019-07-20T13:45:23'})
+    rv = call('POST', '/', data={'action': 'delete',
+                                 'url': 'https://mysite.com/2019/doomed'})
+    assert rv.status_code == 204
+    assert 'content/2019/doomed.md' not in server.repo(repo).files()
+    rv = call('POST', '/media',
+              files={'file': ('a.txt', io.BytesIO(b'hi'), 'text/plain')})
+    assert rv.status_code == 201
+    assert call('GET', '/metrics').status_code == 200
+
+
+def test_oversized_post_refused():
+    rv = call('POST', '/', data={'content': 'x' * (11 * 1024 * 1024)})
+    assert rv.status_code == 413
+
+
+def test_token_checked_on_async_client():
+    token_data = {'me': 'https://mysite.com', 'client_id': 'c',
+                  'scope': 'create'}
+
+    async def fetch_token(access_token):
+        return token_data if access_token == 'good' else 'invalid'
+
+    with patch.dict(app.config, {'TESTING': False}), \
+            patch('micropub.indieauth.token_cache', None), \
+            patch('micropub.indieauth.fetch_token_async', fetch_token):
+        rv = call('GET', '/', params={'q': 'config'},
+                  headers={'Authorization': 'Bearer bad'})
+        assert rv.status_code == 400
+        rv = call('GET', '/', params={'q': 'config'},
+                  headers={'Authorization': 'Bearer good'})
+        assert rv.status_code == 200
@@ -0,0 +1,32 @@
+import json
+import os
+import tempfile
+import logging
+from unittest.mock import patch
+from micropub import app
+from micropub.bench import compare, main
+
+
+def test_compare():
+    baseline = {'make_post': {'p50': 1.0}, 'form2json': {'p50': 1.0}}
+    results = {'make_post': {'p50': 1.1}, 'form2json': {'p50': 2.0},
+               'handle_create': {'p50': 5.0}}
+    assert compare(results, baseline, 1.25) == ['form2json']
+
+
+def test_bench_saves_and_compares():
+    me = app.config.get('ME')
+    baseline = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+    with patch('micropub.commit.GITHUB_API_ROOT'):
+        assert main(['--iterations', '2', '--baseline', baseline,
+                     '--save']) == 0
+        with open(baseline) as f:
+            saved = json.load(f)
+        assert saved['latency'] == 0.0
+        assert sorted(saved['stages']) == ['extract_create_request',
+                                           'form2json', 'handle_create',
+                                           'make_post']
+        assert main(['--iterations', '2', '--baseline', baseline,
+                     '--tolerance', '1000']) == 0
+    app.config['ME'] = me
+    app.logger.setLevel(logging.INFO)
@@ -0,0 +1,343 @@
+import io
+import threading
+import time
+from unittest.mock import patch
+from micropub import commit as gh
+from micropub import metrics
+from micropub.fakegithub import FakeGitHub, git_sha
+
+
+server = None
+repo = 'drivet/test-blog'
+auth = ('dude', 'amazing_password')
+
+
+def setup_module():
+    global server
+    server = FakeGitHub().start()
+
+
+def teardown_module():
+    server.stop()
+
+
+def do_commit(files, message='new post'):
+    with patch('micropub.commit.GITHUB_API_ROOT', server.url):
+        gh.commit(repo, auth, files, message, 'main')
+
+
+def test_commit_adds_files_to_branch():
+    do_commit({'content/post.md': 'hello'})
+    files = server.repo(repo).files()
+    assert files['content/post.md'] == b'hello'
+
+
+def test_commit_keeps_existing_files():
+    do_commit({'content/one.md': 'one'})
+    do_commit({'content/two.md': 'two'})
+    files = server.repo(repo).files()
+    assert files['content/one.md'] == b'one'
+    assert files['content/two.md'] == b'two'
+
+
+def test_commit_reuses_one_connection():
+    gh.get_session()
+    before = server.connections
+    do_commit({'content/a.md': 'a'})
+    do_commit({'content/b.md': 'b'})
+    assert server.connections - before <= 1
+
+
+def test_session_accepts_gzip():
+    assert 'gzip' in gh.get_session().headers['Accept-Encoding']
+
+
+def test_failed_call_raises():
+    with patch('micropub.commit.GITHUB_API_ROOT', server.url):
+        try:
+            gh.get(f'{server.url}/nowhere', auth)
+        except Exception as e:
+            assert '404' in str(e)
+        else:
+            assert False
+
+
+def test_cached_head_skips_lookups():
+    do_commit({'content/c.md': 'c'})
+    server.reset_calls()
+    do_commit({'content/d.md': 'd'})
+    methods = [method for method, path in server.calls]
+    # the text is inline in the tree request
+    assert methods == ['POST', 'POST', 'PATCH']
+
+
+def test_commit_refetches_head_moved_elsewhere():
+    do_commit({'content/e.md': 'e'})
+    fake = server.repo(repo)
+    head = fake.refs['main']
+    tree = dict(fake.trees[fake.commits[head]['tree']])
+    tree['content/other.md'] = fake.add_blob(b'other')
+    fake.refs['main'] = fake.add_commit('elsewhere', fake.add_tree(tree),
+                                        [head])
+    do_commit({'content/f.md': 'f'})
+    files = fake.files()
+    assert files['content/other.md'] == b'other'
+    assert files['content/f.md'] == b'f'
+
+
+def test_refused_ref_updates_are_retried():
+    real_update = gh.update_branch
+    failures = []
+
+    def flaky_update(*args):
+        if len(failures) < 2:
+            failures.append(args)
+            raise gh.GitHubError('Update is not a fast forward', 422)
+        return real_update(*args)
+
+    with patch('micropub.commit.update_branch', flaky_update), \
+            patch('micropub.commit.RETRY_DELAY', 0.001):
+        do_commit({'content/g.md': 'g'})
+    assert len(failures) == 2
+    assert server.repo(repo).files()['content/g.md'] == b'g'
+
+
+def test_retries_are_bounded():
+    def refused_update(*args):
+        raise gh.GitHubError('Update is not a fast forward', 422)
+
+    with patch('micropub.commit.update_branch', refused_update), \
+            patch('micropub.commit.RETRY_DELAY', 0.001), \
+            patch('micropub.commit.COMMIT_RETRIES', 2):
+        try:
+            do_commit({'content/h.md': 'h'})
+        except gh.StaleHead as e:
+            assert e.status_code == 422
+        else:
+            assert False
+
+
+def test_invalid_trees_are_not_retried():
+    calls = []
+
+    def invalid_tree(*args):
+        calls.append(args)
+        raise gh.GitHubError('Invalid tree info', 422)
+
+    with patch('micropub.commit.create_tree', invalid_tree):
+        try:
+            do_commit({'content/h.md': 'h'})
+        except gh.GitHubError as e:
+            assert e.permanent
+        else:
+            assert False
+    assert len(calls) == 1
+
+
+def test_concurrent_commits_all_land():
+    def racing_commit(n):
+        # every thread starts from the same, soon to be stale, head
+        gh.forget_head(repo, 'main')
+        gh.commit(repo, auth, {f'content/race{n}.md': str(n)}, 'new post',
+                  'main')
+
+    with patch('micropub.commit.GITHUB_API_ROOT', server.url), \
+            patch('micropub.commit.RETRY_DELAY', 0.001):
+        threads = [threading.Thread(target=racing_commit, args=(n,))
+                   for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    files = server.repo(repo).files()
+    for n in range(8):
+        assert files[f'content/race{n}.md'] == str(n).encode()
+
+
+def test_commit_streams_files_and_bytes():
+    big = io.BytesIO(bytes(range(256)) * 1000)
+    do_commit({'content/big.bin': big, 'content/small.bin': b'\x00\x01'})
+    files = server.repo(repo).files()
+    assert files['content/big.bin'] == bytes(range(256)) * 1000
+    assert files['content/small.bin'] == b'\x00\x01'
+
+
+def test_commit_deletes_files():
+    do_commit({'content/doomed.md': 'bye'})
+    do_commit({'content/doomed.md': None}, 'delete post')
+    assert 'content/doomed.md' not in server.repo(repo).files()
+
+
+def test_read_and_list_files():
+    do_commit({'content/readme.md': 'read me'})
+    with patch('micropub.commit.GITHUB_API_ROOT', server.url):
+        assert gh.read_file(repo, auth, 'content/readme.md', 'main') == \
+            b'read me'
+        assert gh.read_file(repo, auth, 'content/nothing.md', 'main') is None
+        assert 'content/readme.md' in gh.list_files(repo, auth, 'main')
+
+
+def test_blob_sha_computed_locally():
+    data = 'caf\u00e9\n' * 100
+    assert gh.blob_sha(data) == git_sha('blob', data.encode('utf-8'))
+    assert gh.blob_sha(b'\0\1') == git_sha('blob', b'\0\1')
+    f = io.BytesIO(bytes(range(256)) * 1000)
+    assert gh.blob_sha(f) == git_sha('blob', bytes(range(256)) * 1000)
+    assert f.tell() == 0
+
+
+def test_only_binary_and_large_files_uploaded():
+    server.reset_calls()
+    with patch('micropub.commit.INLINE_SIZE', 10):
+        do_commit({'content/inline.md': 'short',
+                   'content/long.md': 'much too long',
+                   'content/binary.bin': b'\xff\xfe'})
+    blob_posts = [path for method, path in server.calls
+                  if method == 'POST' and '/git/blobs' in path]
+    assert len(blob_posts) == 2
+    files = server.repo(repo).files()
+    assert files['content/inline.md'] == b'short'
+    assert files['content/long.md'] == b'much too long'
+    assert files['content/binary.bin'] == b'\xff\xfe'
+
+
+def test_unchanged_files_not_committed_again():
+    do_commit({'content/same.md': 'same', 'content/same.bin': b'\0same'})
+    head = server.repo(repo).refs['main']
+    server.reset_calls()
+    do_commit({'content/same.md': 'same', 'content/same.bin': b'\0same'})
+    # only the head is checked
+    assert [method for method, path in server.calls] == ['GET', 'GET']
+    assert server.repo(repo).refs['main'] == head
+
+    # without knowing the head, only the tree is made
+    gh.forget_head(repo, 'main')
+    server.reset_calls()
+    do_commit({'content/same.md': 'same', 'content/same.bin': b'\0same'})
+    assert [method for method, path in server.calls] == ['GET', 'GET', 'POST']
+    assert server.repo(repo).refs['main'] == head
+
+
+def test_unchanged_files_checked_against_moved_head():
+    do_commit({'content/undeleted.md': 'back'})
+    # deleted by another worker, behind our cached head's back
+    fake = server.repo(repo)
+    head = fake.refs['main']
+    tree = dict(fake.trees[fake.commits[head]['tree']])
+    del tree['content/undeleted.md']
+    fake.refs['main'] = fake.add_commit('delete post', fake.add_tree(tree),
+                                        [head])
+    do_commit({'content/undeleted.md': 'back'}, 'undelete post')
+    assert fake.files()['content/undeleted.md'] == b'back'
+
+
+def test_known_blobs_not_uploaded_again():
+    do_commit({'content/first.bin': b'\0copy'})
+    server.reset_calls()
+    do_commit({'content/second.bin': b'\0copy'})
+    assert not any('/git/blobs' in path for method, path in server.calls)
+    assert server.repo(repo).files()['content/second.bin'] == b'\0copy'
+
+
+@patch('micropub.metrics.directory', None)
+def test_github_calls_are_timed():
+    metrics._histograms.clear()
+    metrics._counters.clear()
+    do_commit({'content/timed.md': 'hello', 'content/timed.bin': b'\0'})
+    histograms, counters = metrics.collect()
+    calls = {dict(labels)['call'] for name, labels in histograms
+             if name == 'micropub_github_request_seconds'}
+    assert calls == {'blob', 'tree', 'commit', 'update'}
+    with patch('micropub.commit.GITHUB_API_ROOT', server.url):
+        gh.read_file(repo, auth, 'content/nothing.md', 'main')
+    histograms, counters = metrics.collect()
+    assert counters[('micropub_github_failures_total',
+                     (('call', 'contents'), ('status', '404')))] == 1
+
+
+@patch('micropub.commit._rate_limiter', None)
+def test_rate_limited_call_made_again():
+    server.refuse(1, 429, {'Retry-After': '0'})
+    big = io.BytesIO(b'streamed twice' * 1000)
+    do_commit({'content/limited.bin': big})
+    assert server.repo(repo).files()['content/limited.bin'] == \
+        b'streamed twice' * 1000
+
+
+@patch('micropub.commit._rate_limiter', None)
+def test_long_rate_limit_defers_commit():
+    server.refuse(1, 403, {'Retry-After': '600'})
+    try:
+        do_commit({'content/deferred.md': 'later'})
+    except gh.RateLimited as e:
+        assert e.retry_after > 500
+    else:
+        assert False
+    assert 'content/deferred.md' not in server.repo(repo).files()
+
+
+def slow_upload(delay, fail=()):
+    started = []
+
+    def create_blob(repo, auth, contents):
+        started.append(contents)
+        if contents in fail:
+            raise gh.GitHubError('Server Error', 500)
+        time.sleep(delay)
+        return {'sha': git_sha('blob', contents)}
+    return create_blob, started
+
+
+def test_blobs_uploaded_side_by_side():
+    create_blob, started = slow_upload(0.2)
+    files = {f'content/photo{n}.jpg': b'\xff' + bytes([n]) for n in range(4)}
+    with patch('micropub.commit.create_blob', create_blob), \
+            patch('micropub.commit._upload_pool', None), \
+            patch('micropub.commit.POOL_SIZE', 4):
+        start = time.monotonic()
+        entries = gh.tree_entries(repo, auth, files)
+        assert time.monotonic() - start < 0.6
+    assert list(entries) == list(files)
+    for path, (sha, entry) in entries.items():
+        assert sha == entry['sha'] == git_sha('blob', files[path])
+
+
+def test_failed_upload_cancels_commit():
+    create_blob, started = slow_upload(0.1, fail=(b'\xffbad',))
+    files = {'content/bad.jpg': b'\xffbad'}
+    files.update((f'content/photo{n}.jpg', b'\xfe' + bytes([n]))
+                 for n in range(10))
+    with patch('micropub.commit.create_blob', create_blob), \
+            patch('micropub.commit._upload_pool', None), \
+            patch('micropub.commit.POOL_SIZE', 2):
+        try:
+            do_commit(files)
+        except gh.UploadFailed as e:
+            assert list(e.errors) == ['content/bad.jpg']
+            assert e.status_code == 500
+        else:
+            assert False
+    # the uploads waiting their turn were dropped
+    assert len(started) < len(files)
+    assert 'content/photo0.jpg' not in server.repo(repo).files()
+
+
+def test_rate_limited_upload_still_rate_limited():
+    def create_blob(repo, auth, contents):
+        raise gh.RateLimited('slow down', 429, 30)
+
+    with patch('micropub.commit.create_blob', create_blob):
+        try:
+            gh.tree_entries(repo, auth, {'a.bin': b'\xffa', 'b.bin': b'\xffb'})
+        except gh.RateLimited as e:
+            assert e.retry_after == 30
+        else:
+            assert False
+
+
+def test_client_errors_are_permanent():
+    assert gh.GitHubError('Not Found', 404).permanent
+    assert not gh.GitHubError('Server Error', 502).permanent
+    assert gh.GitHubError('Blob does not exist', 422).permanent
+    assert not gh.StaleHead('Update is not a fast forward', 422).permanent
+    assert not gh.RateLimited('slow down', 429, 60).permanent
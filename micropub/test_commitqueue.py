@@ -0,0 +1,296 @@
+import io
+import os
+import tempfile
+import time
+from micropub.commitqueue import CommitQueue
+
+
+class Recorder:
+    def __init__(self, fail=False):
+        self.commits = []
+        self.fail = fail
+
+    def __call__(self, files, message):
+        if self.fail:
+            raise Exception('GitHub is down')
+        self.commits.append((files, message))
+
+
+def make_queue(commit_fn):
+    return CommitQueue(tempfile.mkdtemp(), commit_fn, poll_interval=0.05,
+                       retry_delay=0.05)
+
+
+def test_put_journals_entry():
+    queue = make_queue(Recorder())
+    queue.start = lambda: None
+    queue.put({'a.md': 'hello'}, 'new post')
+    assert queue.depth() == 1
+
+
+def test_drain_commits_in_order():
+    recorder = Recorder()
+    queue = make_queue(recorder)
+    queue.start = lambda: None
+    queue.put({'a.md': 'a'}, 'first')
+    queue.put({'b.md': 'b'}, 'second')
+    assert queue.drain() == 2
+    assert recorder.commits == [({'a.md': 'a'}, 'first'),
+                                ({'b.md': 'b'}, 'second')]
+    assert queue.depth() == 0
+
+
+def test_failed_commit_stays_queued():
+    queue = make_queue(Recorder(fail=True))
+    queue.start = lambda: None
+    queue.put({'a.md': 'a'}, 'first')
+    try:
+        queue.drain()
+    except Exception:
+        pass
+    assert queue.depth() == 1
+
+
+def test_entry_is_committed_once_across_queues():
+    recorder = Recorder()
+    first = make_queue(recorder)
+    first.start = lambda: None
+    second = CommitQueue(first.directory, recorder)
+    first.put({'a.md': 'a'}, 'first')
+    name = first.pending()[0]
+    claimed = first.claim(name)
+    assert second.drain() == 0
+    claimed[0].close()
+    assert second.drain() == 1
+    assert first.drain() == 0
+    assert len(recorder.commits) == 1
+
+
+def test_worker_drains_in_background():
+    recorder = Recorder()
+    queue = make_queue(recorder)
+    queue.put({'a.md': 'a'}, 'first')
+    for _ in range(100):
+        if recorder.commits:
+            break
+        time.sleep(0.01)
+    assert recorder.commits == [({'a.md': 'a'}, 'first')]
+
+
+def test_pending_entries_are_batched():
+    recorder = Recorder()
+    queue = make_queue(recorder)
+    queue.batch_size = 2
+    queue.start = lambda: None
+    queue.put({'a.md': 'a'}, 'new post', 'https://mysite.com/a')
+    queue.put({'b.md': 'b'}, 'new post', 'https://mysite.com/b')
+    queue.put({'c.md': 'c'}, 'new post', 'https://mysite.com/c')
+    assert queue.drain() == 3
+    assert len(recorder.commits) == 2
+    files, message = recorder.commits[0]
+    assert files == {'a.md': 'a', 'b.md': 'b'}
+    assert message == 'batch of 2 posts\n\n' + \
+        'new post: https://mysite.com/a\nnew post: https://mysite.com/b'
+    assert recorder.commits[1] == ({'c.md': 'c'}, 'new post')
+
+
+def test_worker_waits_for_batch_window():
+    recorder = Recorder()
+    queue = make_queue(recorder)
+    queue.batch_size = 10
+    queue.batch_window = 0.3
+    queue.put({'a.md': 'a'}, 'new post', 'https://mysite.com/a')
+    queue.put({'b.md': 'b'}, 'new post', 'https://mysite.com/b')
+    for _ in range(100):
+        if recorder.commits:
+            break
+        time.sleep(0.01)
+    assert len(recorder.commits) == 1
+    assert recorder.commits[0][0] == {'a.md': 'a', 'b.md': 'b'}
+
+
+def test_files_are_journaled_as_blobs():
+    contents = []
+
+    def read_commit(files, message):
+        contents.append({path: f.read() if hasattr(f, 'read') else f
+                         for path, f in files.items()})
+
+    queue = make_queue(read_commit)
+    queue.start = lambda: None
+    queue.put({'a.md': io.BytesIO(b'big post'), 'b.jpg': b'\xff\xd8',
+               'c.md': 'small post'}, 'new post')
+    assert queue.drain() == 1
+    assert contents == [{'a.md': b'big post', 'b.jpg': b'\xff\xd8',
+                         'c.md': 'small post'}]
+    assert os.listdir(queue.directory) == []
+
+
+def test_find_returns_newest_pending_contents():
+    queue = make_queue(Recorder())
+    queue.start = lambda: None
+    queue.put({'a.md': 'first'}, 'new post')
+    queue.put({'a.md': b'second', 'b.md': None}, 'update post')
+    assert queue.find('a.md') == b'second'
+    assert queue.find('b.md') is None
+    try:
+        queue.find('c.md')
+    except KeyError:
+        pass
+    else:
+        assert False
+
+
+class Deferred(Exception):
+    retry_after = 0.01
+
+
+def test_retry_after_overrides_retry_delay():
+    attempts = []
+
+    def commit_later(files, message):
+        attempts.append(message)
+        if len(attempts) == 1:
+            raise Deferred()
+
+    queue = CommitQueue(tempfile.mkdtemp(), commit_later, poll_interval=0.05,
+                        retry_delay=1000)
+    queue.put({'a.md': 'hello'}, 'new post')
+    for _ in range(200):
+        if queue.depth() == 0:
+            break
+        time.sleep(0.01)
+    assert queue.depth() == 0
+    assert attempts == ['new post', 'new post']
+
+
+class Rejected(Exception):
+    permanent = False
+
+
+class Rejecter(Recorder):
+    """Reads the files, and refuses to commit bad.md."""
+    def __init__(self, error=Rejected):
+        super().__init__()
+        self.error = error
+        self.attempts = 0
+
+    def __call__(self, files, message):
+        files = {path: f.read() if hasattr(f, 'read') else f
+                 for path, f in files.items()}
+        if 'bad.md' in files:
+            self.attempts += 1
+            raise self.error('bad.md is bad')
+        super().__call__(files, message)
+
+
+def drain_failing(queue):
+    try:
+        queue.drain()
+    except Exception:
+        return True
+    return False
+
+
+def test_failed_entry_does_not_block_the_rest():
+    recorder = Rejecter()
+    queue = make_queue(recorder)
+    queue.start = lambda: None
+    queue.put({'bad.md': 'bad'}, 'first')
+    queue.put({'a.md': 'a'}, 'second')
+    queue.put({'bad.md': 'fixed'}, 'third')
+    queue.put({'b.md': 'b'}, 'fourth')
+    assert drain_failing(queue)
+    assert recorder.commits == [({'a.md': 'a'}, 'second'),
+                                ({'b.md': 'b'}, 'fourth')]
+    assert queue.depth() == 2
+
+
+def test_entry_is_moved_aside_after_max_attempts():
+    recorder = Rejecter()
+    queue = make_queue(recorder)
+    queue.start = lambda: None
+    queue.max_attempts = 3
+    queue.put({'bad.md': io.BytesIO(b'bad')}, 'first')
+    name = queue.pending()[0]
+    assert drain_failing(queue)
+    assert drain_failing(queue)
+    assert queue.depth() == 1
+    assert drain_failing(queue)
+    assert queue.depth() == 0
+    assert recorder.attempts == 3
+    failed = os.path.join(queue.directory, 'failed')
+    assert sorted(os.listdir(failed)) == \
+        [name, name + '.0.blob', name + '.error']
+    assert os.listdir(queue.directory) == ['failed']
+    assert queue.drain() == 0
+
+
+class Invalid(Exception):
+    permanent = True
+
+
+def test_permanent_failure_is_moved_aside_at_once():
+    queue = make_queue(Rejecter(Invalid))
+    queue.start = lambda: None
+    queue.put({'bad.md': 'bad'}, 'first')
+    assert drain_failing(queue)
+    assert queue.depth() == 0
+    assert len(os.listdir(os.path.join(queue.directory, 'failed'))) == 2
+
+
+def test_deferred_attempts_are_not_counted():
+    queue = make_queue(Rejecter(Deferred))
+    queue.start = lambda: None
+    queue.max_attempts = 1
+    queue.put({'bad.md': 'bad'}, 'first')
+    assert drain_failing(queue)
+    assert drain_failing(queue)
+    assert queue.depth() == 1
+
+
+def test_failed_batch_is_committed_entry_by_entry():
+    recorder = Rejecter()
+    queue = make_queue(recorder)
+    queue.start = lambda: None
+    queue.batch_size = 10
+    queue.put({'a.md': io.BytesIO(b'a')}, 'first')
+    queue.put({'bad.md': 'bad'}, 'second')
+    queue.put({'b.md': 'b'}, 'third')
+    queue.put({'bad.md': 'fixed', 'c.md': 'c'}, 'fourth')
+    assert drain_failing(queue)
+    assert recorder.commits == [({'a.md': b'a'}, 'first'),
+                                ({'b.md': 'b'}, 'third')]
+    assert queue.depth() == 2
+    assert recorder.attempts == 2
+
+
+def test_deferred_batch_is_not_split():
+    recorder = Rejecter(Deferred)
+    queue = make_queue(recorder)
+    queue.start = lambda: None
+    queue.batch_size = 10
+    queue.put({'a.md': 'a'}, 'first')
+    queue.put({'bad.md': 'bad'}, 'second')
+    assert drain_failing(queue)
+    assert recorder.commits == []
+    assert recorder.attempts == 1
+    assert queue.depth() == 2
+
+
+def test_entry_in_flight_elsewhere_is_not_overtaken():
+    recorder = Recorder()
+    first = make_queue(recorder)
+    first.start = lambda: None
+    second = CommitQueue(first.directory, recorder)
+    second.start = lambda: None
+    first.put({'post.md': 'v1'}, 'new post')
+    claimed = first.claim(first.pending()[0])
+    second.put({'post.md': 'v2'}, 'update post')
+    second.put({'other.md': 'other'}, 'new post')
+    assert second.drain() == 1
+    assert recorder.commits == [({'other.md': 'other'}, 'new post')]
+    claimed[0].close()
+    assert second.drain() == 2
+    assert [files for files, message in recorder.commits[1:]] == \
+        [{'post.md': 'v1'}, {'post.md': 'v2'}]
@@ -1,5 +1,9 @@
 
-from micropub.format import make_post
+import json
+import yaml
+from micropub.format import make_post, dump_frontmatter, parse_post, \
+    register_type, plans
+from micropub.post import Post
 
 def assertPost(result, type, fm, content):
     assert result[1] == type
@@ -15,7 +19,7 @@ def xtest_published_date():
             'published': ['2019-08-15T14:35:45+00:00']
         }
     }
-    result = make_post(reqdata)
+    result = make_post(Post(reqdata))
     assertPost(result, 'md', "date: '2019-08-15T10:35:45-04:00'", 'hello')
     
 
@@ -27,7 +31,7 @@ def test_name_title():
             'name': ['this is a title']
         }
     }
-    result = make_post(reqdata)
+    result = make_post(Post(reqdata))
     assertPost(result, 'md', "title: this is a title", 'hello')
     
 def test_reply_to():
@@ -39,7 +43,7 @@ def test_reply_to():
             'in-reply-to': ['http://example.com/bad-take']
         }
     }
-    result = make_post(reqdata)
+    result = make_post(Post(reqdata))
     assertPost(result, 'md', 
                 "in-reply-to: http://example.com/bad-take\ntitle: this is a title",
                 'hello')
@@ -52,7 +56,7 @@ def test_category():
             'category': ['tag1', 'tag2']
         }
     }
-    result = make_post(reqdata)
+    result = make_post(Post(reqdata))
     assertPost(result, 'md', "tags:\n- tag1\n- tag2", 'hello')
  
 def test_blank_category():
@@ -64,6 +68,163 @@ def test_blank_category():
             'category': ['']
         }
     }
-    result = make_post(reqdata)
+    result = make_post(Post(reqdata))
     assertPost(result, 'md', "title: this is a title", 'hello')
- 
\ No newline at end of file
+ 
+
+def assertSameAsYaml(frontmatter):
+    parts = []
+    dump_frontmatter(frontmatter, parts)
+    assert ''.join(parts) == yaml.safe_dump(frontmatter)
+
+
+def test_frontmatter_matches_yaml():
+    assertSameAsYaml({
+        'title': 'this is a title',
+        'in-reply-to': 'http://example.com/bad-take',
+        'date': '2019-08-15T10:35:45-04:00',
+        'tags': ['tag1', 'tag2']
+    })
+
+
+def test_frontmatter_quoting_matches_yaml():
+    for value in ['yes', 'null', 'a: b', 'a #b', 'trailing ', ' leading',
+                  '12:30', '@handle', '', 'café', 'line\nbreak', 'tab\t',
+                  "it's", '"quoted"', '- dash', '2019-08-15']:
+        assertSameAsYaml({'title': value, 'tags': [value, 'tag']})
+
+
+def test_long_frontmatter_matches_yaml():
+    assertSameAsYaml({
+        'summary': 'a rather long summary ' * 10,
+        'title': 'déjà vu, encore une fois\t' * 5,
+        'tags': ['x' * 100]
+    })
+
+
+def test_nested_frontmatter_matches_yaml():
+    assertSameAsYaml({
+        'location': {'type': ['h-card'], 'properties': {'name': ['Home']}},
+        'photo': [{'value': 'https://example.com/a.jpg', 'alt': 'a photo'}],
+        'tags': []
+    })
+
+
+def test_parse_post_undoes_make_post():
+    reqdata = {
+        'type': ['h-entry'],
+        'properties': {
+            'content': [{'html': '<p>hello</p>'}],
+            'name': ['a title'],
+            'category': ['tag1', 'tag2'],
+            'in-reply-to': ['http://example.com/bad-take'],
+            'mp-slug': ['blub'],
+            'published': ['2019-08-15T14:35:45-04:00']
+        }
+    }
+    contents, ext = make_post(Post(reqdata))
+    parsed = parse_post(contents.encode('utf-8'), ext)
+    assert make_post(Post(parsed)) == [contents, ext]
+    assert parsed['properties']['name'] == ['a title']
+    assert parsed['properties']['category'] == ['tag1', 'tag2']
+    assert parsed['properties']['content'] == [{'html': '<p>hello</p>'}]
+
+
+def test_event_rules():
+    reqdata = {
+        'type': ['h-event'],
+        'properties': {
+            'name': ['a party'],
+            'start': ['2019-08-20T20:00:00-04:00'],
+            'location': ['the usual place'],
+            'content': ['bring snacks']
+        }
+    }
+    result = make_post(Post(reqdata))
+    assertPost(result, 'md',
+               "location: the usual place\n"
+               "start: '2019-08-20T20:00:00-04:00'\n"
+               "title: a party\ntype: h-event", 'bring snacks')
+    parsed = parse_post(result[0].encode('utf-8'), 'md')
+    assert parsed == reqdata
+
+
+def test_card_note_is_body():
+    reqdata = {
+        'type': ['h-card'],
+        'properties': {'name': ['Someone'], 'note': ['hi there']}
+    }
+    result = make_post(Post(reqdata))
+    assertPost(result, 'md', "title: Someone\ntype: h-card", 'hi there')
+    assert parse_post(result[0].encode('utf-8'), 'md') == reqdata
+
+
+def test_children_use_their_own_rules():
+    reqdata = {
+        'type': ['h-entry'],
+        'properties': {'content': ['see these']},
+        'children': [{
+            'type': ['h-cite'],
+            'properties': {'name': ['a cite'], 'content': ['cited'],
+                           'category': ['a', '']}
+        }, {
+            'type': ['h-card'],
+            'properties': {'name': ['Someone'], 'note': ['hi there']}
+        }]
+    }
+    contents, ext = make_post(Post(reqdata))
+    frontmatter = yaml.safe_load(contents.split('---\n')[1])
+    assert frontmatter['children'] == [
+        {'type': 'h-cite', 'name': ['a cite'], 'content': 'cited',
+         'tags': ['a']},
+        {'type': 'h-card', 'title': 'Someone', 'note': 'hi there'}
+    ]
+    parsed = parse_post(contents.encode('utf-8'), ext)
+    assert parsed['children'][1] == reqdata['children'][1]
+
+
+def test_register_type():
+    register_type('h-review', {'rating': {'policy': 'first'},
+                               'content': {'policy': 'body'}})
+    try:
+        contents, ext = make_post(Post({
+            'type': ['h-review'],
+            'properties': {'rating': ['5'], 'content': ['great']}
+        }))
+    finally:
+        del plans['h-review']
+    assert contents == "---\nrating: '5'\ntype: h-review\n---\n\ngreat"
+
+
+def test_toml_format():
+    reqdata = {
+        'type': ['h-entry'],
+        'properties': {
+            'content': [{'html': '<p>hello</p>'}],
+            'name': ['a "quoted" title é\x7f'],
+            'category': ['tag1', 'tag2'],
+            'location': [{'type': ['h-card'],
+                          'properties': {'name': ['Home']}}],
+            'published': ['2019-08-15T14:35:45-04:00']
+        }
+    }
+    contents, ext = make_post(Post(reqdata), 'toml')
+    assert ext == 'html'
+    assert contents.startswith('+++\n')
+    assert 'tags = ["tag1", "tag2"]\n' in contents
+    assert contents.endswith('+++\n\n<p>hello</p>')
+    parsed = parse_post(contents.encode('utf-8'), ext)
+    assert parsed['properties']['name'] == reqdata['properties']['name']
+    assert parsed['properties']['location'] == \
+        reqdata['properties']['location']
+    assert make_post(Post(parsed), 'toml') == [contents, ext]
+
+
+def test_json_format():
+    reqdata = {
+        'type': ['h-entry'],
+        'properties': {'content': ['hello'], 'category': ['a', 'b']}
+    }
+    contents, ext = make_post(Post(reqdata), 'json')
+    assert json.loads(contents) == reqdata
+    assert parse_post(contents.encode('utf-8'), ext) == reqdata
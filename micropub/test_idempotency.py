@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import tempfile
+from werkzeug.datastructures import MultiDict
+from micropub import idempotency
+from micropub.idempotency import IdempotencyStore, request_key
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_store(**kwargs):
+    path = os.path.join(tempfile.mkdtemp(), 'idempotency.sqlite')
+    clock = Clock()
+    return IdempotencyStore(path, clock=clock, **kwargs), clock
+
+
+def test_claim_returns_original_location():
+    store, clock = make_store()
+    assert store.claim('a', 'https://example.com/1') is None
+    assert store.claim('a', 'https://example.com/2') == \
+        'https://example.com/1'
+    assert store.claim('b', 'https://example.com/3') is None
+
+
+def test_claims_expire():
+    store, clock = make_store(ttl=60)
+    store.claim('a', 'https://example.com/1')
+    clock.now += 61
+    assert store.claim('a', 'https://example.com/2') is None
+    assert store.claim('a', 'https://example.com/3') == \
+        'https://example.com/2'
+
+
+def test_release_forgets_claim():
+    store, clock = make_store()
+    store.claim('a', 'https://example.com/1')
+    store.release('a')
+    assert store.claim('a', 'https://example.com/2') is None
+
+
+def test_oldest_claims_dropped():
+    store, clock = make_store(max_entries=3)
+    for i in range(idempotency.SWEEP_EVERY):
+        clock.now += 1
+        store.claim(str(i), f'https://example.com/{i}')
+    count = store.connection().execute(
+        'SELECT COUNT(*) FROM requests').fetchone()[0]
+    assert count == 4
+    assert store.claim('0', 'https://example.com/new') is None
+
+
+def test_request_key():
+    assert request_key('abc', {'type': ['h-entry']}, None) == 'key:abc'
+    assert request_key(None, {'type': ['h-entry'], 'access_token': 'x'},
+                       None) == \
+        request_key(None, {'access_token': 'y', 'type': ['h-entry']}, None)
+    form = MultiDict([('content', 'hi'), ('category[]', 'a'),
+                      ('access_token', 'x')])
+    same = MultiDict([('category[]', 'a'), ('content', 'hi')])
+    other = MultiDict([('content', 'hello'), ('category[]', 'a')])
+    assert request_key(None, None, form) == request_key(None, None, same)
+    assert request_key(None, None, form) != request_key(None, None, other)
+
+
+def test_request_key_hashes_the_canonical_json():
+    body = {'type': ['h-entry'], 'properties': {'content': ['é' * 1000]}}
+    data = json.dumps(body, sort_keys=True, separators=(',', ':'))
+    assert request_key(None, dict(body, access_token='x'), None) == \
+        'sha256:' + hashlib.sha256(data.encode('utf-8')).hexdigest()
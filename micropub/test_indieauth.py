@@ -0,0 +1,83 @@
+from unittest.mock import patch, Mock
+from flask import Response
+from micropub import app
+from micropub import indieauth
+
+
+def token_response(status, text):
+    r = Mock()
+    r.status_code = status
+    r.text = text
+    return r
+
+
+valid = token_response(
+    200, 'me=https%3A%2F%2Fmysite.com%2F&client_id=https%3A%2F%2Fquill.p3k.io'
+    '&scope=create+update')
+
+
+def setup_module():
+    app.config['ME'] = 'https://mysite.com'
+    app.config['TOKEN_ENDPOINT'] = 'https://tokens.example.com/token'
+
+
+def setup_function():
+    indieauth.token_cache = None
+
+
+def check(token):
+    with app.test_request_context('/'):
+        return indieauth.check_auth(token)
+
+
+@patch('micropub.indieauth.session')
+def test_valid_token_is_accepted(session):
+    session.get.return_value = valid
+    assert check('abc') is None
+
+
+@patch('micropub.indieauth.session')
+def test_token_endpoint_is_called_once(session):
+    session.get.return_value = valid
+    check('abc')
+    check('abc')
+    check('abc')
+    assert session.get.call_count == 1
+
+
+@patch('micropub.indieauth.session')
+def test_rejected_token_is_cached(session):
+    session.get.return_value = token_response(401, 'unauthorized')
+    assert isinstance(check('bad'), Response)
+    assert isinstance(check('bad'), Response)
+    assert session.get.call_count == 1
+
+
+@patch('micropub.indieauth.session')
+def test_rejected_token_expires(session):
+    session.get.return_value = token_response(401, 'unauthorized')
+    app.config['TOKEN_CACHE_NEGATIVE_TTL'] = 0
+    try:
+        check('bad')
+        check('bad')
+    finally:
+        del app.config['TOKEN_CACHE_NEGATIVE_TTL']
+    assert session.get.call_count == 2
+
+
+@patch('micropub.indieauth.session')
+def test_wrong_me_is_denied(session):
+    session.get.return_value = token_response(
+        200, 'me=https%3A%2F%2Fother.com%2F&client_id=x&scope=create')
+    assert isinstance(check('abc'), Response)
+
+
+@patch('micropub.indieauth.session')
+def test_wrong_scope_is_denied(session):
+    session.get.return_value = token_response(
+        200, 'me=https%3A%2F%2Fmysite.com%2F&client_id=x&scope=read')
+    assert isinstance(check('abc'), Response)
+
+
+def test_missing_token_is_denied():
+    assert isinstance(check(None), Response)
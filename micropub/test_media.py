@@ -0,0 +1,92 @@
+import io
+import os
+import tempfile
+from PIL import Image
+from micropub.media import MediaProcessor, process_image, upload_ext
+
+
+def make_jpeg(path, size, orientation=None):
+    exif = Image.Exif()
+    exif[0x010f] = 'Camera Maker'
+    if orientation:
+        exif[0x0112] = orientation
+    Image.new('RGB', size, 'red').save(path, 'JPEG', exif=exif.tobytes())
+
+
+def test_upload_ext():
+    assert upload_ext('photo.JPG', 'image/jpeg') == 'jpg'
+    assert upload_ext('blob', 'image/png') == 'png'
+    assert upload_ext('../../x.sh;rm', None) == 'bin'
+
+
+def test_exif_is_stripped_and_rotation_applied():
+    path = os.path.join(tempfile.mkdtemp(), 'photo.jpg')
+    make_jpeg(path, (40, 20), orientation=6)
+    assert process_image(path, 'jpg', ()) == {}
+    with Image.open(path) as image:
+        assert image.size == (20, 40)
+        assert not image.getexif()
+
+
+def test_narrower_copies_are_made():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'photo.jpg')
+    make_jpeg(path, (1000, 500))
+    variants = process_image(path, 'jpg', (480, 960, 1920))
+    assert variants == {480: os.path.join(directory, 'photo-480.jpg'),
+                        960: os.path.join(directory, 'photo-960.jpg')}
+    with Image.open(variants[480]) as image:
+        assert image.size == (480, 240)
+        assert not image.getexif()
+
+
+class Upload:
+    def __init__(self, data):
+        self.data = data
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.data)
+
+
+def commit_in_pool(workers):
+    committed = []
+
+    def commit_media(files, location):
+        committed.append((location, {path: f.read()
+                                     for path, f in files.items()}))
+
+    directory = tempfile.mkdtemp()
+    processor = MediaProcessor(directory, commit_media, widths=(10,),
+                               workers=workers)
+    image = io.BytesIO()
+    Image.new('RGB', (20, 20)).save(image, 'PNG')
+    path = processor.save(Upload(image.getvalue()), 'abc', 'png')
+    processor.submit(path, 'png', lambda w: f'media/abc{w or ""}.png',
+                     'https://mysite.com/media/abc.png')
+    if workers:
+        processor.get_pools()[1].shutdown()
+    assert [location for location, _ in committed] == \
+        ['https://mysite.com/media/abc.png']
+    assert sorted(committed[0][1]) == ['media/abc.png', 'media/abc10.png']
+    assert os.listdir(directory) == []
+
+
+def test_upload_processed_and_committed():
+    commit_in_pool(0)
+
+
+def test_upload_processed_in_worker_processes():
+    commit_in_pool(1)
+
+
+def test_unreadable_image_committed_as_is():
+    committed = []
+    directory = tempfile.mkdtemp()
+    processor = MediaProcessor(directory,
+                               lambda files, location: committed.append(
+                                   {p: f.read() for p, f in files.items()}),
+                               widths=(10,), workers=0)
+    path = processor.save(Upload(b'not a jpeg'), 'abc', 'jpg')
+    processor.submit(path, 'jpg', lambda w: 'media/abc.jpg', 'location')
+    assert committed == [{'media/abc.jpg': b'not a jpeg'}]
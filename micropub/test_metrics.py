@@ -0,0 +1,50 @@
+import json
+import os
+import tempfile
+from micropub import metrics
+
+
+def setup_function():
+    metrics.configure(tempfile.mkdtemp())
+    metrics._histograms.clear()
+    metrics._counters.clear()
+
+
+def test_histogram_rendering():
+    metrics.observe('micropub_stage_seconds', 0.003, stage='auth')
+    metrics.observe('micropub_stage_seconds', 0.2, stage='auth')
+    text = metrics.render()
+    assert '# TYPE micropub_stage_seconds histogram\n' in text
+    assert 'micropub_stage_seconds_bucket{stage="auth",le="0.005"} 1\n' \
+        in text
+    assert 'micropub_stage_seconds_bucket{stage="auth",le="0.25"} 2\n' in text
+    assert 'micropub_stage_seconds_bucket{stage="auth",le="+Inf"} 2\n' in text
+    assert 'micropub_stage_seconds_count{stage="auth"} 2\n' in text
+
+
+def test_counters_and_gauges():
+    metrics.inc('micropub_github_failures_total', call='update',
+                status='422')
+    metrics.inc('micropub_github_failures_total', call='update',
+                status='422')
+    text = metrics.render({'micropub_queue_depth': 3})
+    assert 'micropub_github_failures_total{call="update",status="422"} 2\n' \
+        in text
+    assert '# TYPE micropub_queue_depth gauge\nmicropub_queue_depth 3\n' \
+        in text
+
+
+def test_processes_are_added_up():
+    metrics.inc('micropub_responses_total', endpoint='handle_root',
+                status='202')
+    metrics.observe('micropub_stage_seconds', 0.003, stage='commit')
+    metrics.flush()
+    with open(os.path.join(metrics.directory, f'{os.getpid()}.json')) as f:
+        mine = json.load(f)
+    # the same again, from another worker
+    with open(os.path.join(metrics.directory, '1.json'), 'w') as f:
+        json.dump(mine, f)
+    text = metrics.render()
+    assert 'micropub_responses_total{endpoint="handle_root",status="202"} 2' \
+        in text
+    assert 'micropub_stage_seconds_count{stage="commit"} 2\n' in text
@@ -1,9 +1,15 @@
+import io
 import os
 import json
+import tempfile
 from unittest.mock import patch
-from micropub import app
+import micropub.micropub
+from micropub import app, configure
 from micropub.micropub import form2json, extract_create_request, \
     make_permalink
+from micropub.post import Post
+from micropub.postindex import PostIndex
+from micropub.commit import RateLimited
 from werkzeug.datastructures import MultiDict
 from nose.tools import with_setup
 
@@ -27,6 +33,14 @@ def setup_module():
     os.environ['GH_REPO'] = 'drivet/pelican-test-blog'
     os.environ['MICROPUB_REPO_PATH_FORMAT'] = \
         '/' + datef + '/' + timef + '.mpj'
+    os.environ['MICROPUB_MEDIA_DIR'] = tempfile.mkdtemp()
+    os.environ['MICROPUB_MEDIA_WORKERS'] = '0'
+    os.environ['MICROPUB_METRICS_DIR'] = tempfile.mkdtemp()
+    os.environ['MICROPUB_INDEX'] = \
+        os.path.join(tempfile.mkdtemp(), 'index.sqlite')
+    os.environ['MICROPUB_IDEMPOTENCY_DB'] = \
+        os.path.join(tempfile.mkdtemp(), 'idempotency.sqlite')
+    configure()
 
 
 def test_get_fails_with_no_query():
@@ -144,6 +158,45 @@ def test_good_micropub_json_is_validated():
     assert extract_create_request(json, None) == json
 
 
+def test_html_content_is_validated():
+    json = {
+        'type': ['h-entry'],
+        'properties': {
+            'content': [{'html': '<p>hello</p>'}],
+            'published': ['2019-08-15T14:35:45.5']
+        }
+    }
+    assert extract_create_request(json, None) == json
+
+
+def test_nested_micropub_json_is_validated():
+    json = {
+        'type': ['h-entry'],
+        'properties': {
+            'content': ['hello'],
+            'published': ['2019-08-15T14:35:45.5'],
+            'author': [{
+                'type': ['h-card'],
+                'properties': {'name': ['Dude']},
+                'value': 'Dude'
+            }]
+        }
+    }
+    assert extract_create_request(json, None) == json
+
+
+def test_bad_property_name_throws():
+    try:
+        extract_create_request({
+            'type': ['h-entry'],
+            'properties': {'Content': ['hello']}
+        }, None)
+    except Exception:
+        pass
+    else:
+        assert False
+
+
 def test_json_overrides_form_data():
     json = {
         'type': ['h-entry'],
@@ -198,7 +251,7 @@ def test_should_make_permalink():
                 'published': ['2019-08-15T14:16:34.6']
             }
         }
-        permalink = make_permalink(request_data)
+        permalink = make_permalink(Post(request_data))
         print(permalink)
         assert permalink == '2019/08/15/blub'
 
@@ -213,7 +266,7 @@ def test_should_handle_missing_slug_in_permalink():
                 'published': ['2019-08-15T14:16:34.6']
             }
         }
-        permalink = make_permalink(request_data)
+        permalink = make_permalink(Post(request_data))
         assert permalink == '2019/08/15/141634'
 
 
@@ -236,3 +289,383 @@ def test_h_entry_is_default_in_forms():
     result = form2json(form)
     assert result['type'] == ['h-entry']
     assert result['properties']['in-reply-to'] == ['some-post']
+
+
+def test_config_query_is_json():
+    rv = client.get('/?q=config')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'application/json'
+    jdict = json.loads(rv.data)
+    assert 'syndicate-to' in jdict
+    assert rv.headers['ETag']
+    assert 'max-age' in rv.headers['Cache-Control']
+
+
+def test_syndicate_to_query():
+    rv = client.get('/?q=syndicate-to')
+    assert rv.status_code == 200
+    assert list(json.loads(rv.data).keys()) == ['syndicate-to']
+
+
+def test_unchanged_config_is_not_modified():
+    rv = client.get('/?q=config')
+    rv = client.get('/?q=config',
+                    headers={'If-None-Match': rv.headers['ETag']})
+    assert rv.status_code == 304
+    assert rv.data == b''
+
+
+def test_unsupported_query_fails():
+    rv = client.get('/?q=nothing')
+    assert rv.status_code == 400
+
+
+def test_should_make_permalink_with_timezone():
+    with app.app_context():
+        request_data = {
+            'type': 'h-entry',
+            'properties': {
+                'published': ['2019-08-15T14:16:34-04:00']
+            }
+        }
+        permalink = make_permalink(Post(request_data))
+        assert permalink == '2019/08/15/141634'
+
+
+@patch('micropub.micropub.backend')
+def test_create_commits_post(backend_mock):
+    rv = client.post('/', data={
+        'content': 'hello',
+        'mp-slug': 'blub',
+        'published': '2019-07-16T13:45:23.5',
+        'access_token': 'ZZZZSSSS'
+    })
+    assert rv.status_code == 202
+    assert rv.headers['Location'] == 'https://mysite.com/2019/07/16/blub'
+    files, message = backend_mock.commit.call_args[0]
+    assert list(files.keys()) == ['/2019/07/16/134523.mpj']
+    post = files['/2019/07/16/134523.mpj']
+    assert 'ZZZZSSSS' not in post
+    assert post.endswith('---\n\nhello')
+    assert message == 'new post'
+
+
+@patch('micropub.micropub.backend')
+def test_bad_published_date_is_refused(backend_mock):
+    for published in ('', 'last tuesday'):
+        rv = client.post('/', data={'content': 'hello',
+                                    'published': published})
+        assert rv.status_code == 400
+    assert not backend_mock.commit.called
+
+
+def test_post_model_parses_once():
+    post = Post({
+        'type': ['h-entry'],
+        'properties': {
+            'content': [{'html': '<p>hello</p>'}],
+            'published': ['2019-08-15T14:16:34.6']
+        }
+    })
+    assert post.published.hour == 14
+    assert post.slug == '141634'
+    assert post.content == {'html': '<p>hello</p>'}
+
+
+def test_oversized_post_is_refused():
+    small = micropub.micropub.settings._replace(max_body_size=100)
+    with patch('micropub.micropub.settings', small):
+        rv = client.post('/', data={'content': 'x' * 200})
+    assert rv.status_code == 413
+
+
+@patch('micropub.micropub.backend')
+def test_oversized_chunked_post_is_refused(backend_mock):
+    def post_chunked(body, content_type):
+        return client.post('/', input_stream=io.BytesIO(body),
+                           content_type=content_type,
+                           headers={'Transfer-Encoding': 'chunked'},
+                           environ_overrides={'wsgi.input_terminated': True})
+
+    form = 'application/x-www-form-urlencoded'
+    small = micropub.micropub.settings._replace(max_body_size=100)
+    with patch('micropub.micropub.settings', small):
+        rv = post_chunked(b'content=' + b'x' * 200, form)
+        assert rv.status_code == 413
+        rv = post_chunked(b'{"type": ["h-entry"], "properties": '
+                          b'{"content": ["' + b'x' * 200 + b'"]}}',
+                          'application/json')
+        assert rv.status_code == 413
+        rv = post_chunked(b'content=chunked', form)
+        assert rv.status_code == 202
+    assert backend_mock.commit.call_count == 1
+
+
+@patch('micropub.micropub.backend')
+def test_large_post_is_streamed_from_file(backend_mock):
+    contents = []
+    backend_mock.commit.side_effect = \
+        lambda files, message: contents.append(
+            list(files.values())[0].read())
+    small = micropub.micropub.settings._replace(spool_size=10)
+    with patch('micropub.micropub.settings', small):
+        rv = client.post('/', data={
+            'content': 'hello ' * 100,
+            'mp-slug': 'blub',
+            'published': '2019-07-16T13:45:23.5'
+        })
+    assert rv.status_code == 202
+    assert contents[0].startswith(b'---\n')
+    assert contents[0].endswith(b'---\n\n' + b'hello ' * 100)
+
+
+@patch('micropub.micropub.backend')
+def test_media_upload(backend_mock):
+    rv = client.post('/media', data={
+        'file': (io.BytesIO(b'some audio'), 'song.mp3')
+    })
+    assert rv.status_code == 201
+    location = rv.headers['Location']
+    assert location.startswith('https://mysite.com/media/')
+    assert location.endswith('.mp3')
+    files, message = backend_mock.commit.call_args[0]
+    assert message == 'new media'
+    assert list(files) == ['content' + location[len('https://mysite.com'):]]
+
+
+def test_media_upload_needs_a_file():
+    rv = client.post('/media', data={'content': 'hello'})
+    assert rv.status_code == 400
+
+
+def test_oversized_media_is_refused():
+    small = micropub.micropub.settings._replace(media_max_size=100)
+    with patch('micropub.micropub.settings', small):
+        rv = client.post('/media', data={
+            'file': (io.BytesIO(b'x' * 200), 'song.mp3')
+        })
+    assert rv.status_code == 413
+
+
+def create_post(backend_mock, **props):
+    committed = {}
+    backend_mock.commit.side_effect = \
+        lambda files, message: committed.update(files)
+    backend_mock.read.side_effect = \
+        lambda path: committed[path].encode('utf-8') \
+        if isinstance(committed.get(path), str) else committed.get(path)
+    rv = client.post('/', data=props)
+    return rv.headers['Location'], committed
+
+
+@patch('micropub.micropub.backend')
+def test_update_replaces_and_adds(backend_mock):
+    url, committed = create_post(backend_mock, content='hello',
+                                 category='one',
+                                 published='2019-07-17T13:45:23')
+    rv = client.post('/', json={
+        'action': 'update',
+        'url': url,
+        'replace': {'content': ['goodbye']},
+        'add': {'category': ['two']}
+    })
+    assert rv.status_code == 204
+    files, message = backend_mock.commit.call_args[0]
+    assert message == 'update post'
+    assert list(files) == ['/2019/07/17/134523.mpj']
+    post = files['/2019/07/17/134523.mpj']
+    assert 'tags:\n- one\n- two\n' in post
+    assert post.endswith('---\n\ngoodbye')
+
+
+@patch('micropub.micropub.backend')
+def test_update_deletes_properties(backend_mock):
+    url, committed = create_post(backend_mock, **{
+        'content': 'hello',
+        'category[]': ['one', 'two'],
+        'published': '2019-07-18T13:45:23'
+    })
+    rv = client.post('/', json={
+        'action': 'update',
+        'url': url,
+        'delete': {'category': ['one']}
+    })
+    assert rv.status_code == 204
+    assert 'tags:\n- two\n' in committed['/2019/07/18/134523.mpj']
+    rv = client.post('/', json={
+        'action': 'update',
+        'url': url,
+        'delete': ['category']
+    })
+    assert rv.status_code == 204
+    assert 'tags' not in committed['/2019/07/18/134523.mpj']
+
+
+@patch('micropub.micropub.backend')
+def test_delete_and_undelete(backend_mock):
+    url, committed = create_post(backend_mock, content='hello',
+                                 published='2019-07-19T13:45:23')
+    original = committed['/2019/07/19/134523.mpj']
+    rv = client.post('/', data={'action': 'delete', 'url': url})
+    assert rv.status_code == 204
+    assert backend_mock.commit.call_args[0] == \
+        ({'/2019/07/19/134523.mpj': None}, 'delete post')
+    rv = client.post('/', data={'action': 'undelete', 'url': url})
+    assert rv.status_code == 204
+    assert backend_mock.commit.call_args[0] == \
+        ({'/2019/07/19/134523.mpj': original.encode('utf-8')},
+         'undelete post')
+
+
+@patch('micropub.micropub.backend')
+def test_action_on_unknown_post(backend_mock):
+    backend_mock.list_files.return_value = ['README.md']
+    rv = client.post('/', json={'action': 'delete',
+                                'url': 'https://mysite.com/2001/01/01/x'})
+    assert rv.status_code == 400
+    assert not backend_mock.commit.called
+
+
+def test_unsupported_action():
+    rv = client.post('/', json={'action': 'explode',
+                                'url': 'https://mysite.com/2001/01/01/x'})
+    assert rv.status_code == 400
+
+
+@patch('micropub.micropub.backend')
+def test_index_rebuilt_from_repo(backend_mock):
+    index = PostIndex(os.path.join(tempfile.mkdtemp(), 'index.sqlite'))
+    backend_mock.list_files.return_value = ['README.md',
+                                            '/2019/07/20/134523.mpj']
+    backend_mock.read.return_value = b'---\ntitle: old\n---\n'
+    with patch('micropub.micropub.post_index', index):
+        rv = client.post('/', data={
+            'action': 'delete',
+            'url': 'https://mysite.com/2019/07/20/134523'
+        })
+    assert rv.status_code == 204
+    assert backend_mock.commit.call_args[0] == \
+        ({'/2019/07/20/134523.mpj': None}, 'delete post')
+    assert backend_mock.list_files.call_count == 1
+
+
+@patch('micropub.micropub.backend')
+def test_source_served_from_cache(backend_mock):
+    url, committed = create_post(backend_mock, **{
+        'content': 'hello',
+        'category[]': ['one', 'two'],
+        'published': '2019-07-21T13:45:23'
+    })
+    rv = client.get('/', query_string={'q': 'source', 'url': url})
+    assert rv.status_code == 200
+    source = json.loads(rv.data)
+    assert source['type'] == ['h-entry']
+    assert source['properties']['content'] == ['hello']
+    assert source['properties']['category'] == ['one', 'two']
+    assert not backend_mock.read.called
+
+    rv = client.get('/', query_string={'q': 'source', 'url': url,
+                                       'properties[]': ['category', 'x']})
+    assert json.loads(rv.data) == {'properties': {'category': ['one', 'two']}}
+
+
+@patch('micropub.micropub.backend')
+def test_source_read_from_repo_once(backend_mock):
+    url, committed = create_post(backend_mock, content='hello',
+                                 published='2019-07-22T13:45:23')
+    micropub.micropub.post_cache.clear()
+    for _ in range(2):
+        rv = client.get('/', query_string={'q': 'source', 'url': url})
+        assert json.loads(rv.data)['properties']['content'] == ['hello']
+    assert backend_mock.read.call_count == 1
+
+
+@patch('micropub.micropub.backend')
+def test_source_of_deleted_post(backend_mock):
+    url, committed = create_post(backend_mock, content='hello',
+                                 published='2019-07-23T13:45:23')
+    client.post('/', data={'action': 'delete', 'url': url})
+    rv = client.get('/', query_string={'q': 'source', 'url': url})
+    assert rv.status_code == 410
+
+
+def test_source_of_unknown_post():
+    rv = client.get('/', query_string={'q': 'source',
+                                       'url': 'https://elsewhere.com/x'})
+    assert rv.status_code == 400
+
+
+@patch('micropub.micropub.backend')
+def test_metrics(backend_mock):
+    client.post('/', json={
+        'type': ['h-entry'],
+        'properties': {'content': ['hello'],
+                       'published': ['2019-07-24T13:45:23']}
+    })
+    rv = client.get('/metrics')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/plain'
+    text = rv.data.decode('utf-8')
+    for stage in ('validate', 'make_post', 'commit', 'create'):
+        assert f'micropub_stage_seconds_count{{stage="{stage}"}}' in text
+    assert 'micropub_responses_total{endpoint="handle_root",status="202"}' \
+        in text
+
+
+def test_metrics_token():
+    secured = micropub.micropub.settings._replace(metrics_token='s3cret')
+    with patch('micropub.micropub.settings', secured):
+        assert client.get('/metrics').status_code == 401
+        rv = client.get('/metrics',
+                        headers={'Authorization': 'Bearer s3cret'})
+        assert rv.status_code == 200
+
+
+@patch('micropub.micropub.backend')
+def test_rate_limited_post_is_retried_later(backend_mock):
+    backend_mock.commit.side_effect = RateLimited('slow down', 429, 12.2)
+    rv = client.post('/', data={'content': 'hello'})
+    assert rv.status_code == 503
+    assert rv.headers['Retry-After'] == '13'
+
+
+@patch('micropub.micropub.backend')
+def test_retried_create_is_not_committed_again(backend_mock):
+    form = {'content': 'only once', 'access_token': 'first'}
+    rv = client.post('/', data=form)
+    assert rv.status_code == 202
+    # a retry a second later would get a new published date
+    form['access_token'] = 'second'
+    with patch('micropub.micropub.fill_defaults',
+               lambda data: data['properties'].setdefault(
+                   'published', ['2030-01-01T00:00:00'])):
+        again = client.post('/', data=form)
+    assert again.status_code == 202
+    assert again.headers['Location'] == rv.headers['Location']
+    assert backend_mock.commit.call_count == 1
+
+
+@patch('micropub.micropub.backend')
+def test_idempotency_key(backend_mock):
+    headers = {'Idempotency-Key': 'abc123'}
+    rv = client.post('/', json={
+        'type': ['h-entry'],
+        'properties': {'content': ['first'],
+                       'published': ['2019-07-25T13:45:23']}
+    }, headers=headers)
+    again = client.post('/', json={
+        'type': ['h-entry'],
+        'properties': {'content': ['first, edited'],
+                       'published': ['2019-07-26T13:45:23']}
+    }, headers=headers)
+    assert again.headers['Location'] == rv.headers['Location']
+    assert backend_mock.commit.call_count == 1
+
+
+@patch('micropub.micropub.backend')
+def test_failed_create_can_be_retried(backend_mock):
+    backend_mock.commit.side_effect = [RateLimited('slow down', 429, 1), None]
+    form = {'content': 'try, try again'}
+    assert client.post('/', data=form).status_code == 503
+    assert client.post('/', data=form).status_code == 202
+    assert backend_mock.commit.call_count == 2
@@ -0,0 +1,51 @@
+import datetime
+import os
+import tempfile
+from micropub.postindex import PostIndex, compile_path_pattern, match_path
+
+
+def make_index():
+    return PostIndex(os.path.join(tempfile.mkdtemp(), 'index.sqlite'))
+
+
+def test_put_get_and_delete():
+    index = make_index()
+    assert index.get('2019/08/15/hello') is None
+    assert index.put('2019/08/15/hello', 'content/hello.md') == 0
+    assert index.get('2019/08/15/hello') == ('content/hello.md', None, 0)
+    assert index.mark_deleted('2019/08/15/hello', b'---\n') == 1
+    assert index.get('2019/08/15/hello') == ('content/hello.md', b'---\n', 1)
+    assert index.put('2019/08/15/hello', 'content/hello.md') == 2
+    assert index.get('2019/08/15/hello') == ('content/hello.md', None, 2)
+
+
+def test_rebuild_keeps_known_entries():
+    index = make_index()
+    index.put('2019/08/15/hello', 'content/right.md')
+    assert not index.is_built()
+    index.rebuild([('2019/08/15/hello', 'content/wrong.md'),
+                   ('2019/08/16/other', 'content/other.md')])
+    assert index.is_built()
+    assert index.get('2019/08/15/hello') == ('content/right.md', None, 0)
+    assert index.get('2019/08/16/other') == ('content/other.md', None, 0)
+
+
+def test_match_path():
+    pattern = compile_path_pattern(
+        'content/{published:%Y}/{published:%m}/{published:%d}/'
+        '{published:%H}{published:%M}{published:%S}.{ext}')
+    assert match_path(pattern, 'content/2019/08/15/143545.md') == \
+        (datetime.datetime(2019, 8, 15, 14, 35, 45), '143545')
+    assert match_path(pattern, 'content/2019/08/15/143545.txt') is None
+    assert match_path(pattern, 'README.md') is None
+
+
+def test_match_path_with_slug():
+    pattern = compile_path_pattern('{published:%Y-%m-%d}-{slug}.{ext}')
+    assert match_path(pattern, '2019-08-15-hello-world.html') == \
+        (datetime.datetime(2019, 8, 15), 'hello-world')
+
+
+def test_unreadable_formats():
+    assert compile_path_pattern('{published:%b}/{slug}.md') is None
+    assert compile_path_pattern('{published.year}/{slug}.md') is None
@@ -0,0 +1,70 @@
+from micropub.ratelimit import RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_limiter(reserve=10):
+    clock = Clock()
+    return RateLimiter(reserve, clock), clock
+
+
+def test_no_waiting_with_budget_to_spare():
+    limiter, clock = make_limiter()
+    assert limiter.reserve_slot() == 0
+    limiter.update(200, {'X-RateLimit-Remaining': '4000',
+                         'X-RateLimit-Reset': '4600'})
+    assert limiter.reserve_slot() == 0
+    assert limiter.reserve_slot() == 0
+
+
+def test_calls_spread_out_when_budget_is_low():
+    limiter, clock = make_limiter()
+    limiter.update(200, {'X-RateLimit-Remaining': '5',
+                         'X-RateLimit-Reset': '1100'})
+    assert limiter.reserve_slot() == 0
+    assert limiter.reserve_slot() == 20
+    assert limiter.reserve_slot() == 45
+
+
+def test_wait_for_reset_when_budget_is_gone():
+    limiter, clock = make_limiter()
+    limiter.update(200, {'X-RateLimit-Remaining': '0',
+                         'X-RateLimit-Reset': '1300'})
+    assert limiter.reserve_slot(max_wait=10) == 300
+    assert limiter.reserve_slot() == 300
+    clock.now = 1300.0
+    assert limiter.reserve_slot() == 0
+
+
+def test_retry_after_blocks_everyone():
+    limiter, clock = make_limiter()
+    assert limiter.update(429, {'Retry-After': '30'})
+    assert limiter.delay() == 30
+    assert limiter.reserve_slot() == 30
+
+
+def test_secondary_limit_backs_off():
+    limiter, clock = make_limiter()
+    assert limiter.update(403, {}, 'You have exceeded a secondary rate '
+                                   'limit')
+    assert limiter.delay() == 60
+    clock.now += 60
+    assert limiter.update(403, {}, 'You have exceeded a secondary rate '
+                                   'limit')
+    assert limiter.delay() == 120
+    clock.now += 120
+    limiter.update(200, {})
+    assert limiter.update(429, {})
+    assert limiter.delay() == 60
+
+
+def test_plain_forbidden_is_not_rate_limiting():
+    limiter, clock = make_limiter()
+    assert not limiter.update(403, {}, 'Resource not accessible')
+    assert limiter.delay() == 0
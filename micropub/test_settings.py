@@ -0,0 +1,83 @@
+import datetime
+from micropub.settings import load_settings, ConfigError
+
+
+env = {
+    'GH_REPO': 'drivet/test-blog',
+    'GH_USERNAME': 'dude',
+    'GH_PASSWORD': 'amazing_password'
+}
+
+
+def assert_config_error(environ):
+    try:
+        load_settings(environ)
+    except ConfigError:
+        pass
+    else:
+        assert False
+
+
+def test_defaults():
+    settings = load_settings(env)
+    assert settings.repo == 'drivet/test-blog'
+    assert settings.branch == 'main'
+    # as deploys pass on settings they don't have
+    assert load_settings(dict(env, MICROPUB_BRANCH='')).branch == 'main'
+    assert settings.backend == 'github'
+    assert settings.queue_dir is None
+
+
+def test_missing_repo_fails():
+    assert_config_error({'GH_USERNAME': 'dude'})
+
+
+def test_missing_username_fails():
+    assert_config_error({'GH_REPO': 'drivet/test-blog'})
+
+
+def test_formats_are_compiled():
+    settings = load_settings(dict(env, MICROPUB_PERMALINK_FORMAT=
+                                  '{published:%Y}/{slug}'))
+    published = datetime.datetime(2019, 8, 15, 14, 35, 45)
+    assert settings.format_permalink(published=published, slug='blub') == \
+        '2019/blub'
+    assert settings.format_repo_path(published=published, slug='blub',
+                                     ext='md') == \
+        'content/micropub/2019/08/15/143545.md'
+
+
+def test_unknown_format_field_fails():
+    assert_config_error(dict(env, MICROPUB_PERMALINK_FORMAT='{title}'))
+
+
+def test_malformed_format_fails():
+    assert_config_error(dict(env, MICROPUB_REPO_PATH_FORMAT='{published'))
+
+
+def test_bad_number_fails():
+    assert_config_error(dict(env, MICROPUB_BATCH_SIZE='lots'))
+
+
+def test_unknown_backend_fails():
+    assert_config_error(dict(env, MICROPUB_BACKEND='svn'))
+
+
+def test_media_widths():
+    assert load_settings(env).media_widths == (480, 960, 1920)
+    settings = load_settings(dict(env, MICROPUB_MEDIA_WIDTHS='800, 400'))
+    assert settings.media_widths == (400, 800)
+    assert_config_error(dict(env, MICROPUB_MEDIA_WIDTHS='big'))
+
+
+def test_post_formats():
+    assert load_settings(env).post_format('content/a.md') == 'yaml'
+    settings = load_settings(dict(
+        env, MICROPUB_POST_FORMAT='toml',
+        MICROPUB_POST_FORMATS='content/notes/*=json, content/*.html=yaml'))
+    assert settings.post_format('content/notes/1.md') == 'json'
+    assert settings.post_format('content/2019/1.html') == 'yaml'
+    assert settings.post_format('content/2019/1.md') == 'toml'
+    assert_config_error(dict(env, MICROPUB_POST_FORMAT='xml'))
+    assert_config_error(dict(env, MICROPUB_POST_FORMATS='content/*'))
+    assert_config_error(dict(env, MICROPUB_POST_FORMATS='content/*=xml'))
@@ -0,0 +1,49 @@
+import datetime
+from micropub.utils import parse_datetime, LRUCache
+
+
+def test_parses_fractional_seconds():
+    assert parse_datetime('2019-07-16T13:45:23.5') == \
+        datetime.datetime(2019, 7, 16, 13, 45, 23, 500000)
+
+
+def test_parses_whole_seconds():
+    assert parse_datetime('2019-07-16T13:45:23') == \
+        datetime.datetime(2019, 7, 16, 13, 45, 23)
+
+
+def test_parses_offsets():
+    d = parse_datetime('2019-08-15T14:35:45-04:00')
+    assert d.utcoffset() == datetime.timedelta(hours=-4)
+    d = parse_datetime('2019-08-15T14:35:45Z')
+    assert d.utcoffset() == datetime.timedelta(0)
+    d = parse_datetime('2019-08-15T14:35:45.123456789+0530')
+    assert d.utcoffset() == datetime.timedelta(hours=5, minutes=30)
+    assert d.microsecond == 123456
+
+
+def test_rejects_garbage():
+    for datestr in ['yesterday', '2019-08-15T14:35:45-5', '2019-13-01']:
+        try:
+            parse_datetime(datestr)
+        except ValueError:
+            pass
+        else:
+            assert False
+
+
+def test_lru_cache_evicts_oldest():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_lru_cache_expires():
+    cache = LRUCache(2)
+    cache.put('a', 1, ttl=0)
+    assert cache.get('a') is None
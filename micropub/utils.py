@@ -1,5 +1,11 @@
+import datetime
 import functools
+import re
+import threading
+import time
+from collections import OrderedDict
 from flask import current_app as app
+from werkzeug.exceptions import RequestEntityTooLarge
 
 
 def disable_if_testing(decorator):
@@ -12,3 +18,104 @@ def disable_if_testing(decorator):
                 return decorator(func)(*args, **kwargs)
         return wrapper_dit
     return decorator_dit
+
+
+class LRUCache:
+    """A thread safe, size bounded cache whose entries expire after a
+    per-entry time to live, in seconds."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl=None):
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class LimitedInput:
+    """Wraps a request body of unknown length (sent chunked), so reading
+    more than limit bytes of it refuses the request with a 413."""
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.count = 0
+
+    def read(self, size=-1):
+        return self.check(self.stream.read(self.allowed(size)))
+
+    def readline(self, size=-1):
+        return self.check(self.stream.readline(self.allowed(size)))
+
+    def allowed(self, size):
+        # one more than the limit, to tell when it's gone over
+        left = self.limit - self.count + 1
+        return left if size is None or size < 0 else min(size, left)
+
+    def check(self, data):
+        self.count += len(data)
+        if self.count > self.limit:
+            raise RequestEntityTooLarge()
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+iso_re = re.compile(r'(\d{4})-(\d\d)-(\d\d)'
+                    r'(?:[Tt ](\d\d):(\d\d)(?::(\d\d)(?:[.,](\d+))?)?)?'
+                    r'(?:([Zz])|([+-])(\d\d):?(\d\d))?')
+
+
+def parse_datetime(datestr):
+    """Parse an RFC 3339 / ISO 8601 timestamp, like 2019-08-15T14:35:45.5
+    or 2019-08-15T14:35:45-04:00.  The result is naive when there's no
+    offset.  Raises ValueError on anything else."""
+    try:
+        return datetime.datetime.fromisoformat(datestr)
+    except (ValueError, AttributeError):
+        pass
+    m = iso_re.fullmatch(datestr) if isinstance(datestr, str) else None
+    if m is None:
+        raise ValueError(f'Invalid date: {datestr!r}')
+    year, month, day, hour, minute, second, fraction, z, sign, tzh, tzm = \
+        m.groups()
+    tz = None
+    if z:
+        tz = datetime.timezone.utc
+    elif sign:
+        offset = datetime.timedelta(hours=int(tzh), minutes=int(tzm))
+        tz = datetime.timezone(-offset if sign == '-' else offset)
+    return datetime.datetime(int(year), int(month), int(day),
+                             int(hour or 0), int(minute or 0),
+                             int(second or 0),
+                             int((fraction or '0')[:6].ljust(6, '0')), tz)
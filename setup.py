@@ -28,7 +28,9 @@ REQUIRED = [
 # What packages are optional?
 EXTRAS = {
     'dev': ['invoke', 'fabric', 'nose',
-            'jedi', 'rope', 'flake8', 'autopep8', 'yapf', 'black']
+            'jedi', 'rope', 'flake8', 'autopep8', 'yapf', 'black'],
+    # serving with asgi.py, see micropub/asgi.py
+    'async': ['httpx', 'asgiref', 'uvicorn']
 }
 
 # The rest you shouldn't have to touch too much :)
@@ -6,11 +6,24 @@ def run(c):
     c.run('python -m main')
 
 
+@task
+def run_async(c):
+    c.run('uvicorn asgi:application')
+
+
 @task
 def test(c):
     c.run('nosetests')
 
 
+@task
+def bench(c, latency=0.0, iterations=200, save=False):
+    args = f'--latency {latency} --iterations {iterations}'
+    if save:
+        args += ' --save'
+    c.run(f'python -m micropub.bench {args}')
+
+
 @task
 def dbuild(c):
     c.run('docker image build -t ' +